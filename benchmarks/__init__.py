@@ -0,0 +1 @@
+"""Offline benchmarks with local Scoutnet and Google stand-ins."""
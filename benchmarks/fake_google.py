@@ -0,0 +1,478 @@
+"""Local stand-in for the Admin SDK directory_v1 API."""
+import json
+import random
+import re
+import threading
+import time
+import http.server
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs, unquote
+
+SERVICE_PATH = "admin/directory/v1/"
+BATCH_PATH = "batch/admin/directory_v1"
+MAX_PAGE_SIZE = {"groups": 200, "members": 200, "users": 500}
+DEFAULT_PAGE_SIZE = {"groups": 200, "members": 200, "users": 100}
+
+Response = Tuple[int, Optional[Dict[str, Any]]]
+
+
+def _method(
+    method_id: str,
+    http_method: str,
+    path: str,
+    path_params: List[str] = [],
+    query_params: List[str] = [],
+    request: str = None,
+    response: str = None,
+) -> Dict[str, Any]:
+    parameters: Dict[str, Any] = {
+        name: {"type": "string", "location": "path", "required": True}
+        for name in path_params
+    }
+    for name in query_params:
+        parameters[name] = {
+            "type": "integer" if name == "maxResults" else "string",
+            "location": "query",
+        }
+    description: Dict[str, Any] = {
+        "id": "directory.%s" % method_id,
+        "httpMethod": http_method,
+        "path": path,
+        "parameters": parameters,
+        "parameterOrder": path_params,
+    }
+    if request is not None:
+        description["request"] = {"$ref": request}
+    if response is not None:
+        description["response"] = {"$ref": response}
+    return description
+
+
+def discovery_document(root_url: str) -> Dict[str, Any]:
+    """Return a discovery document for the subset of directory_v1 used."""
+    group = ["groupKey"]
+    paging = ["maxResults", "pageToken"]
+    schemas = [
+        "Group", "Groups", "Alias", "Aliases", "Member", "Members", "User", "Users",
+    ]
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "admin:directory_v1",
+        "name": "admin",
+        "version": "directory_v1",
+        "rootUrl": root_url,
+        "servicePath": SERVICE_PATH,
+        "batchPath": BATCH_PATH,
+        "parameters": {
+            name: {"type": "string", "location": "query"}
+            for name in ["alt", "fields", "key", "prettyPrint", "quotaUser"]
+        },
+        "schemas": {name: {"id": name, "type": "object"} for name in schemas},
+        "resources": {
+            "groups": {
+                "methods": {
+                    "list": _method(
+                        "groups.list", "GET", "groups", [],
+                        ["domain", "customer", "query"] + paging, None, "Groups",
+                    ),
+                    "get": _method(
+                        "groups.get", "GET", "groups/{groupKey}", group,
+                        response="Group",
+                    ),
+                    "insert": _method(
+                        "groups.insert", "POST", "groups", request="Group",
+                        response="Group",
+                    ),
+                    "update": _method(
+                        "groups.update", "PUT", "groups/{groupKey}", group,
+                        request="Group", response="Group",
+                    ),
+                    "patch": _method(
+                        "groups.patch", "PATCH", "groups/{groupKey}", group,
+                        request="Group", response="Group",
+                    ),
+                    "delete": _method(
+                        "groups.delete", "DELETE", "groups/{groupKey}", group
+                    ),
+                },
+                "resources": {
+                    "aliases": {
+                        "methods": {
+                            "list": _method(
+                                "groups.aliases.list", "GET",
+                                "groups/{groupKey}/aliases", group,
+                                response="Aliases",
+                            ),
+                            "insert": _method(
+                                "groups.aliases.insert", "POST",
+                                "groups/{groupKey}/aliases", group,
+                                request="Alias", response="Alias",
+                            ),
+                            "delete": _method(
+                                "groups.aliases.delete", "DELETE",
+                                "groups/{groupKey}/aliases/{alias}",
+                                group + ["alias"],
+                            ),
+                        }
+                    }
+                },
+            },
+            "members": {
+                "methods": {
+                    "list": _method(
+                        "members.list", "GET", "groups/{groupKey}/members", group,
+                        ["roles"] + paging, None, "Members",
+                    ),
+                    "insert": _method(
+                        "members.insert", "POST", "groups/{groupKey}/members", group,
+                        request="Member", response="Member",
+                    ),
+                    "delete": _method(
+                        "members.delete", "DELETE",
+                        "groups/{groupKey}/members/{memberKey}", group + ["memberKey"],
+                    ),
+                }
+            },
+            "users": {
+                "methods": {
+                    "list": _method(
+                        "users.list", "GET", "users", [],
+                        ["domain", "customer", "projection", "viewType", "query"]
+                        + paging,
+                        None, "Users",
+                    ),
+                    "get": _method(
+                        "users.get", "GET", "users/{userKey}", ["userKey"],
+                        response="User",
+                    ),
+                    "insert": _method(
+                        "users.insert", "POST", "users", request="User",
+                        response="User",
+                    ),
+                    "update": _method(
+                        "users.update", "PUT", "users/{userKey}", ["userKey"],
+                        request="User", response="User",
+                    ),
+                    "patch": _method(
+                        "users.patch", "PATCH", "users/{userKey}", ["userKey"],
+                        request="User", response="User",
+                    ),
+                }
+            },
+        },
+    }
+
+
+def parse_fields(fields: str) -> Dict[str, Any]:
+    """Parse a field mask like "nextPageToken,users(name(givenName))"."""
+    tree: Dict[str, Any] = {}
+    stack = [tree]
+    name = ""
+    for char in fields + ",":
+        if char == "(":
+            stack.append(stack[-1].setdefault(name.strip(), {}))
+            name = ""
+        elif char in ",)":
+            if name.strip():
+                stack[-1].setdefault(name.strip(), {})
+            name = ""
+            if char == ")":
+                stack.pop()
+        else:
+            name += char
+    return tree
+
+
+def select_fields(data: Any, tree: Dict[str, Any]) -> Any:
+    """Keep only the fields of a partial response."""
+    if not tree:
+        return data
+    if isinstance(data, list):
+        return [select_fields(item, tree) for item in data]
+    if isinstance(data, dict):
+        return {
+            key: select_fields(value, tree[key])
+            for (key, value) in data.items()
+            if key in tree
+        }
+    return data
+
+
+def error(status: int, reason: str, message: str) -> Response:
+    """Return an API error response."""
+    return (
+        status,
+        {"error": {"code": status, "message": message,
+                   "errors": [{"reason": reason, "message": message}]}},
+    )
+
+
+class FakeDirectory(object):
+    """Serve an in-memory Google directory over HTTP.
+
+    Every HTTP request sleeps latency seconds, and every API call
+    (including each part of a batch) fails with a quota error with
+    probability quota_errors.
+    """
+
+    def __init__(
+        self, latency: float = 0.0, quota_errors: float = 0.0, seed: int = 1
+    ) -> None:
+        """Initialize."""
+        self.latency = latency
+        self.quota_errors = quota_errors
+        self.random = random.Random(seed)
+        self.groups: Dict[str, Dict[str, Any]] = {}
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.RLock()
+        self.counters: Dict[str, int] = {}
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.root_url = "http://127.0.0.1:%d/" % self.server.server_port
+        self.discovery_url = self.root_url + "discovery/{api}/{apiVersion}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "FakeDirectory":
+        """Start serving."""
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_group(
+        self,
+        email: str,
+        name: str,
+        description: str = "",
+        aliases: List[str] = [],
+        members: List[str] = [],
+    ) -> None:
+        """Add a group to the directory."""
+        self.groups[email] = {
+            "email": email,
+            "name": name,
+            "description": description,
+            "aliases": list(aliases),
+            "members": list(members),
+        }
+
+    def add_user(self, email: str, first_name: str, last_name: str, **extra: Any) -> None:
+        """Add a user to the directory."""
+        user = {
+            "kind": "admin#directory#user",
+            "id": email,
+            "primaryEmail": email,
+            "name": {
+                "givenName": first_name,
+                "familyName": last_name,
+                "fullName": "%s %s" % (first_name, last_name),
+            },
+            "isAdmin": False,
+            "suspended": False,
+            "orgUnitPath": "/",
+            "isMailboxSetup": True,
+            "creationTime": "2020-01-01T00:00:00.000Z",
+        }
+        user.update(extra)
+        self.users[email] = user
+
+    def _count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _page(
+        self, kind: str, items: List[Dict[str, Any]], query: Dict[str, str]
+    ) -> Dict[str, Any]:
+        size = min(
+            int(query.get("maxResults") or DEFAULT_PAGE_SIZE[kind]), MAX_PAGE_SIZE[kind]
+        )
+        start = int(query.get("pageToken") or 0)
+        result: Dict[str, Any] = {kind: items[start : start + size]}
+        if start + size < len(items):
+            result["nextPageToken"] = str(start + size)
+        return result
+
+    def handle(
+        self, method: str, path: str, query: Dict[str, str], body: Any
+    ) -> Response:
+        """Handle one API request."""
+        self._count(
+            "%s %s" % (method, re.sub(r"(groups|aliases|members|users)/[^/]+", r"\1/*", path))
+        )
+        with self.lock:
+            if self.quota_errors and self.random.random() < self.quota_errors:
+                self._count("quota errors")
+                return error(403, "rateLimitExceeded", "Rate Limit Exceeded")
+            parts = [unquote(part) for part in path.split("/") if part]
+            try:
+                (status, result) = self._route(method, parts, query, body)
+            except KeyError:
+                return error(404, "notFound", "Resource Not Found")
+            if query.get("fields") and result is not None:
+                result = select_fields(result, parse_fields(query["fields"]))
+            return (status, result)
+
+    def _group(self, group: Dict[str, Any]) -> Dict[str, Any]:
+        result = {"kind": "admin#directory#group", "id": group["email"]}
+        result.update({key: group[key] for key in ["email", "name", "description"]})
+        result["adminCreated"] = True
+        result["directMembersCount"] = str(len(group["members"]))
+        if group["aliases"]:
+            result["aliases"] = list(group["aliases"])
+        return result
+
+    def _find_group(self, group_key: str) -> Dict[str, Any]:
+        if group_key in self.groups:
+            return self.groups[group_key]
+        for group in self.groups.values():
+            if group_key in group["aliases"]:
+                return group
+        raise KeyError(group_key)
+
+    def _route(
+        self, method: str, parts: List[str], query: Dict[str, str], body: Any
+    ) -> Response:
+        if parts[0] == "users":
+            if len(parts) == 1 and method == "GET":
+                return (200, self._page("users", list(self.users.values()), query))
+            if len(parts) == 1 and method == "POST":
+                if body["primaryEmail"] in self.users:
+                    return error(409, "duplicate", "Entity already exists.")
+                self.users[body["primaryEmail"]] = body
+                return (200, body)
+            user = self.users[parts[1]]
+            if method in ["PUT", "PATCH"]:
+                user.update(body)
+            return (200, user)
+        if len(parts) == 1:
+            if method == "GET":
+                groups = [self._group(group) for group in self.groups.values()]
+                return (200, self._page("groups", groups, query))
+            if body["email"] in self.groups:
+                return error(409, "duplicate", "Entity already exists.")
+            self.add_group(body["email"], body.get("name"), body.get("description"))
+            return (200, self._group(self.groups[body["email"]]))
+        group = self._find_group(parts[1])
+        if len(parts) == 2:
+            if method == "DELETE":
+                del self.groups[group["email"]]
+                return (204, None)
+            if method in ["PUT", "PATCH"]:
+                group.update(
+                    {key: body[key] for key in ["name", "description"] if key in body}
+                )
+            return (200, self._group(group))
+        if parts[2] == "aliases":
+            if method == "GET":
+                return (200, {"aliases": [{"alias": alias} for alias in group["aliases"]]})
+            if method == "POST":
+                if body["alias"] in self.groups or any(
+                    body["alias"] in other["aliases"] for other in self.groups.values()
+                ):
+                    return error(409, "duplicate", "Entity already exists.")
+                group["aliases"].append(body["alias"])
+                return (200, body)
+            group["aliases"].remove(parts[3])
+            return (204, None)
+        if method == "GET":
+            members = [
+                {
+                    "kind": "admin#directory#member",
+                    "id": member,
+                    "email": member,
+                    "role": "MEMBER",
+                    "type": "USER",
+                    "status": "ACTIVE",
+                }
+                for member in group["members"]
+            ]
+            return (200, self._page("members", members, query))
+        if method == "POST":
+            if body["email"] in group["members"]:
+                return error(409, "duplicate", "Member already exists.")
+            group["members"].append(body["email"])
+            return (200, body)
+        group["members"].remove(parts[3])
+        return (204, None)
+
+    def handle_batch(self, content_type: str, payload: bytes) -> Tuple[str, bytes]:
+        """Handle a multipart/mixed batch request."""
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("ascii") + b"\r\n\r\n" + payload
+        )
+        boundary = "batch_fake_boundary"
+        parts = []
+        for part in message.iter_parts():
+            request = part.get_payload(decode=True).decode("utf-8")
+            (head, _, body) = request.replace("\r\n", "\n").partition("\n\n")
+            (method, target, _) = head.split("\n", 1)[0].split(" ", 2)
+            url = urlparse(target)
+            query = {key: values[0] for (key, values) in parse_qs(url.query).items()}
+            path = url.path.split(SERVICE_PATH.rstrip("/"), 1)[-1]
+            (status, data) = self.handle(
+                method, path, query, json.loads(body) if body.strip() else None
+            )
+            content = json.dumps(data) if data is not None else ""
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                "--%s\r\nContent-Type: application/http\r\n"
+                "Content-ID: <response-%s>\r\n\r\n"
+                "HTTP/1.1 %d X\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n%s\r\n"
+                % (boundary, content_id, status, len(content.encode("utf-8")), content)
+            )
+        body = "".join(parts) + "--%s--\r\n" % boundary
+        return ("multipart/mixed; boundary=%s" % boundary, body.encode("utf-8"))
+
+    def _handler(self) -> Any:
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status: int, content_type: str, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with fake.lock:
+                    fake.counters["bytes"] = fake.counters.get("bytes", 0) + len(body)
+
+            def _dispatch(self) -> None:
+                time.sleep(fake.latency)
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = self.rfile.read(length) if length else b""
+                if url.path.startswith("/discovery/"):
+                    document = discovery_document(fake.root_url)
+                    self._reply(200, "application/json", json.dumps(document).encode())
+                    return
+                if url.path == "/" + BATCH_PATH:
+                    fake._count("batch")
+                    (content_type, body) = fake.handle_batch(
+                        self.headers["Content-Type"], payload
+                    )
+                    self._reply(200, content_type, body)
+                    return
+                query = {
+                    key: values[0] for (key, values) in parse_qs(url.query).items()
+                }
+                path = url.path.split(SERVICE_PATH.rstrip("/"), 1)[-1]
+                (status, data) = fake.handle(
+                    self.command, path, query, json.loads(payload) if payload else None
+                )
+                body = json.dumps(data).encode("utf-8") if data is not None else b""
+                self._reply(status, "application/json", body)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        return Handler
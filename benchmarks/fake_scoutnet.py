@@ -0,0 +1,112 @@
+"""Local stand-in for the Scoutnet group API."""
+import json
+import threading
+import time
+import http.server
+from typing import Any, Dict
+from urllib.parse import urlparse, parse_qs
+from .generate import Dataset
+
+
+def value(data: Any) -> Dict[str, Any]:
+    """Wrap a value the way Scoutnet does."""
+    return {"value": data}
+
+
+class FakeScoutnet(object):
+    """Serve customlists and memberlist JSON for a dataset."""
+
+    def __init__(self, dataset: Dataset, latency: float = 0.0) -> None:
+        """Initialize."""
+        self.dataset = dataset
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.endpoint = "http://127.0.0.1:%d/api" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "FakeScoutnet":
+        """Start serving."""
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def customlists(self) -> Dict[str, Any]:
+        """Return the customlists response."""
+        return {
+            mlist["id"]: {
+                "title": mlist["title"],
+                "description": mlist["description"],
+                "list_email_key": mlist["id"],
+                "aliases": {
+                    str(number): alias for (number, alias) in enumerate(mlist["aliases"])
+                },
+                "link": "%s/group/customlists?list_id=%s" % (self.endpoint, mlist["id"]),
+            }
+            for mlist in self.dataset.lists
+        }
+
+    def customlist(self, list_id: str) -> Dict[str, Any]:
+        """Return the members of a list."""
+        data = {}
+        for mlist in self.dataset.lists:
+            if mlist["id"] != list_id:
+                continue
+            for number in mlist["members"]:
+                member = self.dataset.members[number]
+                entry = {
+                    "first_name": value(member["first_name"]),
+                    "last_name": value(member["last_name"]),
+                    "email": value(member["email"]),
+                }
+                if member["contact_alt_email"]:
+                    entry["extra_emails"] = value([member["contact_alt_email"]])
+                data[member["member_no"]] = entry
+        return {"data": data}
+
+    def memberlist(self) -> Dict[str, Any]:
+        """Return the detailed memberlist."""
+        return {
+            "data": {
+                member["member_no"]: {
+                    key: value(data) for (key, data) in member.items() if data
+                }
+                for member in self.dataset.members
+            }
+        }
+
+    def _handler(self) -> Any:
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                time.sleep(fake.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/api/group/customlists" and "list_id" in query:
+                    data = fake.customlist(query["list_id"][0])
+                elif url.path == "/api/group/customlists":
+                    data = fake.customlists()
+                elif url.path == "/api/group/memberlist":
+                    data = fake.memberlist()
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(data).encode("utf-8")
+                fake.requests += 1
+                fake.bytes_sent += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        return Handler
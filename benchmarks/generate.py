@@ -0,0 +1,73 @@
+"""Generate synthetic Scoutnet members and mailing lists."""
+import random
+import datetime
+from typing import Any, Dict, List
+from dataclasses import dataclass, field
+
+FIRST_NAMES = [
+    "Alva", "Astrid", "Elsa", "Ebba", "Freja", "Ines", "Klara", "Maja",
+    "Saga", "Wilma", "Åsa", "Agnes", "Alfred", "Axel", "Elias", "Erik",
+    "Hugo", "Karl", "Liam", "Lucas", "Nils", "Oskar", "Otto", "Olle",
+]
+LAST_NAMES = [
+    "Andersson", "Berg", "Björk", "Dahl", "Ek", "Eriksson", "Holm", "Johansson",
+    "Karlsson", "Lind", "Lundqvist", "Nilsson", "Nyström", "Öberg", "Persson",
+    "Sandberg", "Sjöberg", "Strand", "Wallin", "Åberg",
+]
+UNITS = [
+    "Spårare", "Upptäckare", "Äventyrare", "Utmanare", "Rover", "Ledare",
+    "Övriga kårmedlemmar",
+]
+ROLES = ["", "", "", "Ledare", "Assistent", "Kassör", "Ordförande"]
+
+
+@dataclass
+class Dataset:
+    """Hold a generated set of members and mailing lists."""
+
+    domain: str
+    members: List[Dict[str, Any]] = field(default_factory=list)
+    lists: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def generate(
+    members: int, lists: int, domain: str = "example.com", seed: int = 1
+) -> Dataset:
+    """Generate members and mailing lists drawing from them."""
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    dataset = Dataset(domain=domain)
+    for number in range(members):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = "%s%s" % (rng.choice(LAST_NAMES), "" if number < 400 else number)
+        age = rng.randint(7, 70)
+        dataset.members.append(
+            {
+                "member_no": str(3000000 + number),
+                "first_name": first_name,
+                "last_name": last_name,
+                "email": "%s.%s.%d@%s"
+                % (first_name.lower(), last_name.lower(), number, "example.net"),
+                "contact_alt_email": rng.choice(
+                    [None, "alt.%d@googlemail.com" % number]
+                ),
+                "unit": rng.choice(UNITS),
+                "contact_mobile_phone": "07%08d" % number,
+                "date_of_birth": (
+                    today - datetime.timedelta(days=age * 365 + rng.randint(0, 364))
+                ).isoformat(),
+                "group_role": rng.choice(ROLES),
+            }
+        )
+    for number in range(lists):
+        size = min(members, max(1, int(rng.paretovariate(1.2) * 10)))
+        dataset.lists.append(
+            {
+                "id": str(100 + number),
+                "title": "Lista %d" % number,
+                "description": "Genererad lista %d" % number,
+                "aliases": ["lista%d@%s" % (number, domain)],
+                "members": rng.sample(range(members), size),
+            }
+        )
+    return dataset
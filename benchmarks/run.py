@@ -0,0 +1,235 @@
+"""Run timed scenarios against local stand-ins and report JSON results."""
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+import httplib2
+import googleapiclient.discovery
+from scoutnet2google.scoutnet import ScoutnetMailinglistApi, ScoutnetUsersApi
+from scoutnet2google.sync_mailinglists import GoogleDirectory, mailinglist2groups
+from scoutnet2google.executor import RequestExecutor
+from scoutnet2google.google_service import REQUEST_FIELDS
+from scoutnet2google.check_users import GoogleUsersDirectory
+from scoutnet2google.matching import UserMatcher
+from scoutnet2google.metrics import METRICS
+from .generate import Dataset, generate
+from .fake_scoutnet import FakeScoutnet
+from .fake_google import FakeDirectory, discovery_document
+
+SCENARIOS = ["get_all_lists", "sync_groups", "check_users"]
+
+
+def version() -> str:
+    """Return the version of the code being measured."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def fake_service(fake: FakeDirectory) -> Any:
+    """Build a directory service talking to a fake directory."""
+    return googleapiclient.discovery.build_from_document(
+        discovery_document(fake.root_url), http=httplib2.Http()
+    )
+
+
+def bench_get_all_lists(dataset: Dataset, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time fetching all mailing lists from Scoutnet."""
+    with FakeScoutnet(dataset, latency=args.scoutnet_latency) as fake:
+        scoutnet = ScoutnetMailinglistApi(
+            fake.endpoint, "1", "key", dataset.domain, workers=args.fetch_workers
+        )
+        start = time.perf_counter()
+        all_lists = scoutnet.get_all_lists()
+        seconds = time.perf_counter() - start
+    return {
+        "scenario": "get_all_lists",
+        "seconds": seconds,
+        "lists": len(all_lists),
+        "requests": fake.requests,
+        "bytes": fake.bytes_sent,
+    }
+
+
+def populate(fake: FakeDirectory, groups: List[Any]) -> None:
+    """Give the fake directory a partly outdated copy of the groups."""
+    for (number, group) in enumerate(groups):
+        if number % 3 == 2:
+            continue
+        members = sorted(group.members)
+        fake.add_group(
+            group.address,
+            group.title if number % 3 == 0 else "Old title",
+            group.description,
+            group.aliases,
+            members[: len(members) * 9 // 10] + ["stale%d@example.net" % number],
+        )
+    for number in range(5):
+        fake.add_group("removed%d@example.com" % number, "Removed (Scoutnet)")
+
+
+def bench_sync_groups(dataset: Dataset, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time synchronizing groups with a fake Google directory."""
+    with FakeScoutnet(dataset) as scoutnet_fake:
+        scoutnet = ScoutnetMailinglistApi(
+            scoutnet_fake.endpoint, "1", "key", dataset.domain, workers=4
+        )
+        all_lists = scoutnet.get_all_lists()
+    groups = [group for mlist in all_lists for group in mailinglist2groups(mlist)]
+    with FakeDirectory(args.google_latency, args.quota_errors) as fake:
+        populate(fake, groups)
+        executor = RequestExecutor(rate=args.rate, base_delay=args.base_delay)
+        directory = GoogleDirectory(
+            fake_service(fake),
+            dataset.domain,
+            workers=args.sync_workers,
+            service_factory=lambda: fake_service(fake),
+            executor=executor,
+        )
+        start = time.perf_counter()
+        results = directory.sync_groups(groups)
+        seconds = time.perf_counter() - start
+    return {
+        "scenario": "sync_groups",
+        "seconds": seconds,
+        "groups": len(results),
+        "member_changes": sum(result.members_changed for result in results),
+        "member_failures": sum(result.members_failed for result in results),
+        "group_failures": len([result for result in results if result.error]),
+        "executor": dict(executor.counters),
+        "api_calls": dict(fake.counters),
+    }
+
+
+def bench_check_users(dataset: Dataset, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time fetching Scoutnet and Google users and matching them."""
+    with FakeScoutnet(dataset, latency=args.scoutnet_latency) as fake:
+        scoutnet = ScoutnetUsersApi(fake.endpoint, "1", "key")
+        start = time.perf_counter()
+        users = scoutnet.all_users
+        fetch_seconds = time.perf_counter() - start
+    adults = scoutnet.select(min_age=18)
+    with FakeDirectory(args.google_latency, args.quota_errors) as google_fake:
+        for (number, user) in enumerate(adults):
+            if number % 10 != 0:
+                google_fake.add_user(
+                    "%s@%s" % (user.member_no, dataset.domain),
+                    user.first_name,
+                    user.last_name,
+                )
+        for number in range(len(adults) // 20):
+            google_fake.add_user(
+                "extra%d@%s" % (number, dataset.domain), "Extra", "User%d" % number
+            )
+        executor = RequestExecutor(rate=args.rate, base_delay=args.base_delay)
+        directory = GoogleUsersDirectory(
+            fake_service(google_fake), dataset.domain, executor=executor, fetch=False
+        )
+        start = time.perf_counter()
+        google_users = directory.get_all_users()
+        google_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    result = UserMatcher(google_users).match(adults)
+    match_seconds = time.perf_counter() - start
+    return {
+        "scenario": "check_users",
+        "seconds": fetch_seconds + google_seconds + match_seconds,
+        "fetch_seconds": fetch_seconds,
+        "google_seconds": google_seconds,
+        "match_seconds": match_seconds,
+        "scoutnet_users": len(users),
+        "google_users": len(google_users),
+        "scoutnet_missing": len(result.scoutnet_missing),
+        "google_missing": len(result.google_missing),
+        "api_calls": dict(google_fake.counters),
+    }
+
+
+BENCHMARKS = {
+    "get_all_lists": bench_get_all_lists,
+    "sync_groups": bench_sync_groups,
+    "check_users": bench_check_users,
+}
+
+
+def run(scenario: str, dataset: Dataset, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run a scenario, adding the timings recorded during it."""
+    METRICS.reset()
+    result = BENCHMARKS[scenario](dataset, args)
+    recorded = METRICS.as_dict()
+    result["timings"] = recorded["timings"]
+    result["slowest"] = recorded["slowest"]
+    return result
+
+
+def main() -> None:
+    """main."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark scoutnet2google against local stand-ins."
+    )
+    parser.add_argument("--members", type=int, default=1000, help="Members (100-50000)")
+    parser.add_argument("--lists", type=int, default=50, help="Lists (10-1000)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        choices=SCENARIOS,
+        help="Scenario to run (default all, may be repeated)",
+    )
+    parser.add_argument("--fetch-workers", type=int, default=4)
+    parser.add_argument("--sync-workers", type=int, default=4)
+    parser.add_argument(
+        "--scoutnet-latency", type=float, default=0.02, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--google-latency", type=float, default=0.02, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--quota-errors", type=float, default=0.0, help="Share of calls failing"
+    )
+    parser.add_argument("--rate", type=float, default=0, help="Requests/s, 0 = off")
+    parser.add_argument("--base-delay", type=float, default=0.05, help="Backoff base")
+    parser.add_argument(
+        "--no-partial-responses",
+        dest="partial_responses",
+        action="store_false",
+        help="Fetch full resources from Google",
+    )
+    parser.add_argument("--output", metavar="filename", help="Write results to file")
+    parser.add_argument("--debug", action="store_true", help="Enable debugging output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+    REQUEST_FIELDS.partial = args.partial_responses
+
+    dataset = generate(args.members, args.lists, seed=args.seed)
+    report = {
+        "version": version(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": [
+            run(scenario, dataset, args) for scenario in (args.scenarios or SCENARIOS)
+        ],
+    }
+    if args.output:
+        with open(args.output, "wt") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
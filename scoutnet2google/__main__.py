@@ -0,0 +1,4 @@
+"""Allow running as python -m scoutnet2google."""
+from scoutnet2google.cli import main
+
+main()
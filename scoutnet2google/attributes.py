@@ -0,0 +1,128 @@
+"""Field level comparison of Scoutnet and Google user attributes."""
+import hashlib
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from dataclasses import dataclass, field
+from scoutnet2google.matching import normalize_email, normalize_mobile
+from scoutnet2google.provisioning import org_unit_path
+
+ATTRIBUTE_FIELDS = ["mobile", "email", "org_unit"]
+DEFAULT_ATTRIBUTE_FIELDS = ["mobile", "email"]
+
+
+@dataclass(frozen=True)
+class UserPatch:
+    """Hold the changed attributes of one Google user."""
+
+    email: str
+    first_name: str = None
+    last_name: str = None
+    fields: Dict[str, str] = field(default_factory=dict)
+    body: Dict[str, Any] = field(default_factory=dict)
+
+
+def parse_attribute_fields(value: str) -> List[str]:
+    """Parse a comma separated list of attribute fields."""
+    fields = [name for name in re.split(r"[,\s]+", value) if name]
+    for name in fields:
+        if name not in ATTRIBUTE_FIELDS:
+            raise ValueError("Unknown attribute field: %s" % name)
+    return fields
+
+
+def comparable(name: str, value: Optional[str]) -> Optional[str]:
+    """Return the form of a field value that is compared."""
+    if name == "mobile":
+        return normalize_mobile(value)
+    if name == "email":
+        return normalize_email(value)
+    return value or None
+
+
+def field_hash(name: str, value: Optional[str]) -> str:
+    """Return a stable hash of the comparable form of a field value."""
+    text = "%s=%s" % (name, comparable(name, value) or "")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def scoutnet_values(
+    user: Any, fields: Iterable[str], org_unit_root: str = "/"
+) -> Dict[str, Optional[str]]:
+    """Return the wanted field values of a Scoutnet user."""
+    values = {
+        "mobile": user.mobile,
+        # The member's own address is the account's recovery address
+        "email": user.email_primary,
+        "org_unit": org_unit_path(org_unit_root, user.unit),
+    }
+    return {name: values[name] for name in fields}
+
+
+def google_values(user: Any, fields: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Return the current field values of a Google user."""
+    values = {
+        "mobile": user.mobile,
+        "email": user.email_alternate,
+        "org_unit": user.unit,
+    }
+    return {name: values[name] for name in fields}
+
+
+def patch_body(google_user: Any, changed: Dict[str, str]) -> Dict[str, Any]:
+    """Return the users().patch body setting changed fields."""
+    body: Dict[str, Any] = {}
+    if "mobile" in changed:
+        # The phones list is replaced as a whole, keep the other numbers
+        phones = [
+            dict(phone)
+            for phone in google_user.phones
+            if dict(phone).get("type") != "mobile"
+        ]
+        body["phones"] = phones + [{"type": "mobile", "value": changed["mobile"]}]
+    if "email" in changed:
+        body["recoveryEmail"] = changed["email"]
+    if "org_unit" in changed:
+        body["orgUnitPath"] = changed["org_unit"]
+    return body
+
+
+def plan_attribute_changes(
+    matches: Iterable[Tuple[Any, Any]],
+    fields: List[str] = DEFAULT_ATTRIBUTE_FIELDS,
+    org_unit_root: str = "/",
+) -> List[UserPatch]:
+    """Compare matched users field by field, return patches of changed users.
+
+    Fields without a value in Scoutnet are left as they are in Google.
+    Users with no changed fields get no patch at all, and administrators
+    and suspended users are never changed.
+    """
+    patches: List[UserPatch] = []
+    seen = set()
+    for (scoutnet_user, google_user) in matches:
+        if (
+            google_user.email_primary in seen
+            or google_user.suspended
+            or google_user.admin
+        ):
+            continue
+        seen.add(google_user.email_primary)
+        wanted = scoutnet_values(scoutnet_user, fields, org_unit_root)
+        current = google_values(google_user, fields)
+        changed = {
+            name: value.strip()
+            for (name, value) in wanted.items()
+            if comparable(name, value) is not None
+            and field_hash(name, value) != field_hash(name, current[name])
+        }
+        if changed:
+            patches.append(
+                UserPatch(
+                    google_user.email_primary,
+                    google_user.first_name,
+                    google_user.last_name,
+                    fields=changed,
+                    body=patch_body(google_user, changed),
+                )
+            )
+    return patches
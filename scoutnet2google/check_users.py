@@ -1,19 +1,49 @@
 """Check that only Scoutnet users exist in Google."""
-from typing import List, Any
+from typing import List, Any, Callable, Iterable, Optional, Tuple
 import argparse
 import logging
 import os
+import secrets
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-import googleapiclient.discovery
-import google.auth.compute_engine
 
-from scoutnet2google.google_auth_installed import google_auth_installed
-from scoutnet2google.scoutnet import ScoutnetUsersApi
+from scoutnet2google.google_service import build_service, clone_service
+from scoutnet2google.google_service import REQUEST_FIELDS
+from scoutnet2google.lazy import lazy_import
+from scoutnet2google.executor import RequestExecutor, is_conflict
+from scoutnet2google.export import Exporter, FORMATS, USER_COLUMNS, check_export
+from scoutnet2google.export import user_record
+from scoutnet2google.metrics import METRICS
+from scoutnet2google.attributes import (
+    UserPatch,
+    parse_attribute_fields,
+    plan_attribute_changes,
+)
+from scoutnet2google.provisioning import (
+    ACTIONS,
+    UserChange,
+    parse_exclude,
+    plan_user_changes,
+    read_user_plan,
+    suspend_limit,
+    write_user_plan,
+)
+from scoutnet2google.scoutnet import SLOTS
 from scoutnet2google import manage_config
+from scoutnet2google.matching import (
+    UserMatcher,
+    MatchResult,
+    DEFAULT_MATCH_KEYS,
+    parse_match_keys,
+)
 
 SCOPES = [
     "https://www.googleapis.com/auth/admin.directory.user",
     "https://www.googleapis.com/auth/admin.directory.user.readonly",
+    # Group addresses are taken too when choosing new account addresses
+    "https://www.googleapis.com/auth/admin.directory.group.readonly",
 ]
 API_SERVICE_NAME = "admin"
 API_VERSION = "directory_v1"
@@ -24,9 +54,10 @@ CLIENT_SECRETS_FILE = os.path.join(
 CLIENT_TOKEN_FILE = os.path.join(
     manage_config.DIRS.user_config_dir, "client_token_%s.json" % "check_users"
 )
+USER_BATCH_SIZE = 50  # Account changes or patches per batch request
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTS)
 class GoogleUser:
     """Hold information about a Google user."""
 
@@ -38,54 +69,69 @@ class GoogleUser:
     email_dad: str = None
     unit: str = None
     mobile: str = None
+    admin: bool = False
+    suspended: bool = False
+    phones: Tuple[Tuple[Tuple[str, Any], ...], ...] = ()
+    aliases: Tuple[str, ...] = ()
 
 
 class GoogleUsersDirectory(object):
     """Access Google users directory."""
 
-    def __init__(self, service: Any, domain: str, readonly: bool = False) -> None:
+    def __init__(
+        self,
+        service: Any,
+        domain: str,
+        readonly: bool = False,
+        executor: Optional[RequestExecutor] = None,
+        workers: int = 1,
+        service_factory: Optional[Callable[[], Any]] = None,
+        fetch: bool = True,
+    ) -> None:
         """Initialize."""
-        self.service = service
+        self._service = service
+        self.service_factory = service_factory
+        self._local = threading.local()
+        self.workers = max(1, workers) if service_factory is not None else 1
+        self.executor = executor or RequestExecutor()
         self.domain = domain
         self.readonly = readonly
         self.logger = logging.getLogger("GoogleDirectory")
         if self.readonly:
             self.logger = self.logger.getChild("READONLY")
-        self.all_users = self.get_all_users()
+        self.all_users = self.get_all_users() if fetch else []
 
-    def _compare_user(self, sn_user, g_user):
-        """Check if a Scoutnet user and a Google user are the same."""
-        return (
-            g_user.first_name == sn_user.first_name
-            and g_user.last_name == sn_user.last_name
-        )
+    @property
+    def service(self) -> Any:
+        """Return the service object of the calling thread."""
+        if self.service_factory is None:
+            return self._service
+        if threading.current_thread() is threading.main_thread():
+            return self._service
+        service = getattr(self._local, "service", None)
+        if service is None:
+            # httplib2 is not thread safe, give each worker its own service
+            service = self.service_factory()
+            self._local.service = service
+        return service
+
+    def match_users(
+        self, scoutnet_users, keys: List[str] = DEFAULT_MATCH_KEYS
+    ) -> MatchResult:
+        """Match Scoutnet users with Google users in one pass."""
+        return UserMatcher(self.all_users, keys).match(scoutnet_users)
 
     def scoutnet_missing_in_google(self, scoutnet_users) -> [GoogleUser]:
         """Look for Scoutnet users missing in Google."""
-        result = set()
-        for sn_user in scoutnet_users:
-            matches = [
-                g_user
-                for g_user in self.all_users
-                if self._compare_user(sn_user, g_user)
-            ]
-            if len(matches) == 0:
-                result.add(sn_user)
-        return list(result)
+        result = self.match_users(scoutnet_users)
+        return list(dict.fromkeys(result.scoutnet_missing))
 
     def google_missing_in_scoutnet(self, scoutnet_users) -> [GoogleUser]:
         """Look for Google users missing in Scoutnet."""
-        result = set()
-        for g_user in self.all_users:
-            matches = [
-                sn_user
-                for sn_user in scoutnet_users
-                if self._compare_user(sn_user, g_user)
-            ]
-            if len(matches) == 0:
-                logging.info("Failed to find match for %s", g_user)
-                result.add(g_user)
-        return list(result)
+        result = self.match_users(scoutnet_users)
+        for g_user in result.google_missing:
+            logging.info("Failed to find match for %s", g_user)
+        return list(dict.fromkeys(result.google_missing))
 
     def get_all_users(self) -> [GoogleUser]:
         """Get all users."""
@@ -100,16 +146,25 @@ class GoogleUsersDirectory(object):
             else:
                 return mobiles[0]
 
+        params = REQUEST_FIELDS.params("users.list")
         while True:
-            result = (
-                self.service.users().list(domain=self.domain, pageToken=token).execute()
+            result = self.executor.execute(
+                self.service.users().list(domain=self.domain, pageToken=token, **params)
             )
             for user in result.get("users", []):
                 new_user = GoogleUser(
                     first_name=user["name"]["givenName"],
                     last_name=user["name"]["familyName"],
                     email_primary=user["primaryEmail"],
+                    email_alternate=user.get("recoveryEmail"),
+                    unit=user.get("orgUnitPath"),
                     mobile=pick_mobile(user.get("phones", [])),
+                    admin=user.get("isAdmin", False),
+                    suspended=user.get("suspended", False),
+                    phones=tuple(
+                        tuple(sorted(phone.items())) for phone in user.get("phones", [])
+                    ),
+                    aliases=tuple(user.get("aliases", [])),
                 )
                 all_users.append(new_user)
             token = result.get("nextPageToken")
@@ -117,25 +172,324 @@ class GoogleUsersDirectory(object):
                 break
         return all_users
 
+    def get_group_addresses(self) -> List[str]:
+        """Get the addresses and aliases of all groups."""
+        addresses: List[str] = []
+        token = None
+        params = REQUEST_FIELDS.params("groups.list")
+        while True:
+            result = self.executor.execute(
+                self.service.groups().list(
+                    domain=self.domain, pageToken=token, **params
+                )
+            )
+            for group in result.get("groups", []):
+                addresses.append(group["email"])
+                addresses.extend(group.get("aliases", []))
+            token = result.get("nextPageToken")
+            if token is None:
+                break
+        return addresses
+
+    def taken_addresses(self) -> List[str]:
+        """Return the addresses of all users and groups, including aliases."""
+        addresses = [user.email_primary for user in self.all_users]
+        for user in self.all_users:
+            addresses.extend(user.aliases)
+        return addresses + self.get_group_addresses()
+
+    def created_before(self, change: UserChange) -> bool:
+        """Check if an existing account is the one a create change makes.
+
+        An insert retried after a server error may already have succeeded.
+        """
+        try:
+            user = self.executor.execute(
+                self.service.users().get(
+                    userKey=change.email, **REQUEST_FIELDS.params("users.get")
+                )
+            )
+        except Exception as exc:
+            self.logger.debug("Exception: %s", str(exc))
+            return False
+        if change.member_no:
+            return change.member_no in [
+                external.get("value") for external in user.get("externalIds", [])
+            ]
+        name = user.get("name", {})
+        return (name.get("givenName"), name.get("familyName")) == (
+            change.first_name,
+            change.last_name,
+        )
+
+    def _user_request(self, change: UserChange) -> Any:
+        """Build the API request for an account change."""
+        if change.action == "create":
+            body = {
+                "primaryEmail": change.email,
+                "name": {
+                    "givenName": change.first_name,
+                    "familyName": change.last_name,
+                },
+                # Never revealed, an administrator sets the first password
+                "password": secrets.token_urlsafe(24),
+                "changePasswordAtNextLogin": True,
+                "orgUnitPath": change.org_unit or "/",
+            }
+            if change.member_no:
+                body["externalIds"] = [
+                    {"type": "organization", "value": change.member_no}
+                ]
+            return self.service.users().insert(body=body)
+        return self.service.users().update(
+            userKey=change.email, body={"suspended": True}
+        )
+
+    def _execute_user_batch(
+        self, chunk: List[UserChange]
+    ) -> List[Optional[Exception]]:
+        """Apply account changes in one batch request, return errors."""
+        if self.readonly:
+            errors: List[Optional[Exception]] = [None] * len(chunk)
+        else:
+            responses = self.executor.execute_batch(
+                self.service.new_batch_http_request,
+                [self._user_request(change) for change in chunk],
+            )
+            errors = [
+                None
+                if change.action == "create"
+                and exc is not None
+                and is_conflict(exc)
+                and self.created_before(change)
+                else exc
+                for (change, (_, exc)) in zip(chunk, responses)
+            ]
+        for (change, exc) in zip(chunk, errors):
+            if exc is None and change.action == "create":
+                self.logger.info(
+                    "Created %s (%s %s) in %s",
+                    change.email,
+                    change.first_name,
+                    change.last_name,
+                    change.org_unit,
+                )
+            elif exc is None:
+                self.logger.info(
+                    "Suspended %s (%s %s)",
+                    change.email,
+                    change.first_name,
+                    change.last_name,
+                )
+            else:
+                self.logger.error(
+                    "Failed to %s %s: %s", change.action, change.email, str(exc)
+                )
+        return errors
+
+    def _execute_patch_batch(
+        self, chunk: List[UserPatch]
+    ) -> List[Optional[Exception]]:
+        """Apply attribute patches in one batch request, return errors."""
+        if self.readonly:
+            errors: List[Optional[Exception]] = [None] * len(chunk)
+        else:
+            responses = self.executor.execute_batch(
+                self.service.new_batch_http_request,
+                [
+                    self.service.users().patch(userKey=patch.email, body=patch.body)
+                    for patch in chunk
+                ],
+            )
+            errors = [exc for (_, exc) in responses]
+        for (patch, exc) in zip(chunk, errors):
+            if exc is None:
+                self.logger.info(
+                    "Updated %s (%s %s): %s",
+                    patch.email,
+                    patch.first_name,
+                    patch.last_name,
+                    ", ".join(
+                        "%s=%s" % item for item in sorted(patch.fields.items())
+                    ),
+                )
+            else:
+                self.logger.error("Failed to update %s: %s", patch.email, str(exc))
+        return errors
+
+    def _map_batches(
+        self, function: Callable[[List[Any]], List[Any]], items: List[Any]
+    ) -> List[Any]:
+        """Apply function to batches of items using the worker pool."""
+        chunks = [
+            items[start : start + USER_BATCH_SIZE]
+            for start in range(0, len(items), USER_BATCH_SIZE)
+        ]
+        if self.workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                outcome = list(executor.map(function, chunks))
+        else:
+            outcome = [function(chunk) for chunk in chunks]
+        return [result for chunk_outcome in outcome for result in chunk_outcome]
+
+    def apply_user_changes(
+        self, changes: List[UserChange]
+    ) -> List[Optional[Exception]]:
+        """Apply account changes in batches, return an error per change."""
+        return self._map_batches(self._execute_user_batch, changes)
+
+    def apply_user_patches(
+        self, patches: List[UserPatch]
+    ) -> List[Optional[Exception]]:
+        """Apply attribute patches in batches, return an error per patch."""
+        return self._map_batches(self._execute_patch_batch, patches)
+
 
 def print_sn_user(user, indent=2):
     """Print name of a user."""
     print("%s%-20.20s %-15.15s" % (" " * indent, user.last_name, user.first_name))
 
 
-def main() -> None:
+def apply_user_changes(
+    directory: GoogleUsersDirectory, changes: List[UserChange]
+) -> int:
+    """Apply account changes and print a summary, return number failed."""
+    with METRICS.timer("phase.provision"):
+        errors = directory.apply_user_changes(changes)
+    counts = {action: 0 for action in ACTIONS + ["failed"]}
+    for (change, exc) in zip(changes, errors):
+        counts[change.action if exc is None else "failed"] += 1
+    print(
+        "Account changes: %d created, %d suspended, %d failed"
+        % (counts["create"], counts["suspend"], counts["failed"])
+    )
+    return counts["failed"]
+
+
+def export_users(
+    filename: str,
+    fmt: Optional[str],
+    scoutnet_users: Iterable[Any],
+    google_users: Iterable[GoogleUser],
+    scoutnet_missing: Iterable[Any],
+    google_missing: Iterable[GoogleUser],
+) -> int:
+    """Write Scoutnet and Google users to file, return the number written."""
+    scoutnet_missing = set(scoutnet_missing)
+    google_missing = set(google_missing)
+    with Exporter(filename, fmt, USER_COLUMNS) as exporter:
+        for user in scoutnet_users:
+            exporter.write(
+                user_record(user, "scoutnet", user not in scoutnet_missing)
+            )
+        for user in google_users:
+            exporter.write(user_record(user, "google", user not in google_missing))
+    return exporter.count
+
+
+def too_many_suspensions(changes: List[UserChange], limit: int) -> bool:
+    """Log an error and return True if changes suspend more than limit accounts."""
+    suspensions = len([change for change in changes if change.action == "suspend"])
+    if suspensions <= limit:
+        return False
+    # A short Scoutnet memberlist must not suspend the whole domain
+    logging.error(
+        "%d accounts would be suspended, more than max_suspensions (%d), "
+        "nothing changed",
+        suspensions,
+        limit,
+    )
+    return True
+
+
+def report(executor: RequestExecutor, filename: Optional[str], failed: int) -> None:
+    """Log statistics, write metrics and exit with an error if changes failed."""
+    executor.log_stats()
+    METRICS.log_summary()
+    if filename:
+        METRICS.write(filename)
+    if failed > 0:
+        sys.exit(1)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
     """main."""
     parser = argparse.ArgumentParser(
         description="Check that only Scoutnet users exist in Google."
     )
 
+    parser.add_argument(
+        "--create",
+        dest="create",
+        action="store_true",
+        help="Create accounts for Scoutnet users missing in Google",
+    )
+    parser.add_argument(
+        "--suspend",
+        dest="suspend",
+        action="store_true",
+        help="Suspend Google users missing in Scoutnet",
+    )
+    parser.add_argument(
+        "--max-suspensions",
+        dest="max_suspensions",
+        metavar="N",
+        help="Suspend at most N (or N%%) accounts, overriding max_suspensions",
+    )
+    parser.add_argument(
+        "--sync-attributes",
+        dest="sync_attributes",
+        action="store_true",
+        help="Update changed attributes of matched Google users",
+    )
+    parser.add_argument(
+        "--plan-file",
+        dest="plan_file",
+        metavar="filename",
+        help="Write the account changes as JSON lines, without applying them",
+    )
+    parser.add_argument(
+        "--apply-plan",
+        dest="apply_plan",
+        metavar="filename",
+        help="Apply account changes from a plan file, without matching",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        metavar="filename",
+        help="Write all Scoutnet and Google users to file",
+    )
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=FORMATS,
+        help="Format of --output (default from its extension, else json)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Test mode (no changes written)",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        metavar="filename",
+        help="Write timings as JSON, or as Prometheus textfile if ending in .prom",
+    )
     parser.add_argument(
         "--verbose", dest="verbose", action="store_true", help="Enable verbose output"
     )
     parser.add_argument(
         "--debug", dest="debug", action="store_true", help="Enable debugging output"
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.output:
+        try:
+            check_export(args.output, args.output_format)
+        except ValueError as exc:
+            parser.error(str(exc))
 
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
@@ -148,6 +502,10 @@ def main() -> None:
         logging.getLogger("googleapiclient.discovery").setLevel(logging.DEBUG)
 
     config = manage_config.S2g_config()
+    # Raw, a percentage is not an interpolation
+    max_suspensions = args.max_suspensions or config.get(
+        "google", "max_suspensions", raw=True
+    )
 
     # Authenticate with Google
     assert config["google"]["auth"] in [
@@ -155,35 +513,71 @@ def main() -> None:
         "compute_engine",
     ], "Invalid authentication method"
     if config["google"]["auth"] == "installed":
-        credentials = google_auth_installed(
+        installed = lazy_import("scoutnet2google.google_auth_installed")
+        credentials = installed.google_auth_installed(
             CLIENT_SECRETS_FILE, CLIENT_TOKEN_FILE, SCOPES
         )
     else:
-        credentials = google.auth.compute_engine.Credentials()
-    service = googleapiclient.discovery.build(
-        API_SERVICE_NAME, API_VERSION, credentials=credentials, cache_discovery=False
+        credentials = lazy_import("google.auth.compute_engine").Credentials()
+    service = build_service(
+        API_SERVICE_NAME, API_VERSION, credentials, config["google"]
+    )
+
+    def service_factory() -> Any:
+        return clone_service(service, credentials)
+
+    executor = RequestExecutor(
+        rate=config.getfloat("google", "rate_limit"),
+        burst=config.getint("google", "rate_burst"),
+        max_retries=config.getint("google", "max_retries"),
     )
-    directory = GoogleUsersDirectory(service, config["google"]["domain"])
-    all_users = directory.get_all_users()
+    with METRICS.timer("phase.google_users"):
+        directory = GoogleUsersDirectory(
+            service,
+            config["google"]["domain"],
+            readonly=args.dry_run,
+            executor=executor,
+            workers=config.getint("google", "sync_workers"),
+            service_factory=service_factory,
+            fetch=args.apply_plan is None,
+        )
+    all_users = directory.all_users
+
+    if args.apply_plan:
+        with open(args.apply_plan, "rt") as file:
+            changes = list(read_user_plan(file))
+        # An edited or stale plan gets the same cap as a direct run
+        if any(change.action == "suspend" for change in changes):
+            with METRICS.timer("phase.google_users"):
+                total = len(directory.get_all_users())
+            limit = suspend_limit(max_suspensions, total)
+            if too_many_suspensions(changes, limit):
+                report(executor, args.metrics, 1)
+        report(executor, args.metrics, apply_user_changes(directory, changes))
+        return
 
     # Configure Scoutnet
+    from scoutnet2google.scoutnet import ScoutnetUsersApi, user_filter
+
     scoutnet = ScoutnetUsersApi(
         api_endpoint=config["scoutnet"]["api_endpoint"],
         api_id=config["scoutnet"]["api_id"],
         api_key=config["scoutnet"]["api_key_users"],
+        cache_max_age=config.scoutnet_cache_max_age(),
+        max_connections=config.getint("scoutnet", "max_connections"),
     )
-    all_active_adults = [
-        member
-        for member in scoutnet.all_adults
-        if member not in scoutnet.all_unit_members("Övriga kårmedlemmar")
-    ]
-
     youth_units = config.getlist("scoutnet", "youthgroup_with_accounts")
     logging.warning(
         'Adding members of "%s" as youth members.' % ('", "'.join(youth_units))
     )
-    tmp = sum([scoutnet.all_unit_members(unit) for unit in youth_units], [])
-    youths = scoutnet.subtract_list(tmp, all_active_adults)
+    is_adult = user_filter(min_age=18)
+    is_other = user_filter(units=["Övriga kårmedlemmar"])
+    with METRICS.timer("phase.scoutnet"):
+        # Filtered while parsing, other members are never kept in memory
+        (all_active_adults, youths) = scoutnet.partition(
+            lambda user: is_adult(user) and not is_other(user),
+            user_filter(units=youth_units),
+        )
     print(
         "Google: %d users, Scoutnet: %d users (%d adults, %d youths)"
         % (
@@ -194,22 +588,79 @@ def main() -> None:
         )
     )
 
+    with METRICS.timer("phase.match"):
+        result = directory.match_users(
+            all_active_adults | youths,
+            parse_match_keys(config["google"]["match_keys"]),
+        )
+    for (key, count) in sorted(result.count_by_key().items()):
+        logging.info("%d users matched by %s", count, key)
+
     # Check for Scoutnet users missing from Google.
-    scoutnet_missing_in_google = directory.scoutnet_missing_in_google(
-        all_active_adults + youths
-    )
+    scoutnet_missing_in_google = list(dict.fromkeys(result.scoutnet_missing))
     print("Scoutnet users missing in Google: %d" % len(scoutnet_missing_in_google))
     for user in scoutnet_missing_in_google:
         print_sn_user(user)
 
-    # Check for Scoutnet users missing from Google.
-    google_missing_in_scoutnet = directory.google_missing_in_scoutnet(
-        all_active_adults + youths
-    )
+    # Check for Google users missing from Scoutnet.
+    google_missing_in_scoutnet = list(dict.fromkeys(result.google_missing))
+    for user in google_missing_in_scoutnet:
+        logging.info("Failed to find match for %s", user)
     print("Google users missing in Scoutnet: %d" % len(google_missing_in_scoutnet))
     for user in google_missing_in_scoutnet:
         print_sn_user(user)
 
+    if args.output:
+        count = export_users(
+            args.output,
+            args.output_format,
+            all_active_adults | youths,
+            all_users,
+            scoutnet_missing_in_google,
+            google_missing_in_scoutnet,
+        )
+        print("Wrote %d users to %s" % (count, args.output))
+
+    actions = [action for action in ACTIONS if getattr(args, action)]
+    if args.plan_file and not actions:
+        actions = ACTIONS
+    changes = plan_user_changes(
+        scoutnet_missing_in_google,
+        google_missing_in_scoutnet,
+        config["google"]["domain"],
+        config["google"]["org_unit_root"],
+        actions,
+        taken=directory.taken_addresses() if "create" in actions else (),
+        exclude=parse_exclude(config["google"]["suspend_exclude"]),
+    )
+    limit = suspend_limit(max_suspensions, len(all_users))
+    if too_many_suspensions(changes, limit):
+        report(executor, args.metrics, 1)
+    if args.plan_file:
+        with open(args.plan_file, "wt") as file:
+            count = write_user_plan(changes, file)
+        print("Wrote %d account changes to %s" % (count, args.plan_file))
+    failed = 0
+    if (args.create or args.suspend) and not args.plan_file:
+        # A plan is only written, to be reviewed and applied with --apply-plan
+        failed = apply_user_changes(directory, changes)
+
+    if args.sync_attributes:
+        with METRICS.timer("phase.attributes"):
+            patches = plan_attribute_changes(
+                [(match.scoutnet_user, match.google_user) for match in result.matches],
+                parse_attribute_fields(config["google"]["attribute_fields"]),
+                config["google"]["org_unit_root"],
+            )
+            errors = directory.apply_user_patches(patches)
+        failed += len([exc for exc in errors if exc is not None])
+        print(
+            "Users with changed attributes: %d (%d failed)"
+            % (len(patches), len([exc for exc in errors if exc is not None]))
+        )
+
+    report(executor, args.metrics, failed)
+
     # Syncronize with Google Directory
     # if not args.skip_google:
     #     # noinspection PyUnboundLocalVariable
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Run the scoutnet2google commands from one entry point."""
+
+from typing import Dict, List, Optional, Tuple
+import argparse
+import importlib
+import logging
+import sys
+import time
+
+# Command name: (module, description). Modules are imported only when run.
+COMMANDS: Dict[str, Tuple[str, str]] = {
+    "sync-lists": (
+        "scoutnet2google.sync_mailinglists",
+        "Synchronize Scoutnet email lists with GSuite groups",
+    ),
+    "check-users": (
+        "scoutnet2google.check_users",
+        "Check, create and suspend GSuite users",
+    ),
+    "export": (
+        "scoutnet2google.export",
+        "Export Scoutnet email lists or users to file",
+    ),
+    "daemon": (
+        "scoutnet2google.daemon",
+        "Keep GSuite groups synchronized in a long-running process",
+    ),
+    "tenants": (
+        "scoutnet2google.tenants",
+        "Synchronize the email lists of many tenants",
+    ),
+}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """main."""
+    started = time.perf_counter()
+    parser = argparse.ArgumentParser(
+        prog="scoutnet2google",
+        description="Synchronize Scoutnet with GSuite.",
+        epilog="Run 'scoutnet2google <command> --help' for the options of a command.",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Enable debugging output, including import times",
+    )
+    parser.add_argument("command", choices=list(COMMANDS), help="Command to run")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    command_args = list(args.args)
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+        if "--debug" not in command_args:
+            command_args.append("--debug")
+
+    (module_name, _) = COMMANDS[args.command]
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    logging.debug(
+        "Imported %s in %.0f ms, %.0f ms after start",
+        module_name,
+        (time.perf_counter() - start) * 1000,
+        (time.perf_counter() - started) * 1000,
+    )
+    # Let the command's usage show the name it was run as
+    sys.argv[0] = "scoutnet2google %s" % args.command
+    module.main(command_args)
+
+
+if __name__ == "__main__":
+    main()
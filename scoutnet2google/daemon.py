@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""Keep Google groups synchronized with Scoutnet in a long-running process."""
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+import argparse
+import http.server
+import json
+import logging
+import random
+import signal
+import threading
+import time
+from scoutnet2google.manage_config import S2g_config
+from scoutnet2google.state import SyncState
+from scoutnet2google.metrics import METRICS
+from scoutnet2google.sync_mailinglists import (
+    GoogleDirectory,
+    GroupSyncResult,
+    configure_addresses,
+    google_directory,
+    mailinglist2groups,
+    scoutnet_api,
+)
+
+if TYPE_CHECKING:
+    from scoutnet2google.scoutnet import ScoutnetMailinglistApi
+
+METRICS_PREFIX = "scoutnet2google"
+
+
+def parse_listen(listen: str) -> Optional[Tuple[str, int]]:
+    """Parse a host:port listen address, None if empty."""
+    if not listen.strip():
+        return None
+    (host, _, port) = listen.strip().rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+class SyncDaemon(object):
+    """Periodically synchronize changed Scoutnet lists with Google."""
+
+    def __init__(
+        self,
+        scoutnet: "ScoutnetMailinglistApi",
+        directory: GoogleDirectory,
+        state: SyncState,
+        interval: float,
+        jitter: float = 0.0,
+        full_reconcile_days: float = 7.0,
+    ) -> None:
+        """Initialize."""
+        self.scoutnet = scoutnet
+        self.directory = directory
+        self.state = state
+        self.interval = interval
+        self.jitter = jitter
+        self.full_reconcile_days = full_reconcile_days
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.status: Dict[str, Any] = {
+            "cycles": 0,
+            "cycle_failures": 0,
+            "last_run": None,
+            "last_success": None,
+            "last_duration": None,
+            "last_error": None,
+            "groups_changed": 0,
+            "groups_synchronized": 0,
+            "groups_failed": 0,
+            "member_changes": 0,
+            "member_failures": 0,
+        }
+        self.logger = logging.getLogger("SyncDaemon")
+
+    def run_cycle(self) -> List[GroupSyncResult]:
+        """Fetch Scoutnet lists and synchronize groups that changed.
+
+        If some lists could not be fetched, the other groups are still
+        synchronized but no group is deleted.
+        """
+        all_groups = []
+        for mlist in self.scoutnet.get_all_lists():
+            all_groups.extend(mailinglist2groups(mlist))
+        complete = not self.scoutnet.failed
+        full_reconcile = self.state.reconcile_due(self.full_reconcile_days)
+        self.directory.full_reconcile = full_reconcile
+        if full_reconcile:
+            self.logger.info("Reconciling all %d groups", len(all_groups))
+        else:
+            # Skip Google entirely unless something changed since last cycle
+            changed = self.directory.changed_groups(all_groups)
+            removed = self.directory.removed_groups(all_groups) if complete else set()
+            with self.lock:
+                self.status["groups_changed"] += len(changed)
+            if not changed and not removed:
+                self.logger.info("No changes in %d groups", len(all_groups))
+                return []
+            self.logger.info(
+                "%d of %d groups changed, %d removed",
+                len(changed),
+                len(all_groups),
+                len(removed),
+            )
+        results = self.directory.sync_groups(all_groups, delete_removed=complete)
+        # Do not keep the prefetched groups around until the next cycle
+        self.directory.inventory = None
+        if full_reconcile and not self.directory.readonly and complete:
+            if all(result.error is None for result in results):
+                self.state.mark_reconciled()
+        return results
+
+    def run_once(self) -> bool:
+        """Run one cycle, recording the outcome. Return True on success."""
+        start = time.time()
+        try:
+            results = self.run_cycle()
+            error = None
+            if self.scoutnet.failed:
+                error = "Failed to fetch %d Scoutnet lists" % len(self.scoutnet.failed)
+                self.logger.error("%s, no groups were deleted", error)
+        except Exception as exc:
+            self.logger.debug("Exception: %s", str(exc))
+            self.logger.error("Synchronization failed: %s", str(exc))
+            results = []
+            error = str(exc)
+        with self.lock:
+            self.status["cycles"] += 1
+            self.status["last_run"] = start
+            self.status["last_duration"] = time.time() - start
+            self.status["last_error"] = error
+            if error is None:
+                self.status["last_success"] = start
+            else:
+                self.status["cycle_failures"] += 1
+            synchronized = [result for result in results if not result.skipped]
+            self.status["groups_synchronized"] += len(synchronized)
+            self.status["groups_failed"] += len(
+                [result for result in results if result.error is not None]
+            )
+            self.status["member_changes"] += sum(
+                result.members_changed for result in results
+            )
+            self.status["member_failures"] += sum(
+                result.members_failed for result in results
+            )
+        self.directory.executor.log_stats()
+        return error is None
+
+    def run(self) -> None:
+        """Run cycles until stopped, sleeping interval plus jitter between them."""
+        while not self.stopping.is_set():
+            self.run_once()
+            delay = self.interval + random.uniform(0, self.jitter)
+            self.logger.info("Next synchronization in %.0fs", delay)
+            self.stopping.wait(delay)
+
+    def stop(self, *args: Any) -> None:
+        """Stop after the running cycle."""
+        self.logger.info("Stopping")
+        self.stopping.set()
+
+    def healthy(self) -> bool:
+        """Check that the last cycle succeeded and was not too long ago."""
+        with self.lock:
+            last_success = self.status["last_success"]
+            last_error = self.status["last_error"]
+        if last_success is None:
+            # Still running the first cycle
+            return last_error is None
+        max_age = 3 * (self.interval + self.jitter)
+        return last_error is None and time.time() - last_success < max_age
+
+    def health(self) -> Dict[str, Any]:
+        """Return status as a JSON compatible dict."""
+        with self.lock:
+            status = dict(self.status)
+        status["status"] = "ok" if self.healthy() else "failing"
+        status["uptime"] = time.time() - self.started
+        return status
+
+    def metrics(self) -> str:
+        """Return status, API counters and timings in Prometheus text format."""
+        with self.lock:
+            status = dict(self.status)
+        counters = dict(self.directory.executor.counters)
+        lines = []
+
+        def metric(name: str, kind: str, value: Any) -> None:
+            if value is None:
+                return
+            lines.append("# TYPE %s_%s %s" % (METRICS_PREFIX, name, kind))
+            lines.append("%s_%s %s" % (METRICS_PREFIX, name, float(value)))
+
+        metric("up", "gauge", 1 if self.healthy() else 0)
+        metric("cycles_total", "counter", status["cycles"])
+        metric("cycle_failures_total", "counter", status["cycle_failures"])
+        metric("last_run_timestamp_seconds", "gauge", status["last_run"])
+        metric("last_success_timestamp_seconds", "gauge", status["last_success"])
+        metric("last_duration_seconds", "gauge", status["last_duration"])
+        metric("groups_changed_total", "counter", status["groups_changed"])
+        metric("groups_synchronized_total", "counter", status["groups_synchronized"])
+        metric("groups_failed_total", "counter", status["groups_failed"])
+        metric("member_changes_total", "counter", status["member_changes"])
+        metric("member_failures_total", "counter", status["member_failures"])
+        metric("google_requests_total", "counter", counters["requests"])
+        metric("google_retries_total", "counter", counters["retries"])
+        metric("google_throttle_seconds_total", "counter", counters["throttle_seconds"])
+        metric("google_backoff_seconds_total", "counter", counters["backoff_seconds"])
+        return "\n".join(lines) + "\n" + METRICS.prometheus()
+
+
+def status_server(
+    daemon: SyncDaemon, address: Tuple[str, int]
+) -> http.server.ThreadingHTTPServer:
+    """Create a server answering /health (JSON) and /metrics (Prometheus)."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                status = 200 if daemon.healthy() else 503
+                body = json.dumps(daemon.health()).encode("utf-8")
+                content_type = "application/json"
+            elif self.path == "/metrics":
+                status = 200
+                body = daemon.metrics().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            daemon.logger.debug("%s %s", self.address_string(), format % args)
+
+    server = http.server.ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """main."""
+    parser = argparse.ArgumentParser(
+        description="Keep GSuite groups synchronized with Scoutnet email lists."
+    )
+    parser.add_argument(
+        "--once", dest="once", action="store_true", help="Run one cycle and exit"
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Test mode (no changes written)",
+    )
+    parser.add_argument(
+        "--verbose", dest="verbose", action="store_true", help="Enable verbose output"
+    )
+    parser.add_argument(
+        "--debug", dest="debug", action="store_true", help="Enable debugging output"
+    )
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+        logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
+        logging.getLogger("googleapiclient.discovery").setLevel(logging.WARNING)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    config = S2g_config()
+    configure_addresses(config)
+
+    # Credentials, HTTP connections and the state stay open between cycles
+    state = SyncState()
+    directory = google_directory(
+        config,
+        args.dry_run,
+        state=state,
+        full_reconcile=False,
+        stagger=config.getfloat("daemon", "stagger"),
+    )
+    daemon = SyncDaemon(
+        scoutnet_api(config),
+        directory,
+        state,
+        interval=config.getfloat("daemon", "interval"),
+        jitter=config.getfloat("daemon", "jitter"),
+        full_reconcile_days=config.getfloat("google", "full_reconcile_days"),
+    )
+
+    if args.once:
+        ok = daemon.run_once()
+        state.close()
+        raise SystemExit(0 if ok else 1)
+
+    server = None
+    listen = parse_listen(config["daemon"]["listen"])
+    if listen is not None:
+        server = status_server(daemon, listen)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("Serving /health and /metrics on %s:%d", *listen)
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
+    if server is not None:
+        server.shutdown()
+    state.close()
+
+
+if __name__ == "__main__":
+    main()
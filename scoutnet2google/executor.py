@@ -0,0 +1,283 @@
+"""Rate limited execution of Google API requests."""
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from googleapiclient.errors import HttpError
+from scoutnet2google.google_service import REQUEST_FIELDS
+from scoutnet2google.metrics import METRICS
+
+DEFAULT_RATE = 20.0  # requests per second
+DEFAULT_BURST = 20
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 64.0
+DEFAULT_POLL_TIMEOUT = 60.0
+
+RETRYABLE_STATUS = [429, 500, 502, 503, 504]
+RETRYABLE_REASONS = ["rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+def http_status(exc: BaseException) -> Optional[int]:
+    """Return the HTTP status of an API error."""
+    if isinstance(exc, HttpError):
+        return int(exc.resp.status)
+    return None
+
+
+def error_reasons(exc: HttpError) -> List[str]:
+    """Return the error reasons of an API error."""
+    try:
+        content = exc.content.decode("utf-8")
+        errors = json.loads(content).get("error", {}).get("errors", [])
+        return [error.get("reason") for error in errors]
+    except (ValueError, AttributeError):
+        return []
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Check if an API error is worth retrying."""
+    status = http_status(exc)
+    if status in RETRYABLE_STATUS:
+        return True
+    if status == 403:
+        return any(
+            reason in RETRYABLE_REASONS
+            for reason in error_reasons(exc)  # type: ignore
+        )
+    return False
+
+
+def is_not_found(exc: BaseException) -> bool:
+    """Check if an API error means that the resource does not exist."""
+    return http_status(exc) == 404
+
+
+def is_conflict(exc: BaseException) -> bool:
+    """Check if an API error means that the resource already exists."""
+    return http_status(exc) == 409
+
+
+def operation_name(request: Any) -> str:
+    """Return the metrics name of a request, e.g. google.directory.groups.list."""
+    method_id = getattr(request, "methodId", None)
+    return "google.%s" % (method_id or "request")
+
+
+def measure_bytes(request: Any) -> None:
+    """Record the size of the response of a request in the metrics."""
+    postproc = getattr(request, "postproc", None)
+    if postproc is None or getattr(postproc, "measured", False):
+        return
+    name = operation_name(request)
+
+    def measured_postproc(resp: Any, content: Any) -> Any:
+        METRICS.add_bytes(name, len(content or b""))
+        return postproc(resp, content)
+
+    measured_postproc.measured = True  # type: ignore
+    request.postproc = measured_postproc
+
+
+class TokenBucket(object):
+    """Thread safe token bucket."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """Initialize."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1) -> float:
+        """Take tokens, waiting if needed. Return the time waited.
+
+        More tokens than burst (a large batch) are taken in burst sized
+        chunks, so every one of them is paid for at rate.
+        """
+        waited = 0.0
+        remaining = tokens
+        while remaining > 0:
+            chunk = min(remaining, self.burst)
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= chunk:
+                    self.tokens -= chunk
+                    remaining -= chunk
+                    continue
+                delay = (chunk - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    def slow_down(self) -> None:
+        """Drain the bucket after the server asked us to back off."""
+        with self.lock:
+            self.tokens = 0.0
+            self.updated = time.monotonic()
+
+
+class RequestExecutor(object):
+    """Execute API requests with rate limiting and exponential backoff."""
+
+    def __init__(
+        self,
+        rate: float = DEFAULT_RATE,
+        burst: int = DEFAULT_BURST,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_delay: float = DEFAULT_BASE_DELAY,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        bucket: Optional[TokenBucket] = None,
+    ) -> None:
+        """Initialize, sharing bucket with other executors if given."""
+        if bucket is None and rate > 0:
+            bucket = TokenBucket(rate, burst)
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.counters: Dict[str, float] = {
+            "requests": 0,
+            "retries": 0,
+            "throttle_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    def _count(self, counter: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[counter] += value
+
+    def _throttle(self, tokens: int = 1) -> None:
+        self._count("requests", tokens)
+        if self.bucket is not None:
+            waited = self.bucket.acquire(tokens)
+            if waited > 0:
+                self._count("throttle_seconds", waited)
+
+    def _backoff(
+        self,
+        attempt: int,
+        exc: BaseException,
+        quota: bool = True,
+        name: Optional[str] = None,
+    ) -> None:
+        if name is not None:
+            METRICS.add_retry(name)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        LOGGER.warning("Retrying in %.1fs after error: %s", delay, str(exc))
+        if quota and self.bucket is not None:
+            self.bucket.slow_down()
+        self._count("retries")
+        self._count("backoff_seconds", delay)
+        time.sleep(delay)
+
+    def execute(self, request: Any) -> Any:
+        """Execute a request, retrying on quota and server errors."""
+        name = operation_name(request)
+        measure_bytes(request)
+        attempt = 0
+        while True:
+            self._throttle()
+            try:
+                with METRICS.timer(name):
+                    return request.execute()
+            except HttpError as exc:
+                if not is_retryable(exc) or attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt, exc, name=name)
+                attempt += 1
+
+    def poll(
+        self, request_factory: Callable[[], Any], timeout: float = DEFAULT_POLL_TIMEOUT
+    ) -> Any:
+        """Execute a request until the resource exists or timeout passes."""
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            try:
+                return self.execute(request_factory())
+            except HttpError as exc:
+                if not is_not_found(exc) or time.monotonic() >= deadline:
+                    raise
+                self._backoff(attempt, exc, quota=False)
+                attempt += 1
+
+    def execute_batch(
+        self, batch_factory: Callable[..., Any], requests: List[Any]
+    ) -> List[Tuple[Any, Optional[Exception]]]:
+        """Execute requests in a batch, retrying failed sub-requests."""
+        results: Dict[int, Tuple[Any, Optional[Exception]]] = {}
+        pending = list(range(len(requests)))
+        attempt = 0
+        while True:
+
+            def callback(request_id: str, response: Any, exception: Any) -> None:
+                results[int(request_id)] = (response, exception)
+
+            batch = batch_factory(callback=callback)
+            for index in pending:
+                measure_bytes(requests[index])
+                batch.add(requests[index], request_id=str(index))
+            # Every sub-request counts against the quota
+            self._throttle(len(pending))
+            start = time.perf_counter()
+            try:
+                with METRICS.timer("google.batch"):
+                    batch.execute()
+            except Exception as exc:
+                # Sub-requests without a callback never got a response
+                for index in pending:
+                    results.setdefault(index, (None, exc))
+            # Sub-requests share the time of the batch equally
+            share = (time.perf_counter() - start) / len(pending)
+            for index in pending:
+                METRICS.observe(
+                    operation_name(requests[index]),
+                    share,
+                    error=results[index][1] is not None,
+                )
+            retry = [
+                index
+                for index in pending
+                if results[index][1] is not None and is_retryable(results[index][1])
+            ]
+            if len(retry) == 0 or attempt >= self.max_retries:
+                break
+            for index in retry:
+                METRICS.add_retry(operation_name(requests[index]))
+            self._backoff(attempt, results[retry[0]][1])  # type: ignore
+            attempt += 1
+            pending = retry
+            for index in retry:
+                del results[index]
+        return [results[index] for index in range(len(requests))]
+
+    def log_stats(self, logger: logging.Logger = LOGGER) -> None:
+        """Log request, retry and throttle counters."""
+        logger.info(
+            "Google API: %d requests, %d retries, %.1fs throttled, %.1fs backoff",
+            self.counters["requests"],
+            self.counters["retries"],
+            self.counters["throttle_seconds"],
+            self.counters["backoff_seconds"],
+        )
+        # Compare runs with partial_responses on and off to see the saving
+        received = METRICS.bytes_by_name("google.")
+        for (name, count) in received.items():
+            logger.debug("  %-44s %10d bytes", name, count)
+        logger.debug(
+            "Google API: %d bytes received, partial responses %s",
+            sum(received.values()),
+            "enabled" if REQUEST_FIELDS.partial else "disabled",
+        )
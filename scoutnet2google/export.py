@@ -0,0 +1,282 @@
+"""Streaming export of mailing lists and users to JSON, JSONL, CSV or Parquet."""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+from dataclasses import asdict
+from typing import IO, Any, Dict, Iterable, List, Optional
+
+from scoutnet2google.lazy import lazy_import
+
+FORMATS = ["json", "jsonl", "csv", "parquet"]
+EXTENSIONS = {".jsonl": "jsonl", ".csv": "csv", ".parquet": "parquet"}
+ROW_GROUP_SIZE = 10000  # Records buffered per Parquet row group
+
+# Column types of the exported records: string, bool or strings (a list)
+LIST_COLUMNS = {
+    "id": "string",
+    "title": "string",
+    "description": "string",
+    "aliases": "strings",
+    "members": "strings",
+}
+USER_COLUMNS = {
+    "source": "string",
+    "member_no": "string",
+    "first_name": "string",
+    "last_name": "string",
+    "email_primary": "string",
+    "email_alternate": "string",
+    "unit": "string",
+    "role": "string",
+    "mobile": "string",
+    "date_of_birth": "string",
+    "admin": "bool",
+    "suspended": "bool",
+    "matched": "bool",
+}
+
+
+def export_format(filename: str, fmt: Optional[str] = None) -> str:
+    """Return the format given, or the one implied by the file extension."""
+    if fmt is not None:
+        return fmt
+    for (extension, implied) in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return implied
+    return "json"
+
+
+def check_export(filename: str, fmt: Optional[str] = None) -> None:
+    """Raise ValueError if records can not be exported to filename."""
+    fmt = export_format(filename, fmt)
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format: %s" % fmt)
+    if fmt == "parquet":
+        try:
+            lazy_import("pyarrow.parquet")
+        except ImportError:
+            raise ValueError("Parquet export requires pyarrow") from None
+
+
+def list_record(mlist: Any) -> Dict[str, Any]:
+    """Return a mailing list as an export record."""
+    record = dict(asdict(mlist), members=sorted(mlist.members))
+    return {name: record.get(name) for name in LIST_COLUMNS}
+
+
+def user_record(user: Any, source: str, matched: Optional[bool]) -> Dict[str, Any]:
+    """Return a Scoutnet or Google user as an export record."""
+    values = dict(asdict(user), source=source, matched=matched)
+    return {name: values.get(name) for name in USER_COLUMNS}
+
+
+class Exporter(object):
+    """Write records one at a time, without holding them in memory.
+
+    json writes one array (the format --output always had), jsonl one
+    object per line, csv one row per record with list values joined by
+    spaces, and parquet (requires pyarrow) columns in row groups.
+    Records go to a temporary file that replaces filename when closed,
+    so a failed export never leaves a truncated file behind.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        fmt: Optional[str] = None,
+        columns: Dict[str, str] = LIST_COLUMNS,
+    ) -> None:
+        """Open filename for writing records with columns in fmt."""
+        check_export(filename, fmt)
+        self.format = export_format(filename, fmt)
+        self.filename = filename
+        self.columns = columns
+        self.count = 0
+        self.file: Optional[IO[str]] = None
+        self.csv: Any = None
+        self.parquet: Any = None
+        self.rows: List[Dict[str, Any]] = []
+        (fd, self.tmpname) = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename))
+        )
+        if self.format == "parquet":
+            os.close(fd)
+            self.pyarrow = lazy_import("pyarrow")
+        else:
+            self.file = os.fdopen(fd, "wt", encoding="utf-8", newline="")
+            if self.format == "json":
+                self.file.write("[")
+            elif self.format == "csv":
+                self.csv = csv.DictWriter(self.file, fieldnames=list(columns))
+                self.csv.writeheader()
+
+    def __enter__(self) -> "Exporter":
+        """Return self."""
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        """Finish the file, or discard it if the export failed."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """Write one record."""
+        if self.format == "json":
+            self.file.write(",\n" if self.count else "\n")
+            self.file.write(json.dumps(record, sort_keys=True, ensure_ascii=False))
+        elif self.format == "jsonl":
+            self.file.write(json.dumps(record, sort_keys=True, ensure_ascii=False))
+            self.file.write("\n")
+        elif self.format == "csv":
+            self.csv.writerow(
+                {
+                    key: " ".join(value) if isinstance(value, list) else value
+                    for (key, value) in record.items()
+                }
+            )
+        else:
+            self.rows.append(record)
+            if len(self.rows) >= ROW_GROUP_SIZE:
+                self._write_row_group()
+        self.count += 1
+
+    def write_all(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Write records, return the number written."""
+        for record in records:
+            self.write(record)
+        return self.count
+
+    def _schema(self) -> Any:
+        """Return the Parquet schema of the columns."""
+        pyarrow = self.pyarrow
+        types = {
+            "string": pyarrow.string(),
+            "bool": pyarrow.bool_(),
+            "strings": pyarrow.list_(pyarrow.string()),
+        }
+        return pyarrow.schema(
+            [(name, types[kind]) for (name, kind) in self.columns.items()]
+        )
+
+    def _write_row_group(self) -> None:
+        """Write the buffered records as one Parquet row group."""
+        if self.parquet is None:
+            self.parquet = self.pyarrow.parquet.ParquetWriter(
+                self.tmpname, self._schema()
+            )
+        rows = [
+            {
+                name: str(value)
+                if value is not None and self.columns[name] == "string"
+                else value
+                for (name, value) in record.items()
+            }
+            for record in self.rows
+        ]
+        self.parquet.write_table(
+            self.pyarrow.Table.from_pylist(rows, schema=self.parquet.schema)
+        )
+        self.rows = []
+
+    def close(self) -> None:
+        """Write what is buffered, close the file and move it in place."""
+        if self.format == "parquet":
+            if self.rows or self.parquet is None:
+                self._write_row_group()
+            self.parquet.close()
+        else:
+            if self.format == "json":
+                self.file.write("\n]\n")
+            self.file.close()
+        os.replace(self.tmpname, self.filename)
+
+    def abort(self) -> None:
+        """Close and remove the file, leaving filename untouched."""
+        if self.parquet is not None:
+            self.parquet.close()
+        if self.file is not None:
+            self.file.close()
+        os.unlink(self.tmpname)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """main."""
+    parser = argparse.ArgumentParser(
+        description="Export Scoutnet email lists or users to file."
+    )
+    parser.add_argument("data", choices=["lists", "users"], help="What to export")
+    parser.add_argument("output", metavar="filename", help="File to write")
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=FORMATS,
+        help="Format of the file (default from its extension, else json)",
+    )
+    parser.add_argument(
+        "--tenant",
+        dest="tenant",
+        metavar="name",
+        help="Use the [scoutnet:name] and [google:name] config sections",
+    )
+    parser.add_argument(
+        "--verbose", dest="verbose", action="store_true", help="Enable verbose output"
+    )
+    parser.add_argument(
+        "--debug", dest="debug", action="store_true", help="Enable debugging output"
+    )
+    args = parser.parse_args(argv)
+    try:
+        check_export(args.output, args.output_format)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    # Only Scoutnet is read, so no Google API client or credentials are set up
+    from scoutnet2google.manage_config import S2g_config
+    from scoutnet2google.sync_mailinglists import configure_addresses, scoutnet_api
+
+    config = S2g_config()
+    if args.tenant is not None:
+        if args.tenant not in config.tenants():
+            parser.error("unknown tenant %s" % args.tenant)
+        config = config.for_tenant(args.tenant)
+    configure_addresses(config)
+
+    failed = 0
+    if args.data == "lists":
+        scoutnet = scoutnet_api(config)
+        with Exporter(args.output, args.output_format) as exporter:
+            for mlist in scoutnet.iter_lists():
+                exporter.write(list_record(mlist))
+        failed = len(scoutnet.failed)
+    else:
+        from scoutnet2google.scoutnet import ScoutnetUsersApi
+
+        users = ScoutnetUsersApi(
+            api_endpoint=config["scoutnet"]["api_endpoint"],
+            api_id=config["scoutnet"]["api_id"],
+            api_key=config["scoutnet"]["api_key_users"],
+            cache_max_age=config.scoutnet_cache_max_age(),
+            max_connections=config.getint("scoutnet", "max_connections"),
+        )
+        with Exporter(args.output, args.output_format, USER_COLUMNS) as exporter:
+            for user in users.iter_users():
+                exporter.write(user_record(user, "scoutnet", None))
+    print("Wrote %d %s to %s" % (exporter.count, args.data, args.output))
+    if failed > 0:
+        logging.error("Failed to fetch %d Scoutnet lists", failed)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 """Handle google auth with installed credentials."""
 import logging
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from typing import List
@@ -9,10 +10,29 @@ import json
 LOGGER = logging.getLogger(__name__)
 
 
+def missing_scopes(
+    credentials: Credentials, token_data: dict, scopes: List[str]
+) -> List[str]:
+    """Return the scopes that the stored credentials were not granted."""
+    granted = token_data.get("scopes")
+    if granted is None:
+        # Saved by an older version, ask Google what the token allows
+        credentials.refresh(Request())
+        granted = credentials.granted_scopes
+    if granted is None:
+        return []
+    return [scope for scope in scopes if scope not in granted]
+
+
 def google_auth_installed(
     secret_file: str, token_file: str, scopes: List[str]
 ) -> Credentials:
-    """Authenticate installed applications with Google."""
+    """Authenticate installed applications with Google.
+
+    Stored credentials lacking some of scopes, like a token saved before a
+    scope was added, are replaced by authorizing again.
+    """
+    credentials = None
     try:
         with open(token_file, "rt") as token_file_fd:
             token_data = json.load(token_file_fd)
@@ -25,6 +45,14 @@ def google_auth_installed(
         )
     except Exception as exc:
         LOGGER.debug("Exception: %s", str(exc))
+    if credentials is not None:
+        missing = missing_scopes(credentials, token_data, scopes)
+        if missing:
+            LOGGER.warning(
+                "Stored credentials lack %s, authorize again", ", ".join(missing)
+            )
+            credentials = None
+    if credentials is None:
         flow = InstalledAppFlow.from_client_secrets_file(secret_file, scopes)
         credentials = flow.run_console()
         token_data = {
@@ -32,6 +60,7 @@ def google_auth_installed(
             "token_uri": credentials.token_uri,
             "client_id": credentials.client_id,
             "client_secret": credentials.client_secret,
+            "scopes": list(scopes),
         }
         with open(token_file, "wt") as token_file:
             json.dump(token_data, token_file)
@@ -0,0 +1,136 @@
+"""Build Google API service objects."""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+from scoutnet2google.lazy import lazy_import
+from scoutnet2google.manage_config import DIRS
+
+DISCOVERY_CACHE_DIR = os.path.join(DIRS.user_cache_dir, "discovery")
+DEFAULT_DISCOVERY_TTL = 86400
+
+# Largest page size the Admin SDK allows for each list call
+MAX_RESULTS = {"groups.list": 200, "members.list": 200, "users.list": 500}
+
+# Partial responses, only the fields that are read from each call
+FIELDS = {
+    "groups.list": "nextPageToken,groups(email,name,description,aliases)",
+    "groups.get": "email,name,description",
+    "groups.aliases.list": "aliases(alias)",
+    "members.list": "nextPageToken,members(email)",
+    "users.list": "nextPageToken,users(primaryEmail,name(givenName,familyName),"
+    "phones,recoveryEmail,orgUnitPath,isAdmin,suspended,aliases)",
+    "users.get": "primaryEmail,name(givenName,familyName),externalIds",
+}
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DiscoveryCache(object):
+    """File based discovery document cache with a time to live."""
+
+    def __init__(
+        self, directory: str = DISCOVERY_CACHE_DIR, ttl: int = DEFAULT_DISCOVERY_TTL
+    ) -> None:
+        """Initialize."""
+        self.directory = directory
+        self.ttl = ttl
+
+    def _filename(self, url: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def get(self, url: str) -> Optional[str]:
+        """Return a cached document unless it has expired."""
+        filename = self._filename(url)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.ttl:
+                LOGGER.debug("Cached discovery document for %s expired", url)
+                return None
+            with open(filename, "rt") as file:
+                LOGGER.debug("Using cached discovery document for %s", url)
+                return file.read()
+        except OSError:
+            return None
+
+    def set(self, url: str, content: str) -> None:
+        """Store a document in the cache."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            (fd, tmpname) = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wt") as file:
+                file.write(content)
+            os.replace(tmpname, self._filename(url))
+        except OSError as exc:
+            LOGGER.warning("Failed to cache discovery document: %s", str(exc))
+
+
+class RequestFields(object):
+    """Field masks and page sizes of the list and get calls."""
+
+    def __init__(self, partial: bool = True) -> None:
+        """Initialize."""
+        self.partial = partial
+
+    def params(self, method: str) -> Dict[str, Any]:
+        """Return the fields and maxResults parameters of a method."""
+        params: Dict[str, Any] = {}
+        if self.partial and method in FIELDS:
+            params["fields"] = FIELDS[method]
+        if method in MAX_RESULTS:
+            params["maxResults"] = MAX_RESULTS[method]
+        return params
+
+
+REQUEST_FIELDS = RequestFields()
+
+
+def build_service(
+    service_name: str, version: str, credentials: Any, google_config: Any
+) -> Any:
+    """Build a service, preferring a local or cached discovery document."""
+    discovery = lazy_import("googleapiclient.discovery")
+    REQUEST_FIELDS.partial = google_config.getboolean("partial_responses", True)
+    LOGGER.debug(
+        "Partial responses %s", "enabled" if REQUEST_FIELDS.partial else "disabled"
+    )
+    document_file = google_config.get("discovery_document")
+    client_options = None
+    if google_config.get("api_endpoint"):
+        client_options = {"api_endpoint": google_config.get("api_endpoint")}
+    if document_file:
+        LOGGER.debug("Using discovery document %s", document_file)
+        with open(document_file, "rt") as file:
+            document = file.read()
+        return discovery.build_from_document(
+            document, credentials=credentials, client_options=client_options
+        )
+    kwargs: Dict[str, Any] = {}
+    if google_config.get("discovery_url"):
+        kwargs["discoveryServiceUrl"] = google_config.get("discovery_url")
+    cache = DiscoveryCache(ttl=int(google_config.get("discovery_cache_ttl", 0) or 0))
+    return discovery.build(
+        service_name,
+        version,
+        credentials=credentials,
+        cache_discovery=cache.ttl > 0,
+        cache=cache,
+        client_options=client_options,
+        **kwargs,
+    )
+
+
+def clone_service(service: Any, credentials: Any) -> Any:
+    """Build another service object from the discovery document of service.
+
+    The clone talks to the same endpoint, including a configured api_endpoint.
+    """
+    discovery = lazy_import("googleapiclient.discovery")
+    return discovery.build_from_document(
+        service._rootDesc,
+        credentials=credentials,
+        client_options={"api_endpoint": service._baseUrl},
+    )
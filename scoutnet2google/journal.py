@@ -0,0 +1,194 @@
+"""Write-ahead journal of planned and completed group changes."""
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import replace
+from typing import Any, Dict, Optional, Set, Tuple
+from scoutnet2google.manage_config import DIRS, open_private
+from scoutnet2google.plan import GroupPlan, plan_record
+
+DEFAULT_JOURNAL_FILE = os.path.join(DIRS.user_cache_dir, "journal.jsonl")
+INFO_OP = "info"  # Creating, updating or deleting a group
+
+
+def alias_op(action: str, alias: str) -> str:
+    """Return the journal key of adding or removing an alias."""
+    return "alias %s %s" % (action, alias)
+
+
+def member_op(action: str, member_key: str) -> str:
+    """Return the journal key of adding or removing a member."""
+    return "member %s %s" % (action, member_key)
+
+
+class Journal(object):
+    """Append-only JSON lines log of group changes.
+
+    A plan is written before a group is changed, every mutation once it
+    has succeeded, and the group once all of it is done. Resuming reads
+    the log back so that finished groups and mutations are not repeated.
+    The file is removed when a run completes without errors.
+
+    plan_digest identifies the plan file being applied (None for a sync).
+    A journal is only resumed by a run with the same plan_digest, since
+    its completed mutations say nothing about another plan.
+    """
+
+    def __init__(
+        self,
+        filename: str = DEFAULT_JOURNAL_FILE,
+        resume: bool = False,
+        plan_digest: Optional[str] = None,
+    ):
+        """Open the journal, reading it back if resuming, else starting over."""
+        self.filename = filename
+        self.plan_digest = plan_digest
+        self.lock = threading.Lock()
+        self.plans: Dict[str, Tuple[Optional[str], GroupPlan]] = {}
+        self.done: Dict[str, Set[str]] = {}
+        self.finished: Dict[str, Optional[str]] = {}
+        self.logger = logging.getLogger(__name__)
+        if resume:
+            self._load()
+        fd = open_private(
+            filename, os.O_WRONLY | (os.O_APPEND if resume else os.O_TRUNC)
+        )
+        self.file = os.fdopen(fd, "at" if resume else "wt", encoding="utf-8")
+        self._append(
+            {
+                "type": "start",
+                "time": time.time(),
+                "resume": resume,
+                "plan_digest": plan_digest,
+            }
+        )
+
+    def _load(self) -> None:
+        try:
+            file = open(self.filename, "rt", encoding="utf-8")
+        except FileNotFoundError:
+            self.logger.info("No journal to resume from")
+            return
+        with file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short by a crash
+                    self.logger.warning("Ignoring damaged journal line")
+                    continue
+                address = record.get("address")
+                if record["type"] == "start" and not record.get("resume"):
+                    if record.get("plan_digest") != self.plan_digest:
+                        raise ValueError(
+                            "Journal %s was written for another plan, "
+                            "run without --resume" % self.filename
+                        )
+                elif record["type"] == "plan":
+                    plan = GroupPlan(**record["plan"])
+                    self.plans[address] = (record.get("hash"), plan)
+                    self.done[address] = set()
+                    self.finished.pop(address, None)
+                elif record["type"] == "done":
+                    self.done.setdefault(address, set()).add(record["op"])
+                elif record["type"] == "finished":
+                    self.finished[address] = record.get("hash")
+        self.logger.info(
+            "Resuming: %d groups finished, %d unfinished",
+            len(self.finished),
+            len([address for address in self.plans if address not in self.finished]),
+        )
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, sort_keys=True, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def planned(self, plan: GroupPlan, content_hash: Optional[str] = None) -> None:
+        """Record the changes about to be made to a group."""
+        with self.lock:
+            self.plans[plan.address] = (content_hash, plan)
+            self.done[plan.address] = set()
+            self.finished.pop(plan.address, None)
+        self._append(
+            {
+                "type": "plan",
+                "address": plan.address,
+                "hash": content_hash,
+                "plan": plan_record(plan),
+            }
+        )
+
+    def completed(self, address: str, op: str) -> None:
+        """Record a successful mutation of a group."""
+        with self.lock:
+            self.done.setdefault(address, set()).add(op)
+        self._append({"type": "done", "address": address, "op": op})
+
+    def group_finished(self, address: str, content_hash: Optional[str] = None) -> None:
+        """Record that all changes to a group have been made."""
+        with self.lock:
+            self.finished[address] = content_hash
+        self._append({"type": "finished", "address": address, "hash": content_hash})
+
+    def is_finished(self, address: str, content_hash: Optional[str] = None) -> bool:
+        """Check if a group with this content has already been finished."""
+        with self.lock:
+            return (
+                address in self.finished and self.finished[address] == content_hash
+            )
+
+    def is_done(self, address: str, op: str) -> bool:
+        """Check if a mutation has already been made."""
+        with self.lock:
+            return op in self.done.get(address, ())
+
+    def remaining(self, plan: GroupPlan) -> GroupPlan:
+        """Return a plan without the mutations already made."""
+        with self.lock:
+            done = set(self.done.get(plan.address, ()))
+        if not done:
+            return plan
+        return replace(
+            plan,
+            info="unchanged" if INFO_OP in done else plan.info,
+            aliases_add=[
+                alias
+                for alias in plan.aliases_add
+                if alias_op("add", alias) not in done
+            ],
+            aliases_remove=[
+                alias
+                for alias in plan.aliases_remove
+                if alias_op("remove", alias) not in done
+            ],
+            members_add=[
+                member
+                for member in plan.members_add
+                if member_op("add", member) not in done
+            ],
+            members_remove=[
+                member
+                for member in plan.members_remove
+                if member_op("remove", member) not in done
+            ],
+        )
+
+    def resume_plan(
+        self, address: str, content_hash: Optional[str] = None
+    ) -> Optional[GroupPlan]:
+        """Return what is left of an unfinished plan for the same content."""
+        with self.lock:
+            entry = self.plans.get(address)
+        if entry is None or entry[0] != content_hash:
+            return None
+        return self.remaining(entry[1])
+
+    def close(self, completed: bool = False) -> None:
+        """Close the journal, removing it if the run completed."""
+        self.file.close()
+        if completed:
+            os.remove(self.filename)
@@ -0,0 +1,24 @@
+"""Deferred imports of heavy dependencies."""
+import importlib
+import logging
+import sys
+import time
+from types import ModuleType
+from typing import Dict
+
+# Seconds spent importing each deferred module
+IMPORT_TIMES: Dict[str, float] = {}
+
+LOGGER = logging.getLogger(__name__)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Import a module the first time a code path needs it."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES[name] = time.perf_counter() - start
+    LOGGER.debug("Imported %s in %.0f ms", name, IMPORT_TIMES[name] * 1000)
+    return module
@@ -1,10 +1,12 @@
 """Manage config."""
 import os
 import configparser
+from typing import List, Optional
 from appdirs import AppDirs
 
 DIRS = AppDirs("Scoutnet2Google", "scoutnet2google")
 DEFAULT_CONFIG_FILE = os.path.join(DIRS.user_config_dir, "scoutnet2google.ini")
+TENANT_SECTIONS = ["scoutnet", "google"]
 
 DEFAULT_CONFIG_GOOGLE = {
     "auth": "standalone",
@@ -18,22 +20,104 @@ api_id:
 api_key_groups: 
 api_key_users: 
 youthgroup_with_accounts =
+fetch_workers: 4
+max_connections: 8
+cache: yes
+cache_max_age: 300
 
 [google]
 auth: installed
 domain: example.com
+sync_workers: 4
+full_reconcile_days: 7
+match_keys: name
+org_unit_root: /
+max_suspensions: 10%
+suspend_exclude:
+attribute_fields: mobile, email
+discovery_cache_ttl: 86400
+discovery_document:
+discovery_url:
+api_endpoint:
+rate_limit: 20
+rate_burst: 20
+max_retries: 6
+partial_responses: yes
+strip_plus: yes
+email_rewrites:
+    ^(.+)@googlemail\\.com$ \\1@gmail.com
+
+[daemon]
+interval: 900
+jitter: 60
+stagger: 0.5
+listen:
+
+[tenants]
+workers: 4
 """
 
 
+def open_private(filename: str, flags: int) -> int:
+    """Open filename with os.open, creating it readable by the owner only.
+
+    The journal and the state hold member addresses, so the directory is
+    created with mode 0700 and the file is made 0600 even if it existed.
+    """
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+    fd = os.open(filename, flags | os.O_CREAT, 0o600)
+    os.fchmod(fd, 0o600)
+    return fd
+
+
 class S2g_config(configparser.ConfigParser):
     """Scoutnet2google config."""
 
-    def __init__(self, config_file: str = DEFAULT_CONFIG_FILE):
-        """Open config."""
+    def __init__(
+        self, config_file: str = DEFAULT_CONFIG_FILE, tenant: Optional[str] = None
+    ):
+        """Open config, with the sections of tenant overriding the defaults."""
         super().__init__()
+        self.config_file = config_file
+        self.tenant = tenant
         self.read_string(DEFAULT_CONFIG)
-        self.read(DEFAULT_CONFIG_FILE)
+        self.read(config_file)
+        if tenant is not None:
+            if tenant not in self.tenants():
+                raise ValueError("Unknown tenant: %s" % tenant)
+            for section in TENANT_SECTIONS:
+                tenant_section = "%s:%s" % (section, tenant)
+                if self.has_section(tenant_section):
+                    for (key, value) in self.items(tenant_section, raw=True):
+                        self.set(section, key, value)
+
+    def tenants(self) -> List[str]:
+        """Return names of tenants, from sections like [scoutnet:name]."""
+        names: List[str] = []
+        for section in self.sections():
+            (base, sep, name) = section.partition(":")
+            if sep and base in TENANT_SECTIONS and name not in names:
+                names.append(name)
+        return names
+
+    def for_tenant(self, tenant: str) -> "S2g_config":
+        """Return the config of a tenant."""
+        return S2g_config(self.config_file, tenant)
+
+    def tenant_file(self, filename: str) -> str:
+        """Return a per tenant variant of a token or state file name."""
+        if self.tenant is None:
+            return filename
+        (base, ext) = os.path.splitext(filename)
+        return "%s_%s%s" % (base, self.tenant, ext)
 
     def getlist(self, section: str, entry: str) -> list:
         """Return entry as a list."""
         return self[section][entry].split("\n")
+
+    def scoutnet_cache_max_age(self) -> Optional[int]:
+        """Return max age of cached Scoutnet responses, None if disabled."""
+        if not self.getboolean("scoutnet", "cache"):
+            return None
+        return self.getint("scoutnet", "cache_max_age")
@@ -0,0 +1,158 @@
+"""Match Scoutnet users with Google users."""
+import logging
+import re
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from dataclasses import dataclass, field
+from scoutnet2google.scoutnet import NORMALIZER
+
+LOGGER = logging.getLogger(__name__)
+
+MATCH_KEYS = ["name", "email", "mobile"]
+DEFAULT_MATCH_KEYS = ["name"]
+
+
+def normalize_name(name: Optional[str]) -> Optional[str]:
+    """Casefold a name and strip diacritics and extra whitespace."""
+    if not name:
+        return None
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split()) or None
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """Lowercase an email address, as Google compares them."""
+    if not email:
+        return None
+    return NORMALIZER.normalize(email) or None
+
+
+def normalize_mobile(mobile: Optional[str]) -> Optional[str]:
+    """Reduce a Swedish mobile number to its national digits."""
+    if not mobile:
+        return None
+    digits = re.sub(r"\D", "", mobile)
+    if mobile.strip().startswith("+46") or digits.startswith("0046"):
+        digits = "0" + digits[digits.index("46") + 2 :]
+    return digits or None
+
+
+def name_keys(user: Any) -> List[str]:
+    """Return the name key of a user."""
+    first_name = normalize_name(user.first_name)
+    last_name = normalize_name(user.last_name)
+    if first_name is None or last_name is None:
+        return []
+    return ["%s|%s" % (first_name, last_name)]
+
+
+def email_keys(user: Any) -> List[str]:
+    """Return the email keys of a user."""
+    emails = [user.email_primary, getattr(user, "email_alternate", None)]
+    return [key for key in map(normalize_email, emails) if key is not None]
+
+
+def mobile_keys(user: Any) -> List[str]:
+    """Return the mobile key of a user."""
+    key = normalize_mobile(user.mobile)
+    return [key] if key is not None else []
+
+
+KEY_FUNCTIONS: Dict[str, Callable[[Any], List[str]]] = {
+    "name": name_keys,
+    "email": email_keys,
+    "mobile": mobile_keys,
+}
+
+
+def parse_match_keys(value: str) -> List[str]:
+    """Parse a comma separated list of match keys."""
+    keys = [key for key in re.split(r"[,\s]+", value) if key]
+    for key in keys:
+        if key not in KEY_FUNCTIONS:
+            raise ValueError("Unknown match key: %s" % key)
+    return keys or DEFAULT_MATCH_KEYS
+
+
+@dataclass(frozen=True)
+class UserMatch:
+    """Hold a matched Scoutnet and Google user and the key that matched."""
+
+    scoutnet_user: Any
+    google_user: Any
+    key: str
+
+
+@dataclass(frozen=True)
+class MatchResult:
+    """Hold the outcome of matching Scoutnet users with Google users."""
+
+    matches: List[UserMatch] = field(default_factory=list)
+    scoutnet_missing: List[Any] = field(default_factory=list)
+    google_missing: List[Any] = field(default_factory=list)
+
+    def count_by_key(self) -> Dict[str, int]:
+        """Count matched Scoutnet users per key."""
+        counts: Dict[str, int] = {}
+        seen = set()
+        for match in self.matches:
+            if id(match.scoutnet_user) not in seen:
+                seen.add(id(match.scoutnet_user))
+                counts[match.key] = counts.get(match.key, 0) + 1
+        return counts
+
+
+class UserMatcher(object):
+    """Match users through normalized key indexes."""
+
+    def __init__(
+        self, google_users: Iterable[Any], keys: List[str] = DEFAULT_MATCH_KEYS
+    ) -> None:
+        """Build one index per key over the Google users."""
+        self.google_users = list(google_users)
+        self.keys = keys
+        self.indexes: Dict[str, Dict[str, List[Tuple[int, Any]]]] = {}
+        for key in keys:
+            index: Dict[str, List[Tuple[int, Any]]] = {}
+            for (position, g_user) in enumerate(self.google_users):
+                for value in KEY_FUNCTIONS[key](g_user):
+                    index.setdefault(value, []).append((position, g_user))
+            self.indexes[key] = index
+
+    def match(self, scoutnet_users: Iterable[Any]) -> MatchResult:
+        """Match Scoutnet users, trying the keys in order.
+
+        A Scoutnet user is matched by the first key that finds someone, but
+        a Google user counts as found if any Scoutnet user has it on any
+        key, so it is never reported missing just because its Scoutnet
+        user matched someone else first.
+        """
+        matches: List[UserMatch] = []
+        scoutnet_missing: List[Any] = []
+        found_positions = set()
+        for sn_user in scoutnet_users:
+            matched_by: Optional[str] = None
+            for key in self.keys:
+                for value in KEY_FUNCTIONS[key](sn_user):
+                    for (position, g_user) in self.indexes[key].get(value, []):
+                        found_positions.add(position)
+                        if matched_by not in (None, key):
+                            continue
+                        LOGGER.debug(
+                            "Matched %s %s with %s by %s",
+                            sn_user.first_name,
+                            sn_user.last_name,
+                            g_user.email_primary,
+                            key,
+                        )
+                        matches.append(UserMatch(sn_user, g_user, key))
+                        matched_by = key
+            if matched_by is None:
+                scoutnet_missing.append(sn_user)
+        google_missing = [
+            g_user
+            for (position, g_user) in enumerate(self.google_users)
+            if position not in found_positions
+        ]
+        return MatchResult(matches, scoutnet_missing, google_missing)
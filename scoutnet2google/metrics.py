@@ -0,0 +1,242 @@
+"""Call counts, latencies and bytes of the hot paths of a run."""
+import bisect
+import contextlib
+import heapq
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+METRICS_PREFIX = "scoutnet2google"
+SLOWEST_COUNT = 10  # Slowest labelled calls kept per operation
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Timing(object):
+    """Count, total time, histogram, bytes and errors of one operation."""
+
+    def __init__(self) -> None:
+        """Initialize."""
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds: float) -> None:
+        """Record one call taking seconds."""
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of its bucket."""
+        rank = q * self.calls
+        seen = 0
+        for (bound, count) in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return bound
+        return self.max_seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return a JSON compatible dict."""
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "seconds": self.seconds,
+            "max_seconds": self.max_seconds,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "bytes": self.bytes,
+            "buckets": dict(
+                zip([str(bound) for bound in BUCKETS] + ["+Inf"], self.buckets)
+            ),
+        }
+
+
+class Metrics(object):
+    """Thread safe registry of timings keyed by operation name.
+
+    Names are dotted, starting with the system they concern, e.g.
+    scoutnet.customlist, google.directory.members.insert, phase.sync or
+    group.sync. Calls timed with a label, like the address of a group,
+    also keep the SLOWEST_COUNT slowest labels per operation.
+    """
+
+    def __init__(self) -> None:
+        """Initialize."""
+        self.lock = threading.Lock()
+        self.timings: Dict[str, Timing] = {}
+        self.slowest: Dict[str, List[Tuple[float, str]]] = {}
+        self.started = time.time()
+
+    def _timing(self, name: str) -> Timing:
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings.setdefault(name, Timing())
+        return timing
+
+    def observe(
+        self,
+        name: str,
+        seconds: float,
+        error: bool = False,
+        label: Optional[str] = None,
+    ) -> None:
+        """Record a call of name taking seconds."""
+        with self.lock:
+            timing = self._timing(name)
+            timing.observe(seconds)
+            if error:
+                timing.errors += 1
+            if label is not None:
+                # Min-heap, the fastest of the kept calls is replaced first
+                slowest = self.slowest.setdefault(name, [])
+                if len(slowest) < SLOWEST_COUNT:
+                    heapq.heappush(slowest, (seconds, label))
+                else:
+                    heapq.heappushpop(slowest, (seconds, label))
+
+    def add_bytes(self, name: str, count: int) -> None:
+        """Record bytes received by name."""
+        with self.lock:
+            self._timing(name).bytes += count
+
+    def add_retry(self, name: str) -> None:
+        """Record a retried call of name."""
+        with self.lock:
+            self._timing(name).retries += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, label: Optional[str] = None) -> Iterator[None]:
+        """Time the enclosed block as one call of name, labelled if given."""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, error, label)
+
+    def bytes_by_name(self, prefix: str = "") -> Dict[str, int]:
+        """Return bytes received per operation whose name starts with prefix."""
+        with self.lock:
+            return {
+                name: timing.bytes
+                for (name, timing) in sorted(self.timings.items())
+                if name.startswith(prefix) and timing.bytes > 0
+            }
+
+    def reset(self) -> None:
+        """Forget everything recorded."""
+        with self.lock:
+            self.timings = {}
+            self.slowest = {}
+            self.started = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return all timings as a JSON compatible dict."""
+        with self.lock:
+            return {
+                "started": self.started,
+                "timings": {
+                    name: timing.as_dict()
+                    for (name, timing) in sorted(self.timings.items())
+                },
+                "slowest": {
+                    name: [
+                        {"label": label, "seconds": seconds}
+                        for (seconds, label) in sorted(slowest, reverse=True)
+                    ]
+                    for (name, slowest) in sorted(self.slowest.items())
+                },
+            }
+
+    def summary(self) -> List[str]:
+        """Return a table of all timings as lines of text."""
+        header = ("operation", "calls", "errors", "retries", "total s", "p50 s")
+        lines = ["%-44s %7s %6s %7s %9s %8s %8s %10s" % (header + ("p95 s", "bytes"))]
+        recorded = self.as_dict()
+        for (name, timing) in sorted(recorded["timings"].items()):
+            lines.append(
+                "%-44s %7d %6d %7d %9.2f %8.3f %8.3f %10d"
+                % (
+                    name,
+                    timing["calls"],
+                    timing["errors"],
+                    timing["retries"],
+                    timing["seconds"],
+                    timing["p50_seconds"],
+                    timing["p95_seconds"],
+                    timing["bytes"],
+                )
+            )
+        for (name, slowest) in recorded["slowest"].items():
+            lines.append("slowest %s:" % name)
+            for entry in slowest:
+                lines.append("  %-42s %9.2f" % (entry["label"], entry["seconds"]))
+        return lines
+
+    def log_summary(self, logger: logging.Logger = LOGGER) -> None:
+        """Log the summary table."""
+        for line in self.summary():
+            logger.info("%s", line)
+
+    def prometheus(self, labels: Optional[Dict[str, str]] = None) -> str:
+        """Return all timings in Prometheus text format."""
+        base = dict(labels or {})
+
+        def label_text(extra: Dict[str, str]) -> str:
+            pairs = dict(base, **extra)
+            return ",".join('%s="%s"' % item for item in sorted(pairs.items()))
+
+        name = METRICS_PREFIX + "_operation"
+        timings = sorted(self.as_dict()["timings"].items())
+        # Samples of a metric family must be grouped after its TYPE line
+        lines = ["# TYPE %s_seconds histogram" % name]
+        for (operation, timing) in timings:
+            cumulative = 0
+            for (bound, count) in timing["buckets"].items():
+                cumulative += count
+                text = label_text({"operation": operation, "le": bound})
+                lines.append("%s_seconds_bucket{%s} %d" % (name, text, cumulative))
+            text = label_text({"operation": operation})
+            lines.append("%s_seconds_sum{%s} %f" % (name, text, timing["seconds"]))
+            lines.append("%s_seconds_count{%s} %d" % (name, text, timing["calls"]))
+        for counter in ["errors", "retries", "bytes"]:
+            lines.append("# TYPE %s_%s_total counter" % (name, counter))
+            for (operation, timing) in timings:
+                text = label_text({"operation": operation})
+                lines.append(
+                    "%s_%s_total{%s} %d" % (name, counter, text, timing[counter])
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str) -> None:
+        """Write timings as Prometheus textfile (.prom) or JSON (otherwise)."""
+        if filename.endswith(".prom"):
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.as_dict(), indent=4)
+        # node_exporter may read the file at any time, replace it atomically
+        (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename) or ".")
+        with os.fdopen(fd, "wt") as file:
+            file.write(data)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+
+
+METRICS = Metrics()
@@ -0,0 +1,60 @@
+"""Serialized change plans for Google groups."""
+import json
+from typing import IO, Any, Dict, Iterable, Iterator, List
+from dataclasses import dataclass, field, asdict
+
+PLAN_VERSION = 1
+
+
+@dataclass(frozen=True)
+class GroupPlan:
+    """Hold the changes needed to synchronize a Google group."""
+
+    address: str
+    info: str = "unchanged"  # "create", "update", "delete" or "unchanged"
+    title: str = None
+    description: str = None
+    aliases_add: List[str] = field(default_factory=list)
+    aliases_remove: List[str] = field(default_factory=list)
+    members_add: List[str] = field(default_factory=list)
+    members_remove: List[str] = field(default_factory=list)
+
+    @property
+    def empty(self) -> bool:
+        """Check if the plan has no changes."""
+        return self.info == "unchanged" and not (
+            self.aliases_add
+            or self.aliases_remove
+            or self.members_add
+            or self.members_remove
+        )
+
+
+def plan_record(plan: GroupPlan) -> Dict[str, Any]:
+    """Return a group plan as a dict without empty fields."""
+    record = {key: value for (key, value) in asdict(plan).items() if value}
+    record["address"] = plan.address
+    return record
+
+
+def write_plan(plans: Iterable[GroupPlan], file: IO[str]) -> int:
+    """Write non-empty group plans as JSON lines, return number written."""
+    file.write(json.dumps({"version": PLAN_VERSION}) + "\n")
+    count = 0
+    for plan in plans:
+        if plan.empty:
+            continue
+        record = plan_record(plan)
+        file.write(json.dumps(record, sort_keys=True, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def read_plan(file: IO[str]) -> Iterator[GroupPlan]:
+    """Read group plans written by write_plan."""
+    header = json.loads(file.readline() or "{}")
+    if header.get("version") != PLAN_VERSION:
+        raise ValueError("Unsupported plan version: %s" % header.get("version"))
+    for line in file:
+        if line.strip():
+            yield GroupPlan(**json.loads(line))
@@ -0,0 +1,146 @@
+"""Plans for creating and suspending Google accounts."""
+import json
+import re
+import unicodedata
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Set
+from dataclasses import dataclass, asdict
+
+USER_PLAN_VERSION = 1
+ACTIONS = ["create", "suspend"]
+
+
+@dataclass(frozen=True)
+class UserChange:
+    """Hold an account to create or suspend in Google."""
+
+    action: str  # "create" or "suspend"
+    email: str
+    first_name: str = None
+    last_name: str = None
+    org_unit: str = None
+    member_no: str = None
+
+
+def address_part(name: Optional[str]) -> str:
+    """Reduce a name to lowercase ASCII letters, digits and dashes."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9]+", "-", stripped.lower()).strip("-")
+
+
+def account_address(user: Any, domain: str, taken: Set[str]) -> str:
+    """Return a free firstname.lastname address for a Scoutnet user."""
+    parts = [address_part(user.first_name), address_part(user.last_name)]
+    local = ".".join(part for part in parts if part) or str(user.member_no)
+    address = "%s@%s" % (local, domain)
+    number = 2
+    while address in taken:
+        address = "%s%d@%s" % (local, number, domain)
+        number += 1
+    taken.add(address)
+    return address
+
+
+def suspend_limit(value: str, total: int) -> int:
+    """Return the most accounts to suspend, value is N or a percentage of total."""
+    value = value.strip()
+    if value.endswith("%"):
+        return int(total * float(value[:-1]) / 100)
+    return int(value)
+
+
+def parse_exclude(value: str) -> List[str]:
+    """Parse a comma separated list of addresses and organizational units."""
+    return [entry.lower() for entry in re.split(r"[,\s]+", value) if entry]
+
+
+def is_excluded(user: Any, exclude: Iterable[str]) -> bool:
+    """Check if a Google user matches an address or is in an excluded unit."""
+    unit = (getattr(user, "unit", None) or "/").lower().rstrip("/") + "/"
+    for entry in exclude:
+        if entry.startswith("/"):
+            if unit.startswith(entry.rstrip("/") + "/"):
+                return True
+        elif entry == user.email_primary.lower():
+            return True
+    return False
+
+
+def org_unit_path(root: str, unit: Optional[str]) -> str:
+    """Return the organizational unit of a Scoutnet unit below root."""
+    root = "/" + root.strip("/")
+    if not unit:
+        return root
+    unit = unit.replace("/", "-").strip()
+    return root.rstrip("/") + "/" + unit
+
+
+def plan_user_changes(
+    scoutnet_missing: Iterable[Any],
+    google_missing: Iterable[Any],
+    domain: str,
+    org_unit_root: str = "/",
+    actions: List[str] = ACTIONS,
+    taken: Iterable[str] = (),
+    exclude: Iterable[str] = (),
+) -> List[UserChange]:
+    """Turn the users missing on either side into account changes.
+
+    Scoutnet users without an account get one in the organizational unit
+    of their Scoutnet unit, at an address not in taken. Google users not
+    in Scoutnet are suspended, except administrators, users already
+    suspended and users matching exclude (see is_excluded).
+    """
+    changes: List[UserChange] = []
+    if "create" in actions:
+        used = {address.lower() for address in taken}
+        for user in scoutnet_missing:
+            changes.append(
+                UserChange(
+                    "create",
+                    account_address(user, domain, used),
+                    first_name=user.first_name,
+                    last_name=user.last_name,
+                    org_unit=org_unit_path(org_unit_root, user.unit),
+                    member_no=user.member_no,
+                )
+            )
+    if "suspend" in actions:
+        for user in google_missing:
+            if getattr(user, "admin", False) or getattr(user, "suspended", False):
+                continue
+            if is_excluded(user, exclude):
+                continue
+            changes.append(
+                UserChange(
+                    "suspend",
+                    user.email_primary,
+                    first_name=user.first_name,
+                    last_name=user.last_name,
+                )
+            )
+    return changes
+
+
+def write_user_plan(changes: Iterable[UserChange], file: IO[str]) -> int:
+    """Write account changes as JSON lines, return number written."""
+    file.write(json.dumps({"version": USER_PLAN_VERSION}) + "\n")
+    count = 0
+    for change in changes:
+        record = {key: value for (key, value) in asdict(change).items() if value}
+        file.write(json.dumps(record, sort_keys=True, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def read_user_plan(file: IO[str]) -> Iterator[UserChange]:
+    """Read account changes written by write_user_plan."""
+    header = json.loads(file.readline() or "{}")
+    if header.get("version") != USER_PLAN_VERSION:
+        raise ValueError("Unsupported plan version: %s" % header.get("version"))
+    for line in file:
+        if line.strip():
+            record: Dict[str, Any] = json.loads(line)
+            if record.get("action") not in ACTIONS:
+                raise ValueError("Unknown action: %s" % record.get("action"))
+            yield UserChange(**record)
@@ -1,3 +1,24 @@
 """Implement acceess to Scoutnet."""
-from .mailinglists import ScoutnetMailinglist, ScoutnetMailinglistApi
-from .users import ScoutnetUser, ScoutnetUsersApi
+import importlib
+from typing import Any
+from .records import SLOTS
+from .addresses import AddressNormalizer, NORMALIZER, parse_rewrites
+
+# The API clients pull in requests, import them on first use
+_LAZY = {
+    'ScoutnetMailinglist': 'mailinglists',
+    'ScoutnetMailinglistApi': 'mailinglists',
+    'ScoutnetUser': 'users',
+    'ScoutnetUsersApi': 'users',
+    'UserSet': 'users',
+    'user_filter': 'users',
+}
+
+
+def __getattr__(name: str) -> Any:
+    """Import API clients when they are first used."""
+    if name in _LAZY:
+        module = importlib.import_module('.' + _LAZY[name], __name__)
+        return getattr(module, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__,
+                                                                   name))
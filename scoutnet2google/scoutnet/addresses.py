@@ -0,0 +1,98 @@
+"""Normalization of e-mail addresses, shared by Scoutnet and Google."""
+import re
+import sys
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Pattern, Tuple
+
+# Rewrites applied to Scoutnet addresses before they are added to Google
+DEFAULT_REWRITES = [(r'^(.+)@googlemail\.com$', r'\1@gmail.com')]
+# A +tag runs from a '+' up to the '@', as it always has been stripped
+PLUS_TAG = re.compile(r'\+[^@]+')
+
+
+def parse_rewrites(text: str) -> List[Tuple[str, str]]:
+    """Parse rewrite rules, one "pattern replacement" pair per line."""
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        (pattern, _, replacement) = line.partition(' ')
+        rules.append((pattern, replacement.strip()))
+    return rules
+
+
+class AddressNormalizer(object):
+    """Precompiled, memoizing pipeline for e-mail addresses.
+
+    normalize() lowercases an address and converts its domain to IDNA,
+    which Google considers the same address. canonical() additionally
+    applies the rewrite rules and then strips +tags, giving the form that
+    is added to Google. Like before, a leading +tag is stripped too, so
+    +x@a.se becomes @a.se. Every distinct spelling is processed once and all
+    results are interned, so equal addresses share one string.
+    """
+
+    def __init__(self, rewrites: Iterable[Tuple[str, str]] = DEFAULT_REWRITES,
+                 strip_plus: bool = True) -> None:
+        """Initialize."""
+        self.lock = threading.Lock()
+        self.configure(rewrites, strip_plus)
+
+    def configure(self, rewrites: Iterable[Tuple[str, str]],
+                  strip_plus: bool = True) -> None:
+        """Replace the rewrite rules, forgetting earlier results."""
+        compiled: List[Tuple[Pattern[str], str]] = [
+            (re.compile(pattern), replacement)
+            for (pattern, replacement) in rewrites]
+        with self.lock:
+            self.rewrites = compiled
+            self.strip_plus = strip_plus
+            # Plain dict operations are atomic, worker threads may share them
+            self.normalized: Dict[str, str] = {}
+            self.canonicals: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        """Return number of known spellings."""
+        return len(self.normalized) + len(self.canonicals)
+
+    def normalize(self, address: str) -> str:
+        """Return an address lowercased and with an IDNA domain."""
+        try:
+            return self.normalized[address]
+        except KeyError:
+            pass
+        (local, at, domain) = address.strip().lower().rpartition('@')
+        if at:
+            try:
+                domain = domain.encode('idna').decode('ascii')
+            except UnicodeError:
+                pass
+        result = sys.intern(local + at + domain if at else domain)
+        result = self.normalized.setdefault(result, result)
+        self.normalized[address] = result
+        return result
+
+    def canonical(self, address: str) -> str:
+        """Return the form of an address used as a Google group member."""
+        try:
+            return self.canonicals[address]
+        except KeyError:
+            pass
+        result = self.normalize(address)
+        for (pattern, replacement) in self.rewrites:
+            result = pattern.sub(replacement, result)
+        if self.strip_plus:
+            result = PLUS_TAG.sub('', result)
+        result = sys.intern(result)
+        # Canonical forms map to themselves, also after rewriting
+        result = self.canonicals.setdefault(result, result)
+        self.canonicals[address] = result
+        return result
+
+    def canonical_all(self, addresses: Iterable[str]) -> FrozenSet[str]:
+        """Return the canonical forms of addresses as a frozenset."""
+        return frozenset(self.canonical(address) for address in addresses)
+
+
+NORMALIZER = AddressNormalizer()
@@ -0,0 +1,239 @@
+"""On-disk response cache for the Scoutnet API."""
+import os
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import time
+import requests
+from typing import IO, Any, Dict, Optional, Tuple
+from appdirs import AppDirs
+
+
+DIRS = AppDirs('Scoutnet2Google', 'scoutnet2google')
+CACHE_DIR = os.path.join(DIRS.user_cache_dir, 'scoutnet')
+DEFAULT_MAX_AGE = 300
+DEFAULT_MAX_CONNECTIONS = 8
+CHUNK_SIZE = 65536
+
+_adapters: Dict[int, requests.adapters.HTTPAdapter] = {}
+_adapters_lock = threading.Lock()
+
+
+class CachingSession(requests.Session):
+    """Session caching GET responses on disk.
+
+    Responses carrying an ETag or Last-Modified header are revalidated
+    with a conditional GET, other responses are reused while younger than
+    max_age seconds. Every response gets the attributes from_cache,
+    unchanged (same content as the previous fetch) and content_hash.
+    The cache directory and its files are accessible by the owner only.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR,
+                 max_age: int = DEFAULT_MAX_AGE) -> None:
+        """Initialize."""
+        super().__init__()
+        self.directory = directory
+        self.max_age = max_age
+        self.logger = logging.getLogger(__name__)
+
+    def _key(self, url: str) -> str:
+        # Include the api id, the same url serves different groups
+        auth_id = self.auth[0] if isinstance(self.auth, tuple) else ''
+        return hashlib.sha256('{} {}'.format(auth_id, url).encode(
+            'utf-8')).hexdigest()
+
+    def _load(self, key: str, read_body: bool = True
+              ) -> Optional[Dict[str, Any]]:
+        """Load cached metadata, and the body unless read_body is False."""
+        digest = hashlib.sha256()
+        body = []
+        try:
+            with open(os.path.join(self.directory, key + '.json'), 'rt') as file:
+                meta = json.load(file)
+            with open(os.path.join(self.directory, key + '.body'), 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    if read_body:
+                        body.append(chunk)
+        except (OSError, ValueError):
+            return None
+        if digest.hexdigest() != meta.get('sha256'):
+            return None
+        if read_body:
+            meta['body'] = b''.join(body)
+        return meta
+
+    def _makedirs(self) -> None:
+        # The memberlist holds personal data, only the owner may read it
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if os.stat(self.directory).st_mode & 0o077:
+            os.chmod(self.directory, 0o700)
+
+    def _write(self, filename: str, data: bytes) -> None:
+        # mkstemp creates the file readable by the owner only
+        (fd, tmpname) = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmpname, os.path.join(self.directory, filename))
+
+    def _store(self, key: str, response: requests.Response) -> None:
+        meta = {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time(),
+            'sha256': hashlib.sha256(response.content).hexdigest(),
+        }
+        try:
+            self._makedirs()
+            self._write(key + '.body', response.content)
+            self._write(key + '.json', json.dumps(meta).encode('utf-8'))
+        except OSError as exc:
+            self.logger.warning("Failed to cache response: %s", str(exc))
+
+    def _cached_response(self, url: str, meta: Dict[str, Any]) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        if 'body' in meta:
+            response._content = meta['body']
+        response.encoding = 'utf-8'
+        response.from_cache = True  # type: ignore
+        response.unchanged = True  # type: ignore
+        response.content_hash = meta['sha256']  # type: ignore
+        return response
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:  # type: ignore
+        """Get url, using the cache when possible."""
+        key = self._key(url)
+        meta = self._load(key)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta is not None:
+            validated = meta.get('etag') or meta.get('last_modified')
+            if not validated and time.time() - meta['fetched'] < self.max_age:
+                self.logger.debug("Using cached response for %s", url)
+                return self._cached_response(url, meta)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = super().get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and meta is not None:
+            self.logger.debug("Response for %s not modified", url)
+            return self._cached_response(url, meta)
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        response.from_cache = False  # type: ignore
+        response.unchanged = (meta is not None  # type: ignore
+                              and meta['sha256'] == content_hash)
+        response.content_hash = content_hash  # type: ignore
+        if response.status_code == 200:
+            self._store(key, response)
+        return response
+
+    def get_stream(self, url: str, **kwargs: Any
+                   ) -> Tuple[requests.Response, Optional[IO[bytes]]]:
+        """Get url like get(), returning the body as an open binary file.
+
+        A fetched body is written to the cache file chunk by chunk and
+        read back from there, so it is never held in memory as a whole.
+        The response itself has no content. The file is None if the
+        request failed.
+        """
+        key = self._key(url)
+        meta = self._load(key, read_body=False)
+        body_file = os.path.join(self.directory, key + '.body')
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta is not None:
+            validated = meta.get('etag') or meta.get('last_modified')
+            if not validated and time.time() - meta['fetched'] < self.max_age:
+                self.logger.debug("Using cached response for %s", url)
+                return (self._cached_response(url, meta), open(body_file, 'rb'))
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = super().get(url, headers=headers, stream=True, **kwargs)
+        if response.status_code == 304 and meta is not None:
+            self.logger.debug("Response for %s not modified", url)
+            response.close()
+            return (self._cached_response(url, meta), open(body_file, 'rb'))
+        if response.status_code != 200:
+            return (response, None)
+        self._makedirs()
+        digest = hashlib.sha256()
+        size = 0
+        (fd, tmpname) = tempfile.mkstemp(dir=self.directory)
+        try:
+            with response, os.fdopen(fd, 'wb') as file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(tmpname, body_file)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        response.from_cache = False  # type: ignore
+        response.unchanged = (meta is not None  # type: ignore
+                              and meta['sha256'] == digest.hexdigest())
+        response.content_hash = digest.hexdigest()  # type: ignore
+        response.streamed_bytes = size  # type: ignore
+        stored = {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time(),
+            'sha256': digest.hexdigest(),
+        }
+        self._write(key + '.json', json.dumps(stored).encode('utf-8'))
+        return (response, open(body_file, 'rb'))
+
+
+def transferred(response: requests.Response) -> int:
+    """Return the number of body bytes received over the network."""
+    if getattr(response, 'from_cache', False):
+        return 0
+    if hasattr(response, 'streamed_bytes'):
+        # Streamed to the cache by get_stream
+        return response.streamed_bytes
+    if not response._content_consumed:
+        # Streaming, the body has not been read yet
+        return int(response.headers.get('Content-Length', 0))
+    return len(response.content)
+
+
+def shared_adapter(max_connections: int = DEFAULT_MAX_CONNECTIONS
+                   ) -> requests.adapters.HTTPAdapter:
+    """Return the adapter pooling connections for all sessions.
+
+    Sessions of the lists and users APIs, and of all tenants, reuse the
+    same keep-alive connections. At most max_connections requests are
+    in flight per host, further requests wait for a free connection.
+    """
+    with _adapters_lock:
+        adapter = _adapters.get(max_connections)
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_connections,
+                pool_block=True)
+            _adapters[max_connections] = adapter
+        return adapter
+
+
+def make_session(api_id: str, api_key: str,
+                 cache_max_age: Optional[int] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS
+                 ) -> requests.Session:
+    """Create an authenticated session, caching if cache_max_age is set."""
+    if cache_max_age is not None:
+        session: requests.Session = CachingSession(max_age=cache_max_age)
+    else:
+        session = requests.Session()
+    session.auth = (api_id, api_key)
+    adapter = shared_adapter(max(1, max_connections))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
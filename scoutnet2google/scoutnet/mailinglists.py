@@ -3,16 +3,22 @@ import os
 import requests
 import logging
 import json
-from typing import List, Any, Dict
+from typing import List, Any, Dict, FrozenSet, Iterable, Iterator, Optional
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from appdirs import AppDirs
+from .http_cache import DEFAULT_MAX_CONNECTIONS, make_session, transferred
+from .addresses import NORMALIZER
+from .records import SLOTS
+from ..metrics import METRICS
 
 
 DIRS = AppDirs('Scoutnet2Google', 'scoutnet2google')
 DEFAULT_CONFIG_FILE = os.path.join(DIRS.user_config_dir, 'scoutnet2google.ini')
+DEFAULT_WORKERS = 1
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTS)
 class ScoutnetMailinglist:
     """Hold information about a Scoutnet mailinglist."""
 
@@ -20,31 +26,46 @@ class ScoutnetMailinglist:
     title: str = None
     description: str = None
     aliases: List[str] = field(default_factory=list)
-    members: List[str] = field(default_factory=list)
+    members: FrozenSet[str] = frozenset()
 
 
 class ScoutnetMailinglistApi(object):
     """Access Scoutnet mailinglists api."""
 
     def __init__(self, api_endpoint: str, api_id: str, api_key: str,
-                 domain: str) -> None:
+                 domain: str, workers: int = DEFAULT_WORKERS,
+                 cache_max_age: Optional[int] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS) -> None:
         """Initialize."""
         self.endpoint = api_endpoint
-        self.session = requests.Session()
-        self.session.auth = (api_id, api_key)
+        self.workers = max(1, workers)
+        self.session = make_session(api_id, api_key, cache_max_age,
+                                    max_connections)
         self.domain = domain
+        # Keys of the lists that failed in the last fetch
+        self.failed: List[str] = []
         self.logger = logging.getLogger(__name__)
 
     def customlists(self) -> Any:
         """Get the configured customlists."""
-        response = self.session.get('{}/group/customlists'.format(
-            self.endpoint))
+        with METRICS.timer('scoutnet.customlists'):
+            response = self.session.get('{}/group/customlists'.format(
+                self.endpoint))
+            response.raise_for_status()
+        METRICS.add_bytes('scoutnet.customlists', transferred(response))
         return response.json()
 
     def get_list(self, list_data: dict) -> ScoutnetMailinglist:
         """Get information about a list."""
         url = list_data.get('link')
-        response = self.session.get(url).json()
+        with METRICS.timer('scoutnet.customlist'):
+            http_response = self.session.get(url)
+            http_response.raise_for_status()
+        METRICS.add_bytes('scoutnet.customlist', transferred(http_response))
+        if getattr(http_response, 'unchanged', False):
+            self.logger.debug("List %s unchanged since last fetch",
+                              list_data.get('list_email_key'))
+        response = http_response.json()
         email_addresses = set()
         data: Dict[str, Any] = response.get('data')
         title = list_data.get('title')
@@ -52,7 +73,7 @@ class ScoutnetMailinglistApi(object):
             for (_, member_data) in data.items():
                 if 'email' in member_data:
                     email = member_data['email']['value']
-                    email_addresses.add(email.lower())
+                    email_addresses.add(NORMALIZER.canonical(email))
                 else:
                     email = None
                 self.logger.debug("Adding member %s (%s %s) to list \"%s\"",
@@ -63,7 +84,7 @@ class ScoutnetMailinglistApi(object):
                 if 'extra_emails' in member_data:
                     extra_emails = member_data['extra_emails']['value']
                     for extra_mail in extra_emails:
-                        email_addresses.add(extra_mail.lower())
+                        email_addresses.add(NORMALIZER.canonical(extra_mail))
                         self.logger.debug("Additional address %s for user %s",
                                           extra_mail, email)
         list_aliases = list_data.get('aliases', {})
@@ -75,25 +96,58 @@ class ScoutnetMailinglistApi(object):
                 else:
                     self.logger.error("Invalid domain in alias: %s", alias)
         return ScoutnetMailinglist(id=list_data['list_email_key'],
-                                   members=list(email_addresses),
+                                   members=frozenset(email_addresses),
                                    aliases=aliases,
                                    title=title,
                                    description=list_data.get('description'))
 
-    def get_all_lists(self, limit: int = None) -> List[ScoutnetMailinglist]:
-        """Fetch all mailing lists from Scoutnet."""
-        all_lists = []
-        count = 0
-        for (clist, cdata) in self.customlists().items():
-            count += 1
-            mlist = self.get_list(cdata)
+    def _fetch_list(self, list_data: dict) -> Optional[ScoutnetMailinglist]:
+        """Get a list, reporting (not raising) fetch errors."""
+        if not isinstance(list_data, dict):
+            self.logger.error("Invalid list in customlists: %r", list_data)
+            self.failed.append(str(list_data))
+            return None
+        try:
+            return self.get_list(list_data)
+        except Exception as exc:
+            self.logger.debug("Exception: %s", str(exc))
+            self.logger.error("Failed to fetch list %s: %s",
+                              list_data.get('list_email_key'),
+                              list_data.get('title'))
+            self.failed.append(list_data.get('list_email_key'))
+            return None
+
+    def iter_lists(self, limit: int = None) -> Iterator[ScoutnetMailinglist]:
+        """Yield the mailing lists with aliases as they are fetched.
+
+        Lists that fail are skipped and their keys collected in failed.
+        """
+        self.failed = []
+        customlists = list(self.customlists().values())
+        if limit is not None:
+            customlists = customlists[:limit]
+        if self.workers > 1 and len(customlists) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                yield from self._included(executor.map(self._fetch_list,
+                                                        customlists))
+        else:
+            yield from self._included(self._fetch_list(cdata)
+                                      for cdata in customlists)
+
+    def _included(self, fetched: Iterable[Optional[ScoutnetMailinglist]]
+                  ) -> Iterator[ScoutnetMailinglist]:
+        """Log fetched lists, yield those with aliases."""
+        for mlist in fetched:
+            if mlist is None:
+                continue
             self.logger.info("Fetched %s: %s (%d members)",
                              mlist.id, mlist.title, len(mlist.members))
             if len(mlist.aliases) > 0:
                 self.logger.debug("Including %s: %s", mlist.id, mlist.title)
-                all_lists.append(mlist)
+                yield mlist
             else:
                 self.logger.debug("Excluding %s: %s", mlist.id, mlist.title)
-            if limit is not None and count >= limit:
-                break
-        return all_lists
+
+    def get_all_lists(self, limit: int = None) -> List[ScoutnetMailinglist]:
+        """Fetch all mailing lists from Scoutnet."""
+        return list(self.iter_lists(limit))
@@ -0,0 +1,6 @@
+"""Compact storage for records."""
+import sys
+
+# Keyword arguments making dataclasses use __slots__ where supported
+SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
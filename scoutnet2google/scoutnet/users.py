@@ -1,18 +1,30 @@
 """Implements interface to Scoutnet mailinglists."""
 import os
+import sys
 import requests
 import logging
 import json
-from typing import List, Any, Dict
+from typing import List, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 from dataclasses import dataclass, field
 from appdirs import AppDirs
 import functools
+import itertools
 from dateutil.relativedelta import relativedelta
 import datetime
+from .http_cache import (DEFAULT_MAX_CONNECTIONS, CachingSession,
+                         make_session, transferred)
+from .records import SLOTS
+from ..metrics import METRICS
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 DIRS = AppDirs('Scoutnet2Google', 'scoutnet2google')
 DEFAULT_CONFIG_FILE = os.path.join(DIRS.user_config_dir, 'scoutnet2google.ini')
+ADULT_AGE = 18
 
 
 class lazy_property(object):
@@ -36,7 +48,7 @@ class lazy_property(object):
         return value
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTS)
 class ScoutnetUser:
     """Hold information about a Scoutnet user."""
 
@@ -56,43 +68,77 @@ class ScoutnetUser:
 class ScoutnetUsersApi(object):
     """Access Scoutnet users api."""
 
-    def __init__(self, api_endpoint: str, api_id: str, api_key: str) -> None:
+    def __init__(self, api_endpoint: str, api_id: str, api_key: str,
+                 cache_max_age: Optional[int] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS) -> None:
         """Initialize."""
         self.endpoint = api_endpoint
-        self.session = requests.Session()
-        self.session.auth = (api_id, api_key)
+        self.session = make_session(api_id, api_key, cache_max_age,
+                                    max_connections)
         self.logger = logging.getLogger(__name__)
 
     def memberlist(self) -> Any:
         """Get the configured users."""
-        response = self.session.get('{}/group/memberlist'.format(
-            self.endpoint))
-        response.raise_for_status()
+        with METRICS.timer('scoutnet.memberlist'):
+            response = self.session.get('{}/group/memberlist'.format(
+                self.endpoint))
+            response.raise_for_status()
+        METRICS.add_bytes('scoutnet.memberlist', transferred(response))
         return response.json()['data']
 
+    def iter_memberlist(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Parse the configured users incrementally, if ijson is available."""
+        if ijson is None:
+            self.logger.debug("ijson not installed, parsing memberlist at once")
+            yield from self.memberlist().items()
+            return
+        url = '{}/group/memberlist'.format(self.endpoint)
+        with METRICS.timer('scoutnet.memberlist'):
+            if isinstance(self.session, CachingSession):
+                # Streamed to the cache file, and parsed from there
+                (response, stream) = self.session.get_stream(url)
+            else:
+                response = self.session.get(url, stream=True)
+                response.raw.decode_content = True
+                stream = response.raw
+            response.raise_for_status()
+        METRICS.add_bytes('scoutnet.memberlist', transferred(response))
+        try:
+            yield from ijson.kvitems(stream, 'data')
+        finally:
+            stream.close()
+            if response.raw is not None:
+                response.close()
+
+    def iter_users(self, units: Iterable[str] = None,
+                   roles: Iterable[str] = None, min_age: int = None,
+                   max_age: int = None) -> Iterator[ScoutnetUser]:
+        """Fetch users from Scoutnet, keeping only matching users."""
+        match = user_filter(units, roles, min_age, max_age)
+        for (_, cdata) in self.iter_memberlist():
+            user = parse_user(cdata)
+            if match(user):
+                yield user
+
+    def partition(self, *matches: Callable[[ScoutnetUser], bool]
+                  ) -> List['UserSet']:
+        """Select users into one set per predicate, in one streaming pass.
+
+        A user goes into the set of the first predicate it matches. Users
+        matching none are never kept in memory.
+        """
+        selected: List[List[ScoutnetUser]] = [[] for _ in matches]
+        for (_, cdata) in self.iter_memberlist():
+            user = parse_user(cdata)
+            for (match, users) in zip(matches, selected):
+                if match(user):
+                    users.append(user)
+                    break
+        return [UserSet(users) for users in selected]
+
     def get_all_users(self) -> List[ScoutnetUser]:
         """Fetch all users from Scoutnet."""
-        users = []
-        for (clist, cdata) in self.memberlist().items():
-            def get_value(data, key):
-                if key in data:
-                    return data[key]['value']
-                else:
-                    return None
-            users.append(
-                ScoutnetUser(
-                    get_value(cdata, 'member_no'),
-                    first_name=get_value(cdata, 'first_name'),
-                    last_name=get_value(cdata, 'last_name'),
-                    email_primary=get_value(cdata, 'email'),
-                    email_alternate=get_value(cdata, 'contact_alt_email'),
-                    email_dad=get_value(cdata, 'contact_email_dad'),
-                    email_mum=get_value(cdata, 'contact_email_mum'),
-                    unit=get_value(cdata, 'unit'),
-                    mobile=get_value(cdata, 'contact_mobile_phone'),
-                    date_of_birth=get_value(cdata, 'date_of_birth'),
-                    role=get_value(cdata, 'group_role')))
-        return users
+        return list(self.iter_users())
 
     @lazy_property
     def all_users(self):
@@ -102,25 +148,181 @@ class ScoutnetUsersApi(object):
     @lazy_property
     def all_adults(self):
         """All users at least 18 years of age."""
-        adults = []
+        return self.select(min_age=ADULT_AGE).list()
+
+    @lazy_property
+    def by_member_no(self) -> Dict[str, ScoutnetUser]:
+        """Users indexed by member number."""
+        return {user.member_no: user for user in self.all_users}
+
+    @lazy_property
+    def by_unit(self) -> Dict[str, List[ScoutnetUser]]:
+        """Users indexed by unit."""
+        index: Dict[str, List[ScoutnetUser]] = {}
+        for user in self.all_users:
+            index.setdefault(user.unit, []).append(user)
+        return index
+
+    @lazy_property
+    def by_role(self) -> Dict[str, List[ScoutnetUser]]:
+        """Users indexed by each of their group roles."""
+        index: Dict[str, List[ScoutnetUser]] = {}
+        for user in self.all_users:
+            for role in user_roles(user):
+                index.setdefault(role, []).append(user)
+        return index
+
+    @lazy_property
+    def by_age(self) -> Dict[int, List[ScoutnetUser]]:
+        """Users indexed by age in years."""
+        index: Dict[int, List[ScoutnetUser]] = {}
         today = datetime.date.today()
         for user in self.all_users:
-            bday = datetime.datetime.strptime(user.date_of_birth, '%Y-%m-%d')
-            age = relativedelta(today, bday).years
-            if age >= 18:
-                adults.append(user)
-        return adults
+            index.setdefault(user_age(user, today), []).append(user)
+        return index
+
+    def select(self, units: Iterable[str] = None, roles: Iterable[str] = None,
+               min_age: int = None, max_age: int = None) -> 'UserSet':
+        """Select users by unit, role and age using the indexes."""
+        if units is not None:
+            result = UserSet(user for unit in units
+                             for user in self.by_unit.get(unit, []))
+        elif roles is not None:
+            result = UserSet(user for role in roles
+                             for user in self.by_role.get(role, []))
+            roles = None
+        elif min_age is not None or max_age is not None:
+            result = UserSet(user for (age, users) in self.by_age.items()
+                             if (min_age is None or age >= min_age)
+                             and (max_age is None or age <= max_age)
+                             for user in users)
+            min_age = max_age = None
+        else:
+            result = UserSet(self.all_users)
+        return result.filter(roles=roles, min_age=min_age, max_age=max_age)
 
     def all_unit_members(self, unit):
         """All users who belong to a unit."""
-        members = []
-        for user in self.all_users:
-            if user.unit == unit:
-                members.append(user)
-
-        return members
+        return list(self.by_unit.get(unit, []))
 
     def subtract_list(self, source, substract):
         """Subtract members from subtract from source."""
-        submembers = [member.member_no for member in substract]
-        return [member for member in source if member.member_no not in submembers]
\ No newline at end of file
+        return (UserSet(source) - UserSet(substract)).list()
+
+
+def parse_user(cdata: Dict[str, Any]) -> ScoutnetUser:
+    """Create a user from a memberlist entry."""
+    def get_value(data, key):
+        if key in data:
+            return data[key]['value']
+        else:
+            return None
+
+    def get_shared(data, key):
+        # Units and roles repeat across users, keep one copy of each
+        value = get_value(data, key)
+        return sys.intern(value) if isinstance(value, str) else value
+    return ScoutnetUser(
+        get_value(cdata, 'member_no'),
+        first_name=get_value(cdata, 'first_name'),
+        last_name=get_value(cdata, 'last_name'),
+        email_primary=get_value(cdata, 'email'),
+        email_alternate=get_value(cdata, 'contact_alt_email'),
+        email_dad=get_value(cdata, 'contact_email_dad'),
+        email_mum=get_value(cdata, 'contact_email_mum'),
+        unit=get_shared(cdata, 'unit'),
+        mobile=get_value(cdata, 'contact_mobile_phone'),
+        date_of_birth=get_value(cdata, 'date_of_birth'),
+        role=get_shared(cdata, 'group_role'))
+
+
+def user_filter(units: Iterable[str] = None, roles: Iterable[str] = None,
+                min_age: int = None,
+                max_age: int = None) -> Callable[[ScoutnetUser], bool]:
+    """Return a predicate matching users on unit, role and age."""
+    unit_set = set(units) if units is not None else None
+    role_set = set(roles) if roles is not None else None
+    today = datetime.date.today()
+
+    def match(user: ScoutnetUser) -> bool:
+        if unit_set is not None and user.unit not in unit_set:
+            return False
+        if role_set is not None and role_set.isdisjoint(user_roles(user)):
+            return False
+        if min_age is not None or max_age is not None:
+            age = user_age(user, today)
+            if min_age is not None and age < min_age:
+                return False
+            if max_age is not None and age > max_age:
+                return False
+        return True
+
+    return match
+
+
+def user_roles(user: ScoutnetUser) -> List[str]:
+    """Return the group roles of a user."""
+    if not user.role:
+        return []
+    return [role.strip() for role in user.role.split(',') if role.strip()]
+
+
+def user_age(user: ScoutnetUser, today: datetime.date = None) -> int:
+    """Return the age of a user in years."""
+    return _age(user.date_of_birth, today or datetime.date.today())
+
+
+@functools.lru_cache(maxsize=None)
+def _age(date_of_birth: str, today: datetime.date) -> int:
+    bday = datetime.datetime.strptime(date_of_birth, '%Y-%m-%d')
+    return relativedelta(today, bday).years
+
+
+class UserSet(object):
+    """Ordered set of Scoutnet users keyed by member number."""
+
+    def __init__(self, users: Iterable[ScoutnetUser] = ()) -> None:
+        """Initialize."""
+        self.users: Dict[str, ScoutnetUser] = {}
+        for user in users:
+            self.users.setdefault(user.member_no, user)
+
+    def __iter__(self) -> Iterator[ScoutnetUser]:
+        """Iterate over users."""
+        return iter(self.users.values())
+
+    def __len__(self) -> int:
+        """Return number of users."""
+        return len(self.users)
+
+    def __contains__(self, user: object) -> bool:
+        """Check if a user is in the set."""
+        return getattr(user, 'member_no', None) in self.users
+
+    def __or__(self, other: Iterable[ScoutnetUser]) -> 'UserSet':
+        """Return the union of two sets."""
+        return UserSet(itertools.chain(self, other))
+
+    def __sub__(self, other: Iterable[ScoutnetUser]) -> 'UserSet':
+        """Return users not in other."""
+        exclude = set(user.member_no for user in other)
+        return UserSet(user for user in self if user.member_no not in exclude)
+
+    def __and__(self, other: Iterable[ScoutnetUser]) -> 'UserSet':
+        """Return users in both sets."""
+        include = set(user.member_no for user in other)
+        return UserSet(user for user in self if user.member_no in include)
+
+    union = __or__
+    difference = __sub__
+    intersection = __and__
+
+    def filter(self, units: Iterable[str] = None, roles: Iterable[str] = None,
+               min_age: int = None, max_age: int = None) -> 'UserSet':
+        """Return users matching all given criteria."""
+        match = user_filter(units, roles, min_age, max_age)
+        return UserSet(user for user in self if match(user))
+
+    def list(self) -> List[ScoutnetUser]:
+        """Return users as a list."""
+        return list(self.users.values())
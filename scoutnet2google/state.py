@@ -0,0 +1,133 @@
+"""Keep track of the last synchronized state of Google groups."""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Set
+from dataclasses import dataclass, field
+from scoutnet2google.manage_config import DIRS, open_private
+from scoutnet2google.scoutnet import SLOTS
+
+DEFAULT_STATE_FILE = os.path.join(DIRS.user_cache_dir, "state.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    address TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    title TEXT,
+    description TEXT,
+    aliases TEXT NOT NULL,
+    members TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+@dataclass(frozen=True, **SLOTS)
+class GroupState:
+    """Hold the last applied state of a Google group."""
+
+    address: str
+    content_hash: str
+    title: str = None
+    description: str = None
+    aliases: List[str] = field(default_factory=list)
+    members: List[str] = field(default_factory=list)
+    updated: float = 0.0
+
+
+class SyncState(object):
+    """Persistent store of applied group state."""
+
+    def __init__(self, filename: str = DEFAULT_STATE_FILE) -> None:
+        """Open (and create) the state database, readable by the owner only."""
+        if filename != ":memory:":
+            # SQLite gives its journal files the mode of the database
+            os.close(open_private(filename, os.O_RDWR))
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.logger = logging.getLogger(__name__)
+
+    def get(self, address: str) -> Optional[GroupState]:
+        """Get the last applied state of a group."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT address, content_hash, title, description, aliases, "
+                "members, updated FROM groups WHERE address = ?",
+                (address,),
+            ).fetchone()
+        if row is None:
+            return None
+        return GroupState(
+            address=row[0],
+            content_hash=row[1],
+            title=row[2],
+            description=row[3],
+            aliases=json.loads(row[4]),
+            members=json.loads(row[5]),
+            updated=row[6],
+        )
+
+    def store(self, group: GroupState) -> None:
+        """Record the applied state of a group."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO groups VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    group.address,
+                    group.content_hash,
+                    group.title,
+                    group.description,
+                    json.dumps(sorted(group.aliases)),
+                    json.dumps(sorted(group.members)),
+                    group.updated or time.time(),
+                ),
+            )
+
+    def remove(self, address: str) -> None:
+        """Forget a group, forcing it to be read from Google next time."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM groups WHERE address = ?", (address,))
+
+    def addresses(self) -> Set[str]:
+        """Return addresses of all known groups."""
+        with self.lock:
+            rows = self.connection.execute("SELECT address FROM groups").fetchall()
+        return set(row[0] for row in rows)
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value)
+            )
+
+    def reconcile_due(self, interval_days: float) -> bool:
+        """Check if a full reconciliation with Google is due."""
+        last = self._get_meta("last_full_reconcile")
+        if last is None:
+            self.logger.info("No previous full reconciliation, doing one now")
+            return True
+        return time.time() - float(last) >= interval_days * 86400
+
+    def mark_reconciled(self) -> None:
+        """Record that a full reconciliation has completed."""
+        self._set_meta("last_full_reconcile", str(time.time()))
+
+    def close(self) -> None:
+        """Close the state database."""
+        self.connection.close()
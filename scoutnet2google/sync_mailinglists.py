@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 """Synchronize mailinglists in Scoutnet with Google groups."""
 
-from typing import List, Any
+from typing import TYPE_CHECKING
+from typing import List, Any, Callable, Dict, FrozenSet, Optional, Set, Tuple
 import argparse
+import hashlib
 import json
 import logging
 import re
 import sys
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-import googleapiclient.discovery
-import google.auth.compute_engine
-from scoutnet2google.google_auth_installed import google_auth_installed
-from scoutnet2google.scoutnet import ScoutnetMailinglistApi, ScoutnetMailinglist
+from googleapiclient.errors import HttpError
+from scoutnet2google.google_service import build_service, clone_service
+from scoutnet2google.google_service import REQUEST_FIELDS
+from scoutnet2google.lazy import lazy_import
+from scoutnet2google.scoutnet import NORMALIZER, SLOTS, parse_rewrites
 from scoutnet2google.manage_config import S2g_config, DIRS
+from scoutnet2google.state import SyncState, GroupState, DEFAULT_STATE_FILE
+from scoutnet2google.plan import GroupPlan, read_plan, write_plan
+from scoutnet2google.export import Exporter, FORMATS, check_export, list_record
+from scoutnet2google.executor import RequestExecutor, TokenBucket
+from scoutnet2google.executor import is_conflict, is_not_found
+from scoutnet2google.journal import Journal, INFO_OP, alias_op, member_op
+from scoutnet2google.journal import DEFAULT_JOURNAL_FILE
+from scoutnet2google.metrics import METRICS
+
+if TYPE_CHECKING:
+    from scoutnet2google.scoutnet import ScoutnetMailinglist, ScoutnetMailinglistApi
 
 DEFAULT_CONFIG_GOOGLE = {
     "auth": "standalone",
@@ -27,214 +43,779 @@ API_VERSION = "directory_v1"
 
 CLIENT_SECRETS_FILE = os.path.join(DIRS.user_config_dir, "client_secret.json")
 CLIENT_TOKEN_FILE = os.path.join(DIRS.user_config_dir, "client_token.json")
-MAX_RESULTS = 100
-CREATE_NAP = 10
+BATCH_SIZE = 1000  # Admin SDK limit of calls per batch request
+CREATE_POLL_TIMEOUT = 60
 SCOUTNET_RE_FILTER = ".*\\(Scoutnet\\)$"
 SCOUTNET_TAG = "(Scoutnet)"
 
-EMAIL_REWRITES = [(r"^(.+)@googlemail\.com$", r"\\1@gmail.com")]
-
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTS)
 class GoogleGroup:
     """Hold information about a Google group."""
 
     address: str
     aliases: List[str] = field(default_factory=list)
-    members: List[str] = field(default_factory=list)
+    members: FrozenSet[str] = frozenset()
     title: str = None
     description: str = None
 
 
+@dataclass(frozen=True, **SLOTS)
+class MemberChange:
+    """Hold a member to add to or remove from a Google group."""
+
+    action: str  # "add" or "remove"
+    group_key: str
+    member_key: str
+
+
+@dataclass(frozen=True)
+class GroupSyncResult:
+    """Hold the outcome of synchronizing a Google group."""
+
+    address: str
+    members_changed: int = 0
+    members_failed: int = 0
+    error: Optional[str] = None
+    skipped: bool = False
+
+
+def group_members(group: GoogleGroup) -> FrozenSet[str]:
+    """Return the members of a group as they are added to Google."""
+    return NORMALIZER.canonical_all(group.members)
+
+
+def already_applied(change: MemberChange, exc: Optional[Exception]) -> bool:
+    """Check if a member change failed only because it was made before."""
+    if exc is None:
+        return False
+    if change.action == "add":
+        return is_conflict(exc)
+    return is_not_found(exc)
+
+
+def member_changes(plan: GroupPlan) -> List[MemberChange]:
+    """Return the member changes of a group plan."""
+    return [
+        MemberChange("add", plan.address, member_key)
+        for member_key in plan.members_add
+    ] + [
+        MemberChange("remove", plan.address, member_key)
+        for member_key in plan.members_remove
+    ]
+
+
+def group_content_hash(group: GoogleGroup) -> str:
+    """Return a hash of the synchronized content of a group."""
+    content = {
+        "address": group.address,
+        "title": group.title,
+        "description": group.description,
+        "aliases": sorted(set(group.aliases)),
+        "members": sorted(group_members(group)),
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
 class GoogleDirectory(object):
     """Access Google group directory."""
 
-    def __init__(self, service: Any, domain: str, readonly: bool = False) -> None:
+    def __init__(
+        self,
+        service: Any,
+        domain: str,
+        readonly: bool = False,
+        workers: int = 1,
+        service_factory: Optional[Callable[[], Any]] = None,
+        state: Optional[SyncState] = None,
+        full_reconcile: bool = True,
+        executor: Optional[RequestExecutor] = None,
+        stagger: float = 0.0,
+        journal: Optional[Journal] = None,
+    ) -> None:
         """Initialize."""
-        self.service = service
+        self.executor = executor or RequestExecutor()
+        self.journal = journal
+        self.stagger = stagger
+        self._stagger_lock = threading.Lock()
+        self._next_start = 0.0
+        self.inventory: Optional[Dict[str, GroupState]] = None
+        self.failed_groups: Set[str] = set()
+        self.state = state
+        self.full_reconcile = full_reconcile or state is None
+        self._service = service
+        self.service_factory = service_factory
+        self._local = threading.local()
         self.domain = domain
         self.readonly = readonly
+        self.workers = max(1, workers) if service_factory is not None else 1
         self.logger = logging.getLogger("GoogleDirectory")
         if self.readonly:
             self.logger = self.logger.getChild("READONLY")
 
-    def sync_groups(self, groups: List[GoogleGroup]) -> None:
-        """Syncronize mailing lists with Google."""
-        self.delete_removed_groups(groups)
+    @property
+    def service(self) -> Any:
+        """Return the service object of the calling thread."""
+        if self.service_factory is None:
+            return self._service
+        if threading.current_thread() is threading.main_thread():
+            return self._service
+        service = getattr(self._local, "service", None)
+        if service is None:
+            # httplib2 is not thread safe, give each worker its own service
+            service = self.service_factory()
+            self._local.service = service
+        return service
+
+    def _map(self, function: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        """Map function over items using the worker pool."""
+        if self.workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(function, items))
+        return [function(item) for item in items]
+
+    def sync_groups(
+        self, groups: List[GoogleGroup], delete_removed: bool = True
+    ) -> List[GroupSyncResult]:
+        """Syncronize mailing lists with Google.
+
+        Groups missing from groups are deleted only if delete_removed is set,
+        which callers clear when some Scoutnet lists could not be fetched.
+        """
+        self.inventory = None
+        self.failed_groups = set()
+        if self.full_reconcile:
+            self.prefetch([group for group in groups if self.needs_plan(group)])
+        if delete_removed:
+            self.delete_removed_groups(groups)
+        else:
+            self.logger.warning("Not deleting any groups, Scoutnet lists are missing")
+        # Groups sharing an address are synchronized in order by one worker
+        queues: Dict[str, List[GoogleGroup]] = {}
+        for group in groups:
+            queues.setdefault(group.address, []).append(group)
+
+        def sync_queue(queue: List[GoogleGroup]) -> List[GroupSyncResult]:
+            return [self.sync_group(group) for group in queue]
+
+        outcome = self._map(sync_queue, list(queues.values()))
+        results = [result for queue_results in outcome for result in queue_results]
+        self.log_summary(results)
+        return results
+
+    def sync_group(self, group: GoogleGroup) -> GroupSyncResult:
+        """Synchronize information, aliases and members of a group."""
+        content_hash = group_content_hash(group)
+        if self.journal is not None and self.journal.is_finished(
+            group.address, content_hash
+        ):
+            self.logger.debug("Group %s finished before, skipping", group.address)
+            return GroupSyncResult(group.address, skipped=True)
+        snapshot = self.snapshot(group.address)
+        if snapshot is not None and snapshot.content_hash == content_hash:
+            self.logger.debug("Group %s unchanged, skipping", group.address)
+            return GroupSyncResult(group.address, skipped=True)
+        self._wait_turn()
+        with METRICS.timer("group.sync", group.address):
+            return self._sync_changed_group(group, content_hash, snapshot)
+
+    def _sync_changed_group(
+        self, group: GoogleGroup, content_hash: str, snapshot: Optional[GroupState]
+    ) -> GroupSyncResult:
+        self.logger.info("Synchronizing group %s", group.address)
+        plan = None
+        if self.journal is not None:
+            plan = self.journal.resume_plan(group.address, content_hash)
+            if plan is not None:
+                self.logger.info("Resuming unfinished group %s", group.address)
+        try:
+            if plan is None:
+                plan = self.plan_group(group, snapshot)
+                if self.journal is not None and not self.readonly:
+                    self.journal.planned(plan, content_hash)
+        except Exception as exc:
+            self.logger.debug("Exception: %s", str(exc))
+            self.logger.error("Failed to synchronize group %s", group.address)
+            self.group_failed(group.address)
+            return GroupSyncResult(group.address, error=str(exc))
+        result = self.apply_group_plan(plan)
+        if result.error is not None or result.members_failed > 0:
+            # Partially applied, re-read the group from Google next time
+            self.group_failed(group.address)
+            return result
+        applied = GroupState(
+            address=group.address,
+            content_hash=content_hash,
+            title=group.title,
+            description=group.description,
+            aliases=list(set(group.aliases)),
+            members=list(group_members(group)),
+        )
+        if self.inventory is not None:
+            self.inventory[group.address] = applied
+        if self.state is not None and not self.readonly:
+            self.state.store(applied)
+        self._journal_finished(group.address, content_hash)
+        return result
+
+    def needs_plan(self, group: GoogleGroup) -> bool:
+        """Check that a group is neither finished nor resumable from the journal."""
+        if self.journal is None:
+            return True
+        content_hash = group_content_hash(group)
+        if self.journal.is_finished(group.address, content_hash):
+            return False
+        return self.journal.resume_plan(group.address, content_hash) is None
+
+    def _journal_done(self, group_key: str, op: str) -> None:
+        """Record a completed mutation in the journal."""
+        if self.journal is not None and not self.readonly:
+            self.journal.completed(group_key, op)
+
+    def _journal_finished(self, group_key: str, content_hash: Optional[str]) -> None:
+        """Record a completed group in the journal."""
+        if self.journal is not None and not self.readonly:
+            self.journal.group_finished(group_key, content_hash)
+
+    def _wait_turn(self) -> None:
+        """Space out the start of group synchronizations by stagger seconds."""
+        if self.stagger <= 0:
+            return
+        with self._stagger_lock:
+            delay = self._next_start - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_start = time.monotonic() + self.stagger
+
+    def changed_groups(self, groups: List[GoogleGroup]) -> List[GoogleGroup]:
+        """Return groups differing from their recorded state."""
+        if self.state is None:
+            return list(groups)
+        changed = []
         for group in groups:
-            self.logger.info("Synchronizing group %s", group.address)
-            self.sync_group_info(group)
-            self.sync_group_aliases(group)
-            self.sync_group_members(group)
+            snapshot = self.state.get(group.address)
+            if snapshot is None or snapshot.content_hash != group_content_hash(group):
+                changed.append(group)
+        return changed
+
+    def snapshot(self, group_key: str) -> Optional[GroupState]:
+        """Return the prefetched or recorded state of a group."""
+        if group_key in self.failed_groups:
+            # Possibly partially applied, neither state is to be trusted
+            return None
+        if self.full_reconcile:
+            if self.inventory is not None:
+                return self.inventory.get(group_key)
+            return None
+        return self.state.get(group_key)
+
+    def prefetch(self, groups: List[GoogleGroup]) -> None:
+        """Read all groups and the members of groups to synchronize."""
+        with METRICS.timer("phase.inventory"):
+            listed = self.list_groups()
+            targets = set(group.address for group in groups)
+            addresses = [
+                entry["email"] for entry in listed if entry["email"] in targets
+            ]
+            members = dict(zip(addresses, self._map(self.get_all_members, addresses)))
+        self.inventory = {
+            entry["email"]: GroupState(
+                address=entry["email"],
+                content_hash="",
+                title=entry.get("name"),
+                description=entry.get("description"),
+                aliases=entry.get("aliases", []),
+                members=members.get(entry["email"], []),
+            )
+            for entry in listed
+        }
+        self.logger.info(
+            "Prefetched %d groups, %d with members", len(listed), len(addresses)
+        )
+
+    def group_failed(self, group_key: str) -> None:
+        """Make later groups with the same address read the group from Google."""
+        self.failed_groups.add(group_key)
+        self.forget_group(group_key)
+
+    def forget_group(self, group_key: str) -> None:
+        """Drop the recorded state of a group."""
+        if self.state is not None and not self.readonly:
+            self.state.remove(group_key)
+
+    def log_summary(self, results: List[GroupSyncResult]) -> None:
+        """Log a combined summary of synchronized groups."""
+        for result in results:
+            if result.skipped:
+                continue
+            if result.error is not None:
+                self.logger.info("  %-40s error: %s", result.address, result.error)
+            else:
+                self.logger.info(
+                    "  %-40s %4d member changes, %4d failed",
+                    result.address,
+                    result.members_changed,
+                    result.members_failed,
+                )
+        self.logger.info(
+            "Synchronized %d groups (%d unchanged): "
+            "%d member changes, %d failed, %d groups failed",
+            len(results),
+            len([result for result in results if result.skipped]),
+            sum(result.members_changed for result in results),
+            sum(result.members_failed for result in results),
+            len([result for result in results if result.error is not None]),
+        )
+
+    def removed_groups(self, groups: List[GoogleGroup]) -> Set[str]:
+        """Find groups that are not in Scoutnet anymore."""
+        if self.full_reconcile and self.inventory is not None:
+            current_groups = set(
+                group_key
+                for (group_key, entry) in self.inventory.items()
+                if re.match(SCOUTNET_RE_FILTER, entry.title or "")
+            )
+        elif self.full_reconcile:
+            current_groups = set(self.get_all_groups(SCOUTNET_RE_FILTER))
+        else:
+            current_groups = self.state.addresses()
+        return current_groups - set([group.address for group in groups])
 
     def delete_removed_groups(self, groups: List[GoogleGroup]) -> None:
         """Delete groups that are not in Scoutnet anymore."""
-        current_groups = set(self.get_all_groups(SCOUTNET_RE_FILTER))
-        old_groups = current_groups - set([group.address for group in groups])
-        for group_key in old_groups:
-            self.logger.info("Deleting group %s", group_key)
-            if not self.readonly:
-                self.service.groups().delete(groupKey=group_key).execute()
+        for group_key in self.removed_groups(groups):
+            self.delete_group(group_key)
 
-    def sync_group_info(self, group: GoogleGroup) -> None:
-        """Update/create group information."""
+    def delete_group(self, group_key: str) -> None:
+        """Delete a group."""
+        self.logger.info("Deleting group %s", group_key)
+        if not self.readonly:
+            try:
+                self.executor.execute(self.service.groups().delete(groupKey=group_key))
+            except HttpError as exc:
+                if not is_not_found(exc):
+                    raise
+                self.logger.info("Group %s already deleted", group_key)
+        self.forget_group(group_key)
+
+    def plan_groups(
+        self, groups: List[GoogleGroup], delete_removed: bool = True
+    ) -> List[GroupPlan]:
+        """Compute the changes needed to synchronize groups."""
+        self.inventory = None
+        self.failed_groups = set()
+        if self.full_reconcile:
+            self.prefetch(groups)
+        plans = []
+        if delete_removed:
+            plans = [
+                GroupPlan(group_key, info="delete")
+                for group_key in sorted(self.removed_groups(groups))
+            ]
+        else:
+            self.logger.warning("Not deleting any groups, Scoutnet lists are missing")
+        # The last group with an address is the one that ends up in Google
+        unique_groups = list({group.address: group for group in groups}.values())
+
+        def plan_changed_group(group: GoogleGroup) -> GroupPlan:
+            snapshot = self.snapshot(group.address)
+            content_hash = group_content_hash(group)
+            if snapshot is not None and snapshot.content_hash == content_hash:
+                return GroupPlan(group.address)
+            return self.plan_group(group, snapshot)
+
+        return plans + self._map(plan_changed_group, unique_groups)
+
+    def plan_group(
+        self, group: GoogleGroup, snapshot: Optional[GroupState] = None
+    ) -> GroupPlan:
+        """Compare a group with Google (or a snapshot) and plan the changes."""
+        if (
+            snapshot is None
+            and self.inventory is not None
+            and group.address not in self.failed_groups
+        ):
+            # Not among the prefetched groups, so it does not exist
+            self.logger.warning("Group %s not found, will create", group.address)
+            info = "create"
+        elif snapshot is None:
+            info = self.plan_group_info(group)
+            current_aliases = None
+            current_members = None
+        else:
+            # Diff against the last applied state instead of reading Google
+            info = self.plan_group_info(
+                group, {"name": snapshot.title, "description": snapshot.description}
+            )
+            current_aliases = set(snapshot.aliases)
+            current_members = set(snapshot.members)
+        if info == "create":
+            current_aliases = set()
+            current_members = set()
+        (aliases_add, aliases_remove) = self.plan_group_aliases(group, current_aliases)
+        (members_add, members_remove) = self.plan_group_members(group, current_members)
+        return GroupPlan(
+            address=group.address,
+            info=info,
+            title=group.title,
+            description=group.description,
+            aliases_add=sorted(aliases_add),
+            aliases_remove=sorted(aliases_remove),
+            members_add=sorted(members_add),
+            members_remove=sorted(members_remove),
+        )
+
+    def plan_group_info(
+        self, group: GoogleGroup, current: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Check if group information needs to be created or updated."""
         group_key = group.address
-        group_body = {
-            "email": group.address,
-            "name": group.title,
-            "description": group.description,
-        }
         try:
-            result = self.service.groups().get(groupKey=group_key).execute()
-            if (
-                result.get("name") == group.title
-                and result.get("description") == group.description
-            ):
-                self.logger.debug("Group %s up to date", group_key)
+            if current is not None:
+                result = current
             else:
-                if not self.readonly:
-                    self.service.groups().update(
-                        groupKey=group_key, body=group_body
-                    ).execute()
-                self.logger.info("Group %s updated", group_key)
-        except Exception as exc:
+                result = self.executor.execute(
+                    self.service.groups().get(
+                        groupKey=group_key, **REQUEST_FIELDS.params("groups.get")
+                    )
+                )
+        except HttpError as exc:
+            if not is_not_found(exc):
+                raise
             self.logger.debug("Exception: %s", str(exc))
             self.logger.warning("Group %s not found, will create", group_key)
+            return "create"
+        if (
+            result.get("name") == group.title
+            and result.get("description") == group.description
+        ):
+            self.logger.debug("Group %s up to date", group_key)
+            return "unchanged"
+        return "update"
+
+    def plan_group_aliases(
+        self, group: GoogleGroup, current_group_aliases: Optional[Set[str]] = None
+    ) -> Tuple[Set[str], Set[str]]:
+        """Return aliases to add and remove."""
+        group_key = group.address
+        if current_group_aliases is None:
+            params = REQUEST_FIELDS.params("groups.aliases.list")
+            result = self.executor.execute(
+                self.service.groups().aliases().list(groupKey=group_key, **params)
+            )
+            if result is not None:
+                current_group_aliases = set(
+                    entry["alias"] for entry in result.get("aliases", [])
+                )
+            else:
+                current_group_aliases = set()
+        return (
+            set(group.aliases) - current_group_aliases,
+            current_group_aliases - set(group.aliases),
+        )
+
+    def plan_group_members(
+        self, group: GoogleGroup, current_members: Optional[Set[str]] = None
+    ) -> Tuple[Set[str], Set[str]]:
+        """Return members to add and remove."""
+        group_key = group.address
+        members = group_members(group)
+        if current_members is None:
+            current_members = set(self.get_all_members(group_key))
+        with METRICS.timer("group.diff"):
+            new_members = members - current_members
+            old_members = current_members - members
+        self.logger.debug("Current group members: %s", list(current_members))
+        self.logger.debug("New group members: %s", list(new_members))
+        self.logger.debug("Old group members: %s", list(old_members))
+        return (new_members, old_members)
+
+    def apply_plan(self, plans: List[GroupPlan]) -> List[GroupSyncResult]:
+        """Apply group plans, batching member changes across groups."""
+        if self.journal is not None:
+            plans = [self.journal.remaining(plan) for plan in plans]
+
+        def apply_group(plan: GroupPlan) -> Optional[str]:
+            try:
+                self.apply_group_info(plan)
+                self.apply_group_aliases(plan)
+            except Exception as exc:
+                self.logger.debug("Exception: %s", str(exc))
+                self.logger.error("Failed to synchronize group %s", plan.address)
+                return str(exc)
+            return None
+
+        errors = dict(
+            zip([plan.address for plan in plans], self._map(apply_group, plans))
+        )
+        changes = [
+            change
+            for plan in plans
+            if errors[plan.address] is None
+            for change in member_changes(plan)
+        ]
+        chunks = [
+            changes[start : start + BATCH_SIZE]
+            for start in range(0, len(changes), BATCH_SIZE)
+        ]
+        outcome = [
+            exc
+            for chunk_outcome in self._map(self._execute_member_batch, chunks)
+            for exc in chunk_outcome
+        ]
+        counts: Dict[str, List[int]] = {plan.address: [0, 0] for plan in plans}
+        for (change, exc) in zip(changes, outcome):
+            counts[change.group_key][0 if exc is None else 1] += 1
+        results = []
+        for plan in plans:
+            # Applied outside of a full comparison, re-read next time
+            self.forget_group(plan.address)
+            if errors[plan.address] is None and counts[plan.address][1] == 0:
+                self._journal_finished(plan.address, None)
+            results.append(
+                GroupSyncResult(
+                    plan.address,
+                    counts[plan.address][0],
+                    counts[plan.address][1],
+                    error=errors[plan.address],
+                )
+            )
+        self.log_summary(results)
+        return results
+
+    def apply_group_plan(self, plan: GroupPlan) -> GroupSyncResult:
+        """Apply the changes of a single group plan."""
+        try:
+            self.apply_group_info(plan)
+            self.apply_group_aliases(plan)
+        except Exception as exc:
+            self.logger.debug("Exception: %s", str(exc))
+            self.logger.error("Failed to synchronize group %s", plan.address)
+            return GroupSyncResult(plan.address, error=str(exc))
+        changes = member_changes(plan)
+        (succeeded, failed) = self.apply_member_changes(changes)
+        if len(changes) > 0:
+            self.logger.debug(
+                "Group %s: %d member changes applied, %d failed",
+                plan.address,
+                succeeded,
+                failed,
+            )
+        return GroupSyncResult(plan.address, succeeded, failed)
+
+    def apply_group_info(self, plan: GroupPlan) -> None:
+        """Delete, update or create group information."""
+        group_key = plan.address
+        group_body = {
+            "email": plan.address,
+            "name": plan.title,
+            "description": plan.description,
+        }
+        if plan.info == "delete":
+            self.delete_group(group_key)
+        elif plan.info == "update":
+            if not self.readonly:
+                self.executor.execute(
+                    self.service.groups().update(groupKey=group_key, body=group_body)
+                )
+            self.logger.info("Group %s updated", group_key)
+        elif plan.info == "create":
             self.logger.debug("Creating group %s: %s", group_key, group_body)
             if not self.readonly:
-                self.service.groups().insert(body=group_body).execute()
                 try:
-                    group = self.service.groups().get(groupKey=group_key).execute()
-                except Exception as exc:
-                    self.logger.debug("Exception: %s", str(exc))
-                    self.logger.warning(
-                        "Group %s not found once created, "
-                        "taking a short nap and retry",
-                        group_key,
+                    self.executor.execute(self.service.groups().insert(body=group_body))
+                except HttpError as exc:
+                    # Created by an interrupted run, make sure it is up to date
+                    if not is_conflict(exc):
+                        raise
+                    self.logger.info("Group %s already exists", group_key)
+                    self.executor.execute(
+                        self.service.groups().update(
+                            groupKey=group_key, body=group_body
+                        )
                     )
-                    time.sleep(CREATE_NAP)
-                    group = self.service.groups().get(groupKey=group_key).execute()
+                # New groups take a while to show up, poll until they do
+                group = self.executor.poll(
+                    lambda: self.service.groups().get(
+                        groupKey=group_key, **REQUEST_FIELDS.params("groups.get")
+                    ),
+                    CREATE_POLL_TIMEOUT,
+                )
                 self.logger.debug("Google returned group %s", group)
             self.logger.info("Group %s created", group_key)
+        if plan.info != "unchanged":
+            self._journal_done(group_key, INFO_OP)
 
-    def sync_group_aliases(self, group: GoogleGroup) -> None:
-        """Update/create group information."""
-        group_key = group.address
-        result = self.service.groups().aliases().list(groupKey=group_key).execute()
-        if result is not None:
-            current_group_aliases = set(
-                entry["alias"] for entry in result.get("aliases", [])
-            )
-        else:
-            current_group_aliases = set()
-        for alias in set(group.aliases) - current_group_aliases:
+    def apply_group_aliases(self, plan: GroupPlan) -> None:
+        """Add and remove group aliases."""
+        group_key = plan.address
+        for alias in plan.aliases_add:
             self.logger.info("Adding alias: %s", alias)
             alias_body = {"alias": alias}
             if not self.readonly:
-                result = (
-                    self.service.groups()
-                    .aliases()
-                    .insert(groupKey=group_key, body=alias_body)
-                    .execute()
-                )
-                self.logger.debug("Insert result: %s", result)
-        for alias in current_group_aliases - set(group.aliases):
+                try:
+                    result = self.executor.execute(
+                        self.service.groups()
+                        .aliases()
+                        .insert(groupKey=group_key, body=alias_body)
+                    )
+                    self.logger.debug("Insert result: %s", result)
+                except HttpError as exc:
+                    if not is_conflict(exc) or not self.owns_alias(group_key, alias):
+                        raise
+                    self.logger.info("Alias %s already exists", alias)
+            self._journal_done(group_key, alias_op("add", alias))
+        for alias in plan.aliases_remove:
             self.logger.info("Removing alias: %s", alias)
             if not self.readonly:
-                result = (
-                    self.service.groups()
-                    .aliases()
-                    .delete(groupKey=group_key, alias=alias)
-                    .execute()
-                )
-                self.logger.debug("Delete result: %s", result)
+                try:
+                    result = self.executor.execute(
+                        self.service.groups()
+                        .aliases()
+                        .delete(groupKey=group_key, alias=alias)
+                    )
+                    self.logger.debug("Delete result: %s", result)
+                except HttpError as exc:
+                    if not is_not_found(exc):
+                        raise
+                    self.logger.info("Alias %s already removed", alias)
+            self._journal_done(group_key, alias_op("remove", alias))
 
-    def sync_group_members(self, group: GoogleGroup) -> None:
-        """Synchronize group members."""
-        group_key = group.address
-        members = set(
-            [re.sub(r"\+[^@]+", "", member) for member in group.members]
-        )  # remove + notation
-        current_members = set(self.get_all_members(group_key))
-        new_members = members - current_members
-        old_members = current_members - members
-        self.logger.debug("Current group members: %s", list(current_members))
-        self.logger.debug("New group members: %s", list(new_members))
-        self.logger.debug("Old group members: %s", list(old_members))
-        for member_key in new_members:
-            member_body = {"email": member_key}
-            try:
-                if not self.readonly:
-                    self.service.members().insert(
-                        groupKey=group_key, body=member_body
-                    ).execute()
-                self.logger.info("Added member %s to group %s", member_key, group_key)
-            except Exception as exc:
-                self.logger.debug("Exception: %s", str(exc))
-                self.logger.error("Failed to add %s to group %s", member_key, group_key)
-        for member_key in old_members:
-            try:
-                if not self.readonly:
-                    self.service.members().delete(
-                        groupKey=group_key, memberKey=member_key
-                    ).execute()
-                self.logger.info(
-                    "Removed member %s from group %s", member_key, group_key
+    def owns_alias(self, group_key: str, alias: str) -> bool:
+        """Check that an existing alias belongs to the group."""
+        owner = self.executor.execute(
+            self.service.groups().get(
+                groupKey=alias, **REQUEST_FIELDS.params("groups.get")
+            )
+        )
+        if owner.get("email", "").lower() == group_key.lower():
+            return True
+        self.logger.error("Alias %s belongs to group %s", alias, owner.get("email"))
+        return False
+
+    def _member_request(self, change: MemberChange) -> Any:
+        """Build the API request for a member change."""
+        if change.action == "add":
+            return self.service.members().insert(
+                groupKey=change.group_key, body={"email": change.member_key}
+            )
+        return self.service.members().delete(
+            groupKey=change.group_key, memberKey=change.member_key
+        )
+
+    def _log_member_change(
+        self, change: MemberChange, exc: Optional[Exception]
+    ) -> None:
+        """Log the outcome of a member change."""
+        if exc is not None:
+            self.logger.debug("Exception: %s", str(exc))
+            if change.action == "add":
+                self.logger.error(
+                    "Failed to add %s to group %s", change.member_key, change.group_key
                 )
-            except Exception as exc:
-                self.logger.debug("Exception: %s", str(exc))
+            else:
                 self.logger.error(
-                    "Failed to delete %s from group %s", member_key, group_key
+                    "Failed to delete %s from group %s",
+                    change.member_key,
+                    change.group_key,
                 )
+        elif change.action == "add":
+            self.logger.info(
+                "Added member %s to group %s", change.member_key, change.group_key
+            )
+        else:
+            self.logger.info(
+                "Removed member %s from group %s", change.member_key, change.group_key
+            )
 
-    def get_all_groups(self, re_filter: str) -> List[str]:
-        """Get all groups matching filter."""
-        all_groups: List[str] = []
+    def _execute_member_batch(
+        self, chunk: List[MemberChange]
+    ) -> List[Optional[Exception]]:
+        """Apply member changes in one batch request, return errors."""
+        if self.readonly:
+            errors: List[Optional[Exception]] = [None] * len(chunk)
+        else:
+            responses = self.executor.execute_batch(
+                self.service.new_batch_http_request,
+                [self._member_request(change) for change in chunk],
+            )
+            errors = [
+                None if already_applied(change, exc) else exc
+                for (change, (_, exc)) in zip(chunk, responses)
+            ]
+        for (change, exc) in zip(chunk, errors):
+            self._log_member_change(change, exc)
+            if exc is None:
+                self._journal_done(
+                    change.group_key, member_op(change.action, change.member_key)
+                )
+        return errors
+
+    def apply_member_changes(self, changes: List[MemberChange]) -> Tuple[int, int]:
+        """Apply member changes in batch requests, return (succeeded, failed)."""
+        failed = 0
+        for start in range(0, len(changes), BATCH_SIZE):
+            outcome = self._execute_member_batch(changes[start : start + BATCH_SIZE])
+            failed += len([exc for exc in outcome if exc is not None])
+        return (len(changes) - failed, failed)
+
+    def list_groups(self) -> List[Dict[str, Any]]:
+        """Get all groups in the domain."""
+        all_groups: List[Dict[str, Any]] = []
         token = None
-        max_results = MAX_RESULTS
+        params = REQUEST_FIELDS.params("groups.list")
         while True:
-            result = (
-                self.service.groups()
-                .list(domain=self.domain, pageToken=token, maxResults=max_results)
-                .execute()
+            result = self.executor.execute(
+                self.service.groups().list(
+                    domain=self.domain, pageToken=token, **params
+                )
             )
-            for group in result.get("groups", []):
-                group_address = group["email"]
-                group_name = group["name"]
-                if re.match(re_filter, group_name):
-                    self.logger.debug("Including group %s", group_address)
-                    all_groups.append(group_address)
-                else:
-                    self.logger.info("Excluding group %s", group_address)
+            all_groups.extend(result.get("groups", []))
             token = result.get("nextPageToken")
             if token is None:
                 break
         return all_groups
 
+    def get_all_groups(self, re_filter: str) -> List[str]:
+        """Get all groups matching filter."""
+        all_groups: List[str] = []
+        for group in self.list_groups():
+            group_address = group["email"]
+            group_name = group["name"]
+            if re.match(re_filter, group_name):
+                self.logger.debug("Including group %s", group_address)
+                all_groups.append(group_address)
+            else:
+                self.logger.info("Excluding group %s", group_address)
+        return all_groups
+
     def get_all_members(self, group_key: str) -> List[str]:
         """Get all members in group."""
         all_members: List[str] = []
         token = None
-        max_results = MAX_RESULTS
+        params = REQUEST_FIELDS.params("members.list")
         while True:
-            result = (
-                self.service.members()
-                .list(groupKey=group_key, pageToken=token, maxResults=max_results)
-                .execute()
+            result = self.executor.execute(
+                self.service.members().list(
+                    groupKey=group_key, pageToken=token, **params
+                )
             )
             for member in result.get("members", []):
                 if "email" in member:
-                    all_members.append(member.get("email").lower())
+                    all_members.append(NORMALIZER.normalize(member.get("email")))
             token = result.get("nextPageToken")
             if token is None:
                 break
         return all_members
 
 
-def mailinglist2groups(mlist: ScoutnetMailinglist) -> List[GoogleGroup]:
+def mailinglist2groups(mlist: "ScoutnetMailinglist") -> List[GoogleGroup]:
     """Convert Scoutnet mailinglist to Google groups."""
     groups = []
-    members = []
+    # All groups of a list share one set of members
+    members = NORMALIZER.canonical_all(mlist.members)
     for address in mlist.aliases:
         if mlist.title is not None:
             title = f"{mlist.title} {SCOUTNET_TAG}"
@@ -244,12 +825,6 @@ def mailinglist2groups(mlist: ScoutnetMailinglist) -> List[GoogleGroup]:
             description = re.sub(r"[\n\r=]", "", mlist.description.strip())
         else:
             description = None
-        for member in mlist.members:
-            for (pattern, repl) in EMAIL_REWRITES:
-                rewritten = re.sub(pattern, repl, member)
-                if rewritten != member:
-                    logging.debug("Address %s rewritten to %s", member, rewritten)
-                members.append(rewritten)
         groups.append(
             GoogleGroup(
                 address=address, members=members, title=title, description=description
@@ -258,12 +833,117 @@ def mailinglist2groups(mlist: ScoutnetMailinglist) -> List[GoogleGroup]:
     return groups
 
 
-def main() -> None:
+def google_credentials(config: S2g_config) -> Any:
+    """Authenticate with Google as configured."""
+    if config["google"]["auth"] == "installed":
+        installed = lazy_import("scoutnet2google.google_auth_installed")
+        return installed.google_auth_installed(
+            CLIENT_SECRETS_FILE, config.tenant_file(CLIENT_TOKEN_FILE), SCOPES
+        )
+    elif config["google"]["auth"] == "compute_engine":
+        return lazy_import("google.auth.compute_engine").Credentials()
+    logging.critical("Unknown authentication method")
+    sys.exit(-1)
+
+
+def google_directory(
+    config: S2g_config,
+    readonly: bool,
+    state: Optional[SyncState] = None,
+    full_reconcile: bool = True,
+    stagger: float = 0.0,
+    credentials: Any = None,
+    bucket: Optional[TokenBucket] = None,
+) -> GoogleDirectory:
+    """Create a directory using the configured settings.
+
+    Authenticates unless credentials are given. A bucket given is shared
+    with other directories instead of the configured rate limit.
+    """
+    if credentials is None:
+        credentials = google_credentials(config)
+    service = build_service(
+        API_SERVICE_NAME, API_VERSION, credentials, config["google"]
+    )
+
+    def service_factory() -> Any:
+        return clone_service(service, credentials)
+
+    executor = RequestExecutor(
+        rate=config.getfloat("google", "rate_limit"),
+        burst=config.getint("google", "rate_burst"),
+        max_retries=config.getint("google", "max_retries"),
+        bucket=bucket,
+    )
+    return GoogleDirectory(
+        service,
+        config["google"]["domain"],
+        readonly,
+        workers=config.getint("google", "sync_workers"),
+        service_factory=service_factory,
+        state=state,
+        full_reconcile=full_reconcile,
+        executor=executor,
+        stagger=stagger,
+    )
+
+
+def configure_addresses(config: S2g_config) -> None:
+    """Set up e-mail address normalization as configured."""
+    NORMALIZER.configure(
+        parse_rewrites(config["google"]["email_rewrites"]),
+        strip_plus=config.getboolean("google", "strip_plus"),
+    )
+
+
+def scoutnet_api(config: S2g_config) -> "ScoutnetMailinglistApi":
+    """Create a Scoutnet mailinglist client using the configured settings."""
+    from scoutnet2google.scoutnet import ScoutnetMailinglistApi
+
+    return ScoutnetMailinglistApi(
+        api_endpoint=config["scoutnet"]["api_endpoint"],
+        api_id=config["scoutnet"]["api_id"],
+        api_key=config["scoutnet"]["api_key_groups"],
+        domain=config["google"]["domain"],
+        workers=config.getint("scoutnet", "fetch_workers"),
+        cache_max_age=config.scoutnet_cache_max_age(),
+        max_connections=config.getint("scoutnet", "max_connections"),
+    )
+
+
+def all_succeeded(results: List[GroupSyncResult]) -> bool:
+    """Check that all groups were synchronized without errors."""
+    return all(
+        result.error is None and result.members_failed == 0 for result in results
+    )
+
+
+def report_metrics(filename: Optional[str] = None) -> None:
+    """Log the timing summary and optionally write it to a file."""
+    METRICS.log_summary()
+    if filename:
+        METRICS.write(filename)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
     """main."""
     parser = argparse.ArgumentParser(
         description="Synchronize Scoutnet email lists with GSuite groups."
     )
 
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="sync",
+        choices=["sync", "plan", "apply"],
+        help="Synchronize (default), write changes to a plan file or apply a plan",
+    )
+    parser.add_argument(
+        "--plan-file",
+        dest="plan_file",
+        metavar="filename",
+        help="Plan file to write (plan) or read (apply)",
+    )
     parser.add_argument(
         "--limit",
         dest="limit",
@@ -272,7 +952,16 @@ def main() -> None:
         help="Only process n groups (dangerous!)",
     )
     parser.add_argument(
-        "--output", dest="output", metavar="filename", help="Write all groups to file"
+        "--output",
+        dest="output",
+        metavar="filename",
+        help="Write all groups to file while fetching them",
+    )
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=FORMATS,
+        help="Format of --output (default from its extension, else json)",
     )
     parser.add_argument(
         "--skip-google",
@@ -286,13 +975,47 @@ def main() -> None:
         action="store_true",
         help="Test mode (no changes written)",
     )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Continue an interrupted sync or apply from the journal",
+    )
+    parser.add_argument(
+        "--tenant",
+        dest="tenant",
+        metavar="name",
+        help="Use the [scoutnet:name] and [google:name] config sections",
+    )
+    parser.add_argument(
+        "--full-reconcile",
+        dest="full_reconcile",
+        action="store_true",
+        help="Verify all groups against Google, not only changed ones",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics",
+        metavar="filename",
+        help="Write timings as JSON, or as Prometheus textfile if ending in .prom",
+    )
     parser.add_argument(
         "--verbose", dest="verbose", action="store_true", help="Enable verbose output"
     )
     parser.add_argument(
         "--debug", dest="debug", action="store_true", help="Enable debugging output"
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.command != "sync":
+        if args.plan_file is None:
+            parser.error("%s requires --plan-file" % args.command)
+        if args.skip_google:
+            parser.error("%s can not be combined with --skip-google" % args.command)
+    if args.output:
+        try:
+            check_export(args.output, args.output_format)
+        except ValueError as exc:
+            parser.error(str(exc))
 
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
@@ -305,53 +1028,112 @@ def main() -> None:
         logging.getLogger("googleapiclient.discovery").setLevel(logging.DEBUG)
 
     config = S2g_config()
+    if args.tenant is not None:
+        if args.tenant not in config.tenants():
+            parser.error("unknown tenant %s" % args.tenant)
+        config = config.for_tenant(args.tenant)
+    configure_addresses(config)
 
     if not args.skip_google:
-        # Authenticate with Google
-        if config["google"]["auth"] == "installed":
-            credentials = google_auth_installed(
-                CLIENT_SECRETS_FILE, CLIENT_TOKEN_FILE, SCOPES
-            )
-        elif config["google"]["auth"] == "compute_engine":
-            credentials = google.auth.compute_engine.Credentials()
-        else:
-            logging.critical("Unknown authentication method")
-            sys.exit(-1)
-        service = googleapiclient.discovery.build(
-            API_SERVICE_NAME,
-            API_VERSION,
-            credentials=credentials,
-            cache_discovery=False,
+        plan_digest = None
+        if args.command == "apply":
+            with open(args.plan_file, "rb") as file:
+                plan_digest = hashlib.sha256(file.read()).hexdigest()
+        state = SyncState(config.tenant_file(DEFAULT_STATE_FILE))
+        full_reconcile = args.full_reconcile or state.reconcile_due(
+            config.getfloat("google", "full_reconcile_days")
+        )
+        directory = google_directory(
+            config,
+            args.dry_run or args.command == "plan",
+            state=state,
+            full_reconcile=full_reconcile,
         )
-        directory = GoogleDirectory(service, config["google"]["domain"], args.dry_run)
+        executor = directory.executor
+        if not directory.readonly:
+            try:
+                directory.journal = Journal(
+                    config.tenant_file(DEFAULT_JOURNAL_FILE),
+                    resume=args.resume,
+                    plan_digest=plan_digest,
+                )
+            except ValueError as exc:
+                parser.error(str(exc))
 
-    # Configure Scoutnet
-    scoutnet = ScoutnetMailinglistApi(
-        api_endpoint=config["scoutnet"]["api_endpoint"],
-        api_id=config["scoutnet"]["api_id"],
-        api_key=config["scoutnet"]["api_key_groups"],
-        domain=config["google"]["domain"],
-    )
+        if args.command == "apply":
+            with open(args.plan_file, "rt") as file:
+                plans = list(read_plan(file))
+            with METRICS.timer("phase.apply"):
+                results = directory.apply_plan(plans)
+            if directory.journal is not None:
+                directory.journal.close(completed=all_succeeded(results))
+            executor.log_stats()
+            report_metrics(args.metrics)
+            state.close()
+            return
 
-    # Fetch all mailing lists from Scoutnet
-    all_lists = scoutnet.get_all_lists(args.limit)
+    scoutnet = scoutnet_api(config)
 
-    # Optionally output all groups to file
-    if args.output:
-        with open(args.output, "wt") as file:
-            file.write(
-                json.dumps([x.__dict__ for x in all_lists], sort_keys=True, indent=4)
-            )
+    # Fetch all mailing lists from Scoutnet, optionally streaming them to file
+    with METRICS.timer("phase.scoutnet"):
+        if args.output:
+            all_lists = []
+            with Exporter(args.output, args.output_format) as exporter:
+                for mlist in scoutnet.iter_lists(args.limit):
+                    exporter.write(list_record(mlist))
+                    if not args.skip_google:
+                        all_lists.append(mlist)
+            logging.info("Wrote %d groups to %s", exporter.count, args.output)
+        else:
+            all_lists = scoutnet.get_all_lists(args.limit)
+    if scoutnet.failed:
+        # A group of a list that failed must not be taken for a removed one
+        logging.error(
+            "Failed to fetch %d Scoutnet lists, no groups will be deleted",
+            len(scoutnet.failed),
+        )
 
     # Convert Scoutnet mailinglists to Google groups
     all_groups = []
     for mlist in all_lists:
         all_groups.extend(mailinglist2groups(mlist))
 
+    if args.command == "plan":
+        with METRICS.timer("phase.plan"):
+            plans = directory.plan_groups(
+                all_groups, delete_removed=not scoutnet.failed
+            )
+        with open(args.plan_file, "wt") as file:
+            count = write_plan(plans, file)
+        logging.info("Wrote changes to %d groups to %s", count, args.plan_file)
+        executor.log_stats()
+        report_metrics(args.metrics)
+        state.close()
+        if scoutnet.failed:
+            sys.exit(1)
+        return
+
     # Syncronize with Google Directory
     if not args.skip_google:
         # noinspection PyUnboundLocalVariable
-        directory.sync_groups(all_groups)
+        with METRICS.timer("phase.sync"):
+            results = directory.sync_groups(
+                all_groups, delete_removed=not scoutnet.failed
+            )
+        if full_reconcile and not args.dry_run and args.limit is None:
+            if not scoutnet.failed and all(
+                result.error is None for result in results
+            ):
+                state.mark_reconciled()
+        if directory.journal is not None:
+            directory.journal.close(
+                completed=all_succeeded(results) and not scoutnet.failed
+            )
+        executor.log_stats()
+        state.close()
+    report_metrics(args.metrics)
+    if scoutnet.failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
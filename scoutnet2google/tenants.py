@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Synchronize the mailing lists of many tenants in one process."""
+
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from scoutnet2google.manage_config import S2g_config
+from scoutnet2google.state import SyncState, DEFAULT_STATE_FILE
+from scoutnet2google.executor import TokenBucket
+from scoutnet2google.sync_mailinglists import (
+    configure_addresses,
+    google_credentials,
+    google_directory,
+    mailinglist2groups,
+    scoutnet_api,
+)
+
+# Settings of the whole process, they can not differ between tenants
+SHARED_GOOGLE_KEYS = [
+    "email_rewrites",
+    "strip_plus",
+    "partial_responses",
+    "rate_limit",
+    "rate_burst",
+]
+
+
+def tenant_overrides(config: S2g_config, names: List[str]) -> List[str]:
+    """Return the shared [google] settings overridden in tenant sections."""
+    overrides = []
+    for name in names:
+        section = "google:%s" % name
+        for key in SHARED_GOOGLE_KEYS:
+            if config.has_section(section) and config.has_option(section, key):
+                overrides.append("%s in [%s]" % (key, section))
+    return overrides
+
+
+@dataclass
+class TenantReport:
+    """Hold the outcome of synchronizing one tenant."""
+
+    tenant: str
+    domain: str = None
+    seconds: float = 0.0
+    lists: int = 0
+    groups: int = 0
+    unchanged: int = 0
+    member_changes: int = 0
+    member_failures: int = 0
+    group_failures: int = 0
+    error: Optional[str] = None
+    google: Dict[str, float] = field(default_factory=dict)
+
+
+def sync_tenant(
+    config: S2g_config,
+    dry_run: bool = False,
+    full_reconcile: bool = False,
+    credentials: Any = None,
+    bucket: Optional[TokenBucket] = None,
+) -> TenantReport:
+    """Synchronize the mailing lists of one tenant."""
+    report = TenantReport(config.tenant, domain=config["google"]["domain"])
+    logger = logging.getLogger("Tenant").getChild(config.tenant)
+    start = time.monotonic()
+    state = None
+    directory = None
+    try:
+        state = SyncState(config.tenant_file(DEFAULT_STATE_FILE))
+        full_reconcile = full_reconcile or state.reconcile_due(
+            config.getfloat("google", "full_reconcile_days")
+        )
+        # Each tenant gets its own executor and counters, the rate limit is shared
+        directory = google_directory(
+            config,
+            dry_run,
+            state=state,
+            full_reconcile=full_reconcile,
+            credentials=credentials,
+            bucket=bucket,
+        )
+        scoutnet = scoutnet_api(config)
+        all_lists = scoutnet.get_all_lists()
+        all_groups = []
+        for mlist in all_lists:
+            all_groups.extend(mailinglist2groups(mlist))
+        results = directory.sync_groups(
+            all_groups, delete_removed=not scoutnet.failed
+        )
+        if full_reconcile and not dry_run and not scoutnet.failed:
+            if all(result.error is None for result in results):
+                state.mark_reconciled()
+        report.lists = len(all_lists)
+        report.groups = len(results)
+        report.unchanged = len([result for result in results if result.skipped])
+        report.member_changes = sum(result.members_changed for result in results)
+        report.member_failures = sum(result.members_failed for result in results)
+        report.group_failures = len(
+            [result for result in results if result.error is not None]
+        )
+        if scoutnet.failed:
+            report.error = "Failed to fetch %d Scoutnet lists" % len(scoutnet.failed)
+    except Exception as exc:
+        logger.debug("Exception: %s", str(exc))
+        logger.error("Failed to synchronize tenant %s: %s", config.tenant, str(exc))
+        report.error = str(exc) or exc.__class__.__name__
+    finally:
+        if state is not None:
+            state.close()
+    if directory is not None:
+        report.google = dict(directory.executor.counters)
+    report.seconds = time.monotonic() - start
+    return report
+
+
+def sync_tenants(
+    configs: List[S2g_config],
+    workers: int,
+    dry_run: bool = False,
+    full_reconcile: bool = False,
+    bucket: Optional[TokenBucket] = None,
+) -> List[TenantReport]:
+    """Synchronize tenants, at most workers at a time.
+
+    All tenants use one Google project, so they share one rate limit.
+    Credentials are obtained up front, since authorizing an installed
+    application may prompt on the console.
+    """
+    credentials = [google_credentials(config) for config in configs]
+
+    def sync(args: Any) -> TenantReport:
+        (config, tenant_credentials) = args
+        return sync_tenant(config, dry_run, full_reconcile, tenant_credentials, bucket)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(sync, zip(configs, credentials)))
+
+
+def log_report(reports: List[TenantReport]) -> None:
+    """Log a combined summary of all tenants."""
+    logger = logging.getLogger("Tenant")
+    for report in reports:
+        if report.error is not None:
+            logger.warning("  %-20s error: %s", report.tenant, report.error)
+            continue
+        logger.info(
+            "  %-20s %4d groups (%4d unchanged), %5d member changes, "
+            "%4d failed, %4d groups failed, %5d requests, %.1fs",
+            report.tenant,
+            report.groups,
+            report.unchanged,
+            report.member_changes,
+            report.member_failures,
+            report.group_failures,
+            report.google.get("requests", 0),
+            report.seconds,
+        )
+    logger.info(
+        "Synchronized %d tenants (%d failed)",
+        len(reports),
+        len([report for report in reports if report.error is not None]),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """main."""
+    parser = argparse.ArgumentParser(
+        description="Synchronize Scoutnet email lists of many tenants with GSuite."
+    )
+    parser.add_argument(
+        "--tenant",
+        dest="tenants",
+        metavar="name",
+        action="append",
+        help="Only synchronize this tenant (may be repeated)",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        metavar="N",
+        type=int,
+        help="Number of tenants synchronized at the same time",
+    )
+    parser.add_argument(
+        "--report", dest="report", metavar="filename", help="Write report as JSON"
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Test mode (no changes written)",
+    )
+    parser.add_argument(
+        "--full-reconcile",
+        dest="full_reconcile",
+        action="store_true",
+        help="Verify all groups against Google, not only changed ones",
+    )
+    parser.add_argument(
+        "--verbose", dest="verbose", action="store_true", help="Enable verbose output"
+    )
+    parser.add_argument(
+        "--debug", dest="debug", action="store_true", help="Enable debugging output"
+    )
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+        logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
+        logging.getLogger("googleapiclient.discovery").setLevel(logging.WARNING)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = S2g_config()
+    # Addresses are normalized the same way for all tenants
+    configure_addresses(config)
+    names = args.tenants or config.tenants()
+    for name in names:
+        if name not in config.tenants():
+            parser.error("unknown tenant %s" % name)
+    if len(names) == 0:
+        parser.error("no tenants configured")
+    overrides = tenant_overrides(config, names)
+    if overrides:
+        parser.error(
+            "%s can only be set in [google] when syncing many tenants"
+            % ", ".join(overrides)
+        )
+
+    workers = args.workers or config.getint("tenants", "workers")
+    bucket = None
+    if config.getfloat("google", "rate_limit") > 0:
+        bucket = TokenBucket(
+            config.getfloat("google", "rate_limit"),
+            config.getint("google", "rate_burst"),
+        )
+    reports = sync_tenants(
+        [config.for_tenant(name) for name in names],
+        workers,
+        args.dry_run,
+        args.full_reconcile,
+        bucket,
+    )
+    log_report(reports)
+
+    if args.report:
+        with open(args.report, "wt") as file:
+            json.dump([asdict(report) for report in reports], file, indent=4)
+
+    if any(report.error is not None for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()